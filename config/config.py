@@ -11,6 +11,42 @@ class Config:
         self.S3_DATASET_BUCKET = f'{self.PREFIX}-massage-dataset'
         self.DATASET_GROUP_NAME = f'{self.PREFIX}-massage-dataset-group'
         self.PERSONALIZE_ROLE_NAME = f'{self.PREFIX.capitalize()}PersonalizeRole'
+        self.CAMPAIGN_POINTER_KEY = 'campaign-pointer.json'
+        # 'aws' or 'fake', the in-memory backend of helpers.fake_aws
+        self.AWS_BACKEND = os.getenv('AWS_BACKEND', 'aws').lower()
+        # Seconds between two status checks of a Personalize resource, and after creating the IAM role
+        self.PERSONALIZE_POLL_INTERVAL = float(os.getenv('PERSONALIZE_POLL_INTERVAL', 60))
+        self.IAM_PROPAGATION_DELAY = float(os.getenv('IAM_PROPAGATION_DELAY', 10))
+        # Process-wide rate limits and throttle retries of the Personalize and S3 control-plane calls
+        self.RATE_GOVERNOR = os.getenv('RATE_GOVERNOR', 'on').lower() != 'off'
+        self.PERSONALIZE_CONTROL_TPS = float(os.getenv('PERSONALIZE_CONTROL_TPS', 8))
+        self.S3_CONTROL_TPS = float(os.getenv('S3_CONTROL_TPS', 100))
+        self.CONTROL_MAX_ATTEMPTS = int(os.getenv('CONTROL_MAX_ATTEMPTS', 8))
+        self.RECOMMENDATION_STORE_DIR = os.path.join(self.BASE_DIR, 'data', 'recommendation_store')
+        self.SERVING_DIR = os.path.join(self.BASE_DIR, 'data', 'serving')
+        self.FALLBACK_RECOMMENDER_PATH = os.path.join(self.SERVING_DIR, 'cooccurrence.npz')
+        self.ITEM_CATALOG_PATH = os.path.join(self.SERVING_DIR, 'item_catalog.json')
+        self.USER_TABLE_PATH = os.path.join(self.SERVING_DIR, 'user_table.npz')
+        self.KNOWN_USERS_PATH = os.path.join(self.SERVING_DIR, 'known_users.npz')
+        self.KNOWN_USERS_FALSE_POSITIVE_RATE = 0.01
+        self.COLD_START_RECOMMENDER_PATH = os.path.join(self.SERVING_DIR, 'cold_start.npz')
+        self.SHARD_ROUTER_PATH = os.path.join(self.SERVING_DIR, 'shard_router.json')
+        # The datasets, import files and fingerprints of each shard
+        self.SHARD_DIR = os.path.join(self.BASE_DIR, 'data', 'shards')
+        self.DATASET_FINGERPRINT_PATH = os.path.join(self.BASE_DIR, 'data', 'dataset_fingerprints.npz')
+        # Only export the interactions of the last N months to Personalize, 0 exports the whole history
+        self.TRAINING_WINDOW_MONTHS = int(os.getenv('TRAINING_WINDOW_MONTHS', 0))
+        self.REQUEST_RATE_DIR = os.getenv('REQUEST_RATE_DIR', os.path.join(self.BASE_DIR, 'data', 'request_rates'))
+        # Opt-in: the serving hosts upload their request rate files under this prefix of S3_DATASET_BUCKET,
+        # e.g. request-rates, and the training host plans from them. Empty plans from REQUEST_RATE_DIR only
+        self.REQUEST_RATE_S3_PREFIX = os.getenv('REQUEST_RATE_S3_PREFIX', '')
+        self.REQUEST_RATE_DOWNLOAD_DIR = os.getenv('REQUEST_RATE_DOWNLOAD_DIR',
+                                                   os.path.join(self.BASE_DIR, 'data', 'request_rates_s3'))
+        self.RUN_REPORT_DIR = os.path.join(self.BASE_DIR, 'data', 'reports', 'runs')
+        self.BENCHMARK_REPORT_DIR = os.path.join(self.BASE_DIR, 'data', 'reports', 'benchmarks')
+        self.BENCHMARK_DATA_DIR = os.path.join(self.BASE_DIR, 'data', 'synthetic')
+        self.CAPACITY_REPORT_PATH = os.path.join(self.BASE_DIR, 'data', 'reports', 'capacity_plan.json')
+        self.EVENT_TRACKER_PATH = os.path.join(self.SERVING_DIR, 'event_tracker.json')
 
 
 class StagingConfig(Config):
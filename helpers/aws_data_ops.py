@@ -4,7 +4,7 @@ import pandas as pd
 
 from config.config import settings
 from config.log_config import logger
-from helpers.connection import create_session
+from helpers.connection import connect_to_s3_client
 
 
 def read_data_file_from_s3(bucket_object, s3_file_name, is_parquet=True):
@@ -26,6 +26,60 @@ def read_data_file_from_s3(bucket_object, s3_file_name, is_parquet=True):
     return pd.read_csv(io.BytesIO(data), header=0, delimiter=",", low_memory=False)
 
 
+def split_s3_path(s3_path):
+    """
+    Split an S3 path into its bucket and key
+
+    :param s3_path: str, the S3 path. Ex: s3://bucket/exports/full.csv
+    :return: (str, str), the bucket name and the key
+    """
+    bucket_name, _, key = s3_path[len('s3://'):].partition('/')
+    return bucket_name, key
+
+
+def list_s3_keys(s3_client, bucket_name, prefix=''):
+    """
+    List the keys under a prefix, following the pagination
+
+    :param s3_client: object, boto3 s3 client object
+    :param bucket_name: str, boto3 s3 bucket name
+    :param prefix: str, the key prefix, default ''
+    :return: list, the keys and their sizes, dicts with Key and Size
+    """
+    objects, kwargs = [], {'Bucket': bucket_name, 'Prefix': prefix}
+    while True:
+        response = s3_client.list_objects_v2(**kwargs)
+        objects += [{'Key': obj['Key'], 'Size': obj['Size']} for obj in response.get('Contents', [])]
+        if not response.get('IsTruncated'):
+            return objects
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def read_s3_object(s3_client, bucket_name, key):
+    """
+    Read an object of s3 bucket
+
+    :param s3_client: object, boto3 s3 client object
+    :param bucket_name: str, boto3 s3 bucket name
+    :param key: str, the object key
+    :return: bytes, the object content
+    """
+    return s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+
+
+def open_s3_object(s3_client, bucket_name, key):
+    """
+    Open an object of s3 bucket as a stream, to read it chunk by chunk
+
+    :param s3_client: object, boto3 s3 client object
+    :param bucket_name: str, boto3 s3 bucket name
+    :param key: str, the object key
+    :return: (file-like, int), the object body and its size in bytes
+    """
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    return response['Body'], response['ContentLength']
+
+
 def upload_file_to_s3(s3_client, file_name, bucket_name, object_name=None):
     """
     Upload file to s3 bucket
@@ -90,9 +144,8 @@ def create_bucket(bucket_name, profile_name=None):
     :return: object, boto3 s3 bucket object
     """
 
-    session = create_session(profile_name=profile_name)
-    region = session.region_name
-    s3_client = session.client("s3", region_name=region)
+    s3_client = connect_to_s3_client(profile_name=profile_name)
+    region = s3_client.meta.region_name
 
     # Check if bucket exist
     response = s3_client.list_buckets()
@@ -101,9 +154,11 @@ def create_bucket(bucket_name, profile_name=None):
             logger.info(f"Bucket {bucket_name} already exists in {region} region")
             return bucket_name
 
-    s3_client.create_bucket(
-        Bucket=bucket_name, CreateBucketConfiguration={"LocationConstraint": region}
-    )
+    # us-east-1 is the default location and rejects a LocationConstraint
+    bucket_params = {}
+    if region and region != "us-east-1":
+        bucket_params["CreateBucketConfiguration"] = {"LocationConstraint": region}
+    s3_client.create_bucket(Bucket=bucket_name, **bucket_params)
 
     logger.info(f"Bucket {bucket_name} created in {region} region")
     return bucket_name
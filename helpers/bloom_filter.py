@@ -0,0 +1,94 @@
+import hashlib
+import math
+
+import numpy as np
+
+UINT64_MASK = (1 << 64) - 1
+
+
+def _hash_pair(value):
+    digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+
+class BloomFilter:
+    """
+    Bloom filter on a numpy bit array, with k indices derived from one 128-bit blake2b hash
+    (Kirsch-Mitzenmacher double hashing). Lookups never touch the network and take a few microseconds.
+    """
+
+    def __init__(self, n_bits, n_hashes, bits=None):
+        """
+        :param n_bits: int, the size of the bit array
+        :param n_hashes: int, the number of hash functions
+        :param bits: np.ndarray, packed uint8 bits of an existing filter. Default: None, an empty filter
+        """
+        self.n_bits = int(n_bits)
+        self.n_hashes = int(n_hashes)
+        self.bits = bits if bits is not None else np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+        # Indexing bytes is much faster than numpy scalar indexing for single lookups
+        self._lookup_bytes = None
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=0.01):
+        """
+        Create an empty filter sized for `capacity` values at the given false positive rate
+
+        :param capacity: int, the expected number of values
+        :param false_positive_rate: float, the target false positive rate
+        :return: BloomFilter
+        """
+        capacity = max(int(capacity), 1)
+        n_bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        n_hashes = max(1, round(n_bits / capacity * math.log(2)))
+        return cls(n_bits, n_hashes)
+
+    def _indices(self, h1, h2):
+        return [((h1 + i * h2) & UINT64_MASK) % self.n_bits for i in range(self.n_hashes)]
+
+    def add_many(self, values):
+        """
+        Add values to the filter
+
+        :param values: iterable, the values
+        :return: BloomFilter, self
+        """
+        pairs = np.array([_hash_pair(value) for value in values], dtype=np.uint64).reshape(-1, 2)
+        h1, h2 = pairs[:, 0], pairs[:, 1]
+        for i in range(self.n_hashes):
+            # uint64 arithmetic wraps around like the & UINT64_MASK of single lookups
+            indices = (h1 + np.uint64(i) * h2) % np.uint64(self.n_bits)
+            np.bitwise_or.at(self.bits, (indices >> np.uint64(3)).astype(np.int64),
+                             (np.uint8(1) << (indices & np.uint64(7)).astype(np.uint8)))
+        self._lookup_bytes = None
+        return self
+
+    def __contains__(self, value):
+        h1, h2 = _hash_pair(value)
+        bits = self._lookup_bytes
+        if bits is None:
+            bits = self._lookup_bytes = self.bits.tobytes()
+        for index in self._indices(h1, h2):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def save(self, path):
+        """
+        Save the filter to a .npz file
+
+        :param path: str, the file path
+        :return: None
+        """
+        np.savez_compressed(path, bits=self.bits, n_bits=self.n_bits, n_hashes=self.n_hashes)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a filter saved with `save`
+
+        :param path: str, the file path
+        :return: BloomFilter
+        """
+        with np.load(path) as arrays:
+            return cls(int(arrays['n_bits']), int(arrays['n_hashes']), bits=arrays['bits'])
@@ -1,7 +1,123 @@
 import os
 
 import boto3
+from botocore.config import Config as BotoConfig
 from config.config import settings
+from helpers.rate_governor import GovernedClient, RateGovernor
+
+
+_fake_backend = None
+_rate_governor = None
+
+
+def use_fake_backend(backend=None):
+    """
+    Hand out the clients of an in-memory fake backend instead of AWS clients, see helpers.fake_aws
+
+    :param backend: FakeAWSBackend, the backend. Default: None, a backend with the default durations
+    :return: FakeAWSBackend, the backend, to inspect its resources and call counts
+    """
+    global _fake_backend
+    if backend is None:
+        from helpers.fake_aws import FakeAWSBackend
+        backend = FakeAWSBackend()
+    _fake_backend = backend
+    return backend
+
+
+def use_aws_backend():
+    """
+    Hand out AWS clients again
+    """
+    global _fake_backend
+    _fake_backend = None
+
+
+def get_fake_backend():
+    """
+    :return: FakeAWSBackend | None, the fake backend in use, created on first use when AWS_BACKEND=fake
+    """
+    if _fake_backend is None and settings.AWS_BACKEND == 'fake':
+        use_fake_backend()
+    return _fake_backend
+
+
+def use_rate_governor(governor=None):
+    """
+    Send the Personalize and S3 control-plane calls of every client created from now on through one governor
+
+    :param governor: RateGovernor, the governor. Default: None, a governor with the rates of the settings
+    :return: RateGovernor, the governor, to inspect its throttle counts and waits
+    """
+    global _rate_governor
+    if governor is None:
+        governor = RateGovernor(
+            rates={'personalize': settings.PERSONALIZE_CONTROL_TPS, 's3': settings.S3_CONTROL_TPS},
+            max_attempts=settings.CONTROL_MAX_ATTEMPTS
+        )
+    _rate_governor = governor
+    return governor
+
+
+def restore_rate_governor(governor):
+    """
+    Put back the governor in use before `use_rate_governor`, e.g. at the end of a benchmark
+
+    :param governor: RateGovernor | None, the previous governor, see `get_rate_governor`
+    :return: None
+    """
+    global _rate_governor
+    _rate_governor = governor
+
+
+def get_rate_governor():
+    """
+    :return: RateGovernor | None, the governor in use, created on first use unless RATE_GOVERNOR=off
+    """
+    if _rate_governor is None and settings.RATE_GOVERNOR:
+        use_rate_governor()
+    return _rate_governor
+
+
+def governed_client(client, service, retrying_client=None):
+    """
+    Wrap a control-plane client with the process-wide rate governor
+
+    :param client: object, the boto3 client
+    :param service: str, the service name of the rate limit
+    :param retrying_client: callable, creates a client with its own retries for the managed transfers,
+                            paginators and waiters, see GovernedClient. Default: None
+    :return: object, the governed client, the client itself when the governor is off
+    """
+    governor = get_rate_governor()
+    if governor is None:
+        return client
+    return GovernedClient(client, service, governor, retrying_client=retrying_client)
+
+
+def control_plane_attempts():
+    """
+    :return: int | None, a single attempt per call under the governor, which retries the throttles, the transient
+             and the connection errors and counts them. None for the client's own retries
+    """
+    return None if get_rate_governor() is None else 1
+
+
+def control_plane_config():
+    """
+    :return: BotoConfig | None, the botocore config of the control-plane clients
+    """
+    max_attempts = control_plane_attempts()
+    if max_attempts is None:
+        return None
+    return BotoConfig(retries={'mode': 'standard', 'total_max_attempts': max_attempts})
+
+
+def retrying_config():
+    """
+    :return: BotoConfig, the botocore config of the clients retrying on their own, see `governed_client`
+    """
+    return BotoConfig(retries={'mode': 'standard'})
 
 
 def create_session(profile_name=None):
@@ -20,9 +136,15 @@ def connect_to_s3_client(profile_name=None):
     :param profile_name: profile name in ~/.aws/credentials
     :return: object, S3 connection
     """
+    if get_fake_backend() is not None:
+        backend = get_fake_backend()
+        return governed_client(backend.client('s3', control_plane_attempts()), 's3',
+                               retrying_client=lambda: backend.client('s3'))
+
     session = create_session(profile_name=profile_name)
-    s3_client = session.client("s3")
-    return s3_client
+    s3_client = session.client("s3", config=control_plane_config())
+    # The managed transfers, paginators and waiters keep botocore's retries, see GovernedClient
+    return governed_client(s3_client, 's3', retrying_client=lambda: session.client("s3", config=retrying_config()))
 
 
 def connect_to_s3_resource(profile_name=None):
@@ -87,6 +209,9 @@ def connect_to_iam_resource(profile_name=None):
     :return: object, iam connection
     """
 
+    if get_fake_backend() is not None:
+        return get_fake_backend().resource('iam')
+
     session = create_session(profile_name=profile_name)
     iam_client = session.resource("iam")
 
@@ -100,20 +225,62 @@ def connect_to_personalize(profile_name=None):
     :return: object, personalize connection
     """
 
+    if get_fake_backend() is not None:
+        backend = get_fake_backend()
+        return governed_client(backend.client('personalize', control_plane_attempts()), 'personalize',
+                               retrying_client=lambda: backend.client('personalize'))
+
     session = create_session(profile_name=profile_name)
-    personalize = session.client("personalize")
+    personalize = session.client("personalize", config=control_plane_config())
 
-    return personalize
+    # The paginators and waiters keep botocore's retries, see GovernedClient
+    return governed_client(personalize, 'personalize',
+                           retrying_client=lambda: session.client("personalize", config=retrying_config()))
 
 
-def connect_to_personalize_runtime(profile_name=None):
+def connect_to_personalize_runtime(profile_name=None, max_pool_connections=None, connect_timeout=None,
+                                   read_timeout=None, max_attempts=None):
     """
     Connect to personalize runtime
     :param profile_name: profile name in ~/.aws/credentials
+    :param max_pool_connections: int, the size of the HTTP connection pool, default None (botocore's 10)
+    :param connect_timeout: float, the connect timeout in seconds, default None (botocore's 60)
+    :param read_timeout: float, the read timeout in seconds, default None (botocore's 60)
+    :param max_attempts: int, the number of attempts per call including retries, default None (botocore's)
     :return: object, personalize runtime connection
     """
 
+    if get_fake_backend() is not None:
+        return get_fake_backend().client('personalize-runtime', max_attempts=max_attempts)
+
     session = create_session(profile_name=profile_name)
-    personalize_runtime = session.client("personalize-runtime")
+    config_params = {
+        'max_pool_connections': max_pool_connections,
+        'connect_timeout': connect_timeout,
+        'read_timeout': read_timeout,
+        'retries': {'max_attempts': max_attempts} if max_attempts is not None else None,
+    }
+    config_params = {key: value for key, value in config_params.items() if value is not None}
+    config = BotoConfig(**config_params) if config_params else None
+    personalize_runtime = session.client("personalize-runtime", config=config)
 
     return personalize_runtime
+
+
+def connect_to_personalize_events(profile_name=None, endpoint_url=None, max_pool_connections=None):
+    """
+    Connect to personalize events, the PutEvents API of event trackers
+    :param profile_name: profile name in ~/.aws/credentials
+    :param endpoint_url: str, a custom endpoint, e.g. a local stub for tests, default None (the AWS endpoint)
+    :param max_pool_connections: int, the size of the HTTP connection pool, default None (botocore's 10)
+    :return: object, personalize events connection
+    """
+
+    if get_fake_backend() is not None:
+        return get_fake_backend().client('personalize-events')
+
+    session = create_session(profile_name=profile_name)
+    config = BotoConfig(max_pool_connections=max_pool_connections) if max_pool_connections is not None else None
+    personalize_events = session.client("personalize-events", endpoint_url=endpoint_url, config=config)
+
+    return personalize_events
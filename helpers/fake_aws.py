@@ -0,0 +1,652 @@
+import csv
+import functools
+import hashlib
+import io
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+
+from config.log_config import logger
+
+ACCOUNT_ID = '123456789012'
+# Seconds from CREATE PENDING to ACTIVE per resource type, Personalize takes minutes to hours
+DEFAULT_DURATIONS = {
+    'datasetGroup': 0.2,
+    'schema': 0.0,
+    'dataset': 0.1,
+    'datasetImportJob': 0.5,
+    'solution': 0.1,
+    'solutionVersion': 1.0,
+    'campaign': 0.5,
+    'campaignUpdate': 0.5,
+    'eventTracker': 0.1,
+    'delete': 0.2,
+}
+RECIPES = [
+    'arn:aws:personalize:::recipe/aws-user-personalization',
+    'arn:aws:personalize:::recipe/aws-user-personalization-v2',
+    'arn:aws:personalize:::recipe/aws-similar-items',
+    'arn:aws:personalize:::recipe/aws-popularity-count',
+]
+
+
+def client_error(code, message, operation_name, status_code=400):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': status_code}},
+        operation_name
+    )
+
+
+def operation(func):
+    """
+    Run a client method as an API call of the backend: latency, throttling and botocore-like retries
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return self.backend.invoke(self.service_name, func.__name__, lambda: func(self, *args, **kwargs),
+                                   self.max_attempts)
+    return wrapper
+
+
+class FakeAWSBackend:
+    """
+    In-memory stand-in for the personalize, personalize-runtime, personalize-events, S3 and IAM services,
+    to run and time the orchestration of TrainPipeline and Inference without an AWS account.
+
+    Resources go through CREATE PENDING -> CREATE IN_PROGRESS -> ACTIVE | CREATE FAILED in `durations`
+    seconds, evaluated when they are described, so there is no background thread. A resource fails with its
+    `failure_rates` probability, an import job also fails when its S3 object doesn't exist, and creating a
+    resource on a parent that isn't ACTIVE yet raises ResourceInUseException as on AWS.
+
+    Every call waits `latencies[service]` seconds and is throttled with the `throttle_rates[service]`
+    probability. Throttled calls are retried `max_attempts` times with exponential backoff like botocore's
+    default retry mode, then a ThrottlingException is raised.
+
+    Usage:
+        from helpers.connection import use_fake_backend
+        backend = use_fake_backend(FakeAWSBackend(durations={'solutionVersion': 3}, throttle_rates={'s3': 0.1}))
+    or AWS_BACKEND=fake in the environment for the default backend.
+    """
+
+    def __init__(self, durations=None, failure_rates=None, throttle_rates=None, latencies=None,
+                 runtime_latency=0.02, runtime_jitter=0.005, max_attempts=5, retry_backoff=0.01,
+                 region_name='us-east-1', seed=None):
+        """
+        :param durations: dict, resource type -> seconds to ACTIVE, merged into DEFAULT_DURATIONS
+        :param failure_rates: dict, resource type -> probability of CREATE FAILED. Default: None, no failure
+        :param throttle_rates: dict | float, service name -> probability of a ThrottlingException per attempt,
+                               a float applies to every service. Default: None, no throttling
+        :param latencies: dict | float, service name -> seconds per control plane call. Default: None, no latency
+        :param runtime_latency: float, the mean GetRecommendations latency in seconds
+        :param runtime_jitter: float, the standard deviation of the GetRecommendations latency
+        :param max_attempts: int, the attempts per call including retries, botocore's legacy mode makes 5
+        :param retry_backoff: float, the first retry delay in seconds, doubled on every retry
+        :param region_name: str, the region of the ARNs
+        :param seed: int, the seed of the failures, throttling and latencies. Default: None, random
+        """
+        self.durations = {**DEFAULT_DURATIONS, **(durations or {})}
+        self.failure_rates = failure_rates or {}
+        self.throttle_rates = throttle_rates or {}
+        self.latencies = latencies or {}
+        self.runtime_latency = runtime_latency
+        self.runtime_jitter = runtime_jitter
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.region_name = region_name
+        self.random = random.Random(seed)
+
+        self.lock = threading.RLock()
+        self.resources = {}
+        self.tags = {}
+        self.buckets = {}
+        self.roles = {}
+        self.items = {}
+        self.events = []
+        self.calls = Counter()
+        self.throttles = Counter()
+        self.retry_wait = 0.0
+
+    def client(self, service_name, max_attempts=None):
+        """
+        :param service_name: str, 'personalize'|'personalize-runtime'|'personalize-events'|'s3'
+        :param max_attempts: int, the attempts per call including retries. Default: None, the backend's
+        :return: object, a client with the boto3 methods used by the repository
+        """
+        clients = {
+            'personalize': FakePersonalizeClient,
+            'personalize-runtime': FakePersonalizeRuntimeClient,
+            'personalize-events': FakePersonalizeEventsClient,
+            's3': FakeS3Client,
+        }
+        if service_name not in clients:
+            raise ValueError(f"The fake backend has no {service_name} client")
+        return clients[service_name](self, max_attempts)
+
+    def resource(self, service_name):
+        """
+        :param service_name: str, 'iam'
+        :return: object, a resource with the boto3 methods used by the repository
+        """
+        if service_name != 'iam':
+            raise ValueError(f"The fake backend has no {service_name} resource")
+        return FakeIAMResource(self)
+
+    @staticmethod
+    def _rate(rates, service_name):
+        return rates if isinstance(rates, (int, float)) else rates.get(service_name, 0.0)
+
+    def invoke(self, service_name, operation_name, call, max_attempts=None):
+        """
+        Run one API call with the latency and throttling of its service
+        """
+        max_attempts = max_attempts or self.max_attempts
+        latency = self._rate(self.latencies, service_name)
+        throttle_rate = self._rate(self.throttle_rates, service_name)
+        for attempt in range(max_attempts):
+            with self.lock:
+                self.calls[f'{service_name}.{operation_name}'] += 1
+                throttled = self.random.random() < throttle_rate
+            if latency:
+                time.sleep(latency)
+            if not throttled:
+                return call()
+
+            with self.lock:
+                self.throttles[f'{service_name}.{operation_name}'] += 1
+            if attempt < max_attempts - 1:
+                delay = self.random.uniform(0, self.retry_backoff * 2 ** attempt)
+                with self.lock:
+                    self.retry_wait += delay
+                time.sleep(delay)
+        raise client_error('ThrottlingException', 'Rate exceeded', operation_name)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'throttles': dict(self.throttles),
+                'retry_wait_seconds': self.retry_wait,
+                'resources': Counter(record['_type'] for record in self.resources.values()),
+                'events': len(self.events),
+            }
+
+    def arn(self, service_name, resource_path):
+        return f'arn:aws:{service_name}:{self.region_name}:{ACCOUNT_ID}:{resource_path}'
+
+    def add_resource(self, resource_type, arn, final_status=None, **fields):
+        """
+        Register a resource in CREATE PENDING
+
+        :param resource_type: str, a DEFAULT_DURATIONS key
+        :param arn: str, the resource ARN
+        :param final_status: str, forces the final status. Default: None, ACTIVE or CREATE FAILED by failure rate
+        :param fields: the fields returned by describe and list calls
+        :return: dict, the resource record
+        """
+        with self.lock:
+            if final_status is None:
+                failed = self.random.random() < self.failure_rates.get(resource_type, 0.0)
+                final_status = 'CREATE FAILED' if failed else 'ACTIVE'
+            now = datetime.now(timezone.utc)
+            record = {
+                **fields,
+                'creationDateTime': now,
+                'lastUpdatedDateTime': now,
+                '_type': resource_type,
+                '_started': time.monotonic(),
+                '_duration': self.durations.get(resource_type, 0.0),
+                '_final': final_status,
+            }
+            if final_status == 'CREATE FAILED':
+                record.setdefault('failureReason', 'Injected failure')
+            self.resources[arn] = record
+            return record
+
+    def status(self, record):
+        """
+        The status of a resource at this time, applies completed campaign updates and deletions
+        """
+        now = time.monotonic()
+        update = record.get('_update')
+        if update is not None and now - update['_started'] >= update['_duration']:
+            record.update({key: value for key, value in update.items() if not key.startswith('_')})
+            record['latestCampaignUpdate']['status'] = 'ACTIVE'
+            record['lastUpdatedDateTime'] = datetime.now(timezone.utc)
+            del record['_update']
+
+        elapsed = now - record['_started']
+        if record.get('_deleting'):
+            return 'DELETE PENDING' if elapsed < record['_duration'] else 'DELETED'
+        if elapsed >= record['_duration']:
+            return record['_final']
+        return 'CREATE PENDING' if elapsed < 0.2 * record['_duration'] else 'CREATE IN_PROGRESS'
+
+    def get(self, arn, resource_type, operation_name):
+        """
+        :return: dict, the resource record, raises ResourceNotFoundException when it doesn't exist
+        """
+        with self.lock:
+            record = self.resources.get(arn)
+            if record is None or record['_type'] != resource_type or self.status(record) == 'DELETED':
+                raise client_error('ResourceNotFoundException', f'{arn} not found', operation_name)
+            return record
+
+    def require_active(self, arn, resource_type, operation_name):
+        record = self.get(arn, resource_type, operation_name)
+        status = self.status(record)
+        if status != 'ACTIVE':
+            raise client_error('ResourceInUseException', f'{arn} is {status}', operation_name)
+        return record
+
+    def describe(self, record):
+        """
+        :return: dict, the public fields of a resource with its current status
+        """
+        with self.lock:
+            status = self.status(record)
+            description = {key: value for key, value in record.items() if not key.startswith('_')}
+            description['status'] = status
+            if 'latestCampaignUpdate' in record:
+                description['latestCampaignUpdate'] = dict(record['latestCampaignUpdate'])
+            return description
+
+    def find(self, resource_type, **fields):
+        """
+        :return: list, the descriptions of the resources of a type with the given field values,
+                 a resource being deleted is left out and its name can be reused at once
+        """
+        with self.lock:
+            return [
+                self.describe(record) for record in self.resources.values()
+                if record['_type'] == resource_type and not record.get('_deleting')
+                and all(record.get(key) == value for key, value in fields.items())
+            ]
+
+
+class _FakeClient:
+    service_name = None
+
+    def __init__(self, backend, max_attempts=None):
+        self.backend = backend
+        self.max_attempts = max_attempts
+        self.meta = SimpleNamespace(region_name=backend.region_name, endpoint_url=None,
+                                    service_model=SimpleNamespace(service_name=self.service_name))
+
+
+class FakePersonalizeClient(_FakeClient):
+    service_name = 'personalize'
+
+    def _create(self, resource_type, arn_path, name, operation_name, unique_scope=None, **fields):
+        with self.backend.lock:
+            if self.backend.find(resource_type, name=name, **(unique_scope or {})):
+                raise client_error('ResourceAlreadyExistsException', f'{name} already exists', operation_name)
+            arn = self.backend.arn('personalize', arn_path)
+            self.backend.add_resource(resource_type, arn, name=name, **{f'{resource_type}Arn': arn}, **fields)
+            return arn
+
+    # Dataset groups, schemas and datasets
+    @operation
+    def list_dataset_groups(self, **kwargs):
+        groups = self.backend.find('datasetGroup')
+        return {'datasetGroups': [{k: group[k] for k in ('name', 'datasetGroupArn', 'status')} for group in groups]}
+
+    @operation
+    def create_dataset_group(self, name, **kwargs):
+        arn = self._create('datasetGroup', f'dataset-group/{name}', name, 'CreateDatasetGroup')
+        return {'datasetGroupArn': arn}
+
+    @operation
+    def describe_dataset_group(self, datasetGroupArn):
+        record = self.backend.get(datasetGroupArn, 'datasetGroup', 'DescribeDatasetGroup')
+        return {'datasetGroup': self.backend.describe(record)}
+
+    @operation
+    def create_schema(self, name, schema, **kwargs):
+        arn = self._create('schema', f'schema/{name}', name, 'CreateSchema', schema=schema)
+        return {'schemaArn': arn}
+
+    @operation
+    def list_datasets(self, datasetGroupArn=None, **kwargs):
+        scope = {'datasetGroupArn': datasetGroupArn} if datasetGroupArn else {}
+        return {'datasets': [{k: dataset[k] for k in ('name', 'datasetArn', 'datasetType', 'status')}
+                             for dataset in self.backend.find('dataset', **scope)]}
+
+    @operation
+    def create_dataset(self, datasetType, datasetGroupArn, schemaArn, name, **kwargs):
+        self.backend.require_active(datasetGroupArn, 'datasetGroup', 'CreateDataset')
+        group_name = datasetGroupArn.rsplit('/', 1)[1]
+        arn = self._create('dataset', f'dataset/{group_name}/{datasetType}', name, 'CreateDataset',
+                           unique_scope={'datasetGroupArn': datasetGroupArn}, datasetType=datasetType,
+                           datasetGroupArn=datasetGroupArn, schemaArn=schemaArn)
+        return {'datasetArn': arn}
+
+    @operation
+    def describe_dataset(self, datasetArn):
+        return {'dataset': self.backend.describe(self.backend.get(datasetArn, 'dataset', 'DescribeDataset'))}
+
+    # Imports
+    @operation
+    def create_dataset_import_job(self, jobName, datasetArn, dataSource, roleArn=None, importMode='FULL',
+                                  **kwargs):
+        dataset = self.backend.require_active(datasetArn, 'dataset', 'CreateDatasetImportJob')
+        data_location = dataSource['dataLocation']
+        bucket_name, _, key = data_location.replace('s3://', '', 1).partition('/')
+        body = self.backend.buckets.get(bucket_name, {}).get(key)
+
+        final_status = 'CREATE FAILED' if body is None else None
+        arn = self.backend.arn('personalize', f'dataset-import-job/{jobName}')
+        record = self.backend.add_resource(
+            'datasetImportJob', arn, final_status=final_status, jobName=jobName, datasetImportJobArn=arn,
+            datasetArn=datasetArn, dataSource=dataSource, roleArn=roleArn, importMode=importMode
+        )
+        if body is None:
+            record['failureReason'] = f'Input file {data_location} not found'
+        elif dataset['datasetType'] == 'ITEMS':
+            # The runtime recommends the imported items
+            rows = csv.DictReader(io.StringIO(body.decode('utf-8')))
+            items = {row['ITEM_ID']: row.get('ITEM_NAME') for row in rows}
+            with self.backend.lock:
+                dataset_items = {} if importMode == 'FULL' else self.backend.items.get(dataset['datasetGroupArn'], {})
+                self.backend.items[dataset['datasetGroupArn']] = {**dataset_items, **items}
+        return {'datasetImportJobArn': arn}
+
+    @operation
+    def describe_dataset_import_job(self, datasetImportJobArn):
+        record = self.backend.get(datasetImportJobArn, 'datasetImportJob', 'DescribeDatasetImportJob')
+        return {'datasetImportJob': self.backend.describe(record)}
+
+    # Solutions
+    @operation
+    def list_recipes(self, **kwargs):
+        return {'recipes': [{'name': arn.rsplit('/', 1)[1], 'recipeArn': arn, 'status': 'ACTIVE'}
+                            for arn in RECIPES]}
+
+    @operation
+    def list_solutions(self, datasetGroupArn=None, **kwargs):
+        scope = {'datasetGroupArn': datasetGroupArn} if datasetGroupArn else {}
+        return {'solutions': [{k: solution[k] for k in ('name', 'solutionArn', 'status')}
+                              for solution in self.backend.find('solution', **scope)]}
+
+    @operation
+    def create_solution(self, name, datasetGroupArn, recipeArn=None, performHPO=False, performAutoML=False,
+                        solutionConfig=None, **kwargs):
+        self.backend.require_active(datasetGroupArn, 'datasetGroup', 'CreateSolution')
+        arn = self._create('solution', f'solution/{name}', name, 'CreateSolution', datasetGroupArn=datasetGroupArn,
+                           recipeArn=recipeArn, performHPO=performHPO, performAutoML=performAutoML,
+                           solutionConfig=solutionConfig or {})
+        return {'solutionArn': arn}
+
+    @operation
+    def describe_solution(self, solutionArn):
+        return {'solution': self.backend.describe(self.backend.get(solutionArn, 'solution', 'DescribeSolution'))}
+
+    @operation
+    def delete_solution(self, solutionArn):
+        with self.backend.lock:
+            record = self.backend.get(solutionArn, 'solution', 'DeleteSolution')
+            record.update(_deleting=True, _started=time.monotonic(), _duration=self.backend.durations['delete'])
+        return {}
+
+    @operation
+    def create_solution_version(self, solutionArn, tags=None, trainingMode='FULL', **kwargs):
+        solution = self.backend.require_active(solutionArn, 'solution', 'CreateSolutionVersion')
+        if not self.backend.items.get(solution['datasetGroupArn']):
+            raise client_error('InvalidInputException', 'The dataset group has no imported data',
+                               'CreateSolutionVersion')
+        arn = f'{solutionArn}/{uuid.uuid4().hex[:8]}'
+        self.backend.add_resource('solutionVersion', arn, solutionVersionArn=arn, solutionArn=solutionArn,
+                                  trainingMode=trainingMode, recipeArn=solution['recipeArn'])
+        self.backend.tags[arn] = list(tags or [])
+        return {'solutionVersionArn': arn}
+
+    @operation
+    def describe_solution_version(self, solutionVersionArn):
+        record = self.backend.get(solutionVersionArn, 'solutionVersion', 'DescribeSolutionVersion')
+        return {'solutionVersion': self.backend.describe(record)}
+
+    @operation
+    def list_solution_versions(self, solutionArn=None, **kwargs):
+        scope = {'solutionArn': solutionArn} if solutionArn else {}
+        return {'solutionVersions': [
+            {k: version[k] for k in ('solutionVersionArn', 'status', 'creationDateTime', 'lastUpdatedDateTime')}
+            for version in self.backend.find('solutionVersion', **scope)
+        ]}
+
+    @operation
+    def list_tags_for_resource(self, resourceArn):
+        return {'tags': list(self.backend.tags.get(resourceArn, []))}
+
+    @operation
+    def get_solution_metrics(self, solutionVersionArn):
+        self.backend.require_active(solutionVersionArn, 'solutionVersion', 'GetSolutionMetrics')
+        # Stable per solution version, so the best of several trainings is reproducible
+        seed = int(hashlib.sha256(solutionVersionArn.encode('utf-8')).hexdigest()[:8], 16)
+        rng = random.Random(seed)
+        ndcg_10 = rng.uniform(0.15, 0.45)
+        return {'solutionVersionArn': solutionVersionArn, 'metrics': {
+            'coverage': rng.uniform(0.3, 0.9),
+            'mean_reciprocal_rank_at_25': ndcg_10 * rng.uniform(0.8, 1.0),
+            'normalized_discounted_cumulative_gain_at_5': ndcg_10 * rng.uniform(0.85, 0.95),
+            'normalized_discounted_cumulative_gain_at_10': ndcg_10,
+            'normalized_discounted_cumulative_gain_at_25': ndcg_10 * rng.uniform(1.05, 1.2),
+            'precision_at_5': ndcg_10 * rng.uniform(0.3, 0.5),
+            'precision_at_10': ndcg_10 * rng.uniform(0.2, 0.3),
+            'precision_at_25': ndcg_10 * rng.uniform(0.1, 0.2),
+        }}
+
+    # Campaigns
+    @operation
+    def list_campaigns(self, solutionArn=None, **kwargs):
+        scope = {'solutionArn': solutionArn} if solutionArn else {}
+        return {'campaigns': [{k: campaign[k] for k in ('name', 'campaignArn', 'status')}
+                              for campaign in self.backend.find('campaign', **scope)]}
+
+    @operation
+    def create_campaign(self, name, solutionVersionArn, minProvisionedTPS=1, campaignConfig=None, **kwargs):
+        version = self.backend.require_active(solutionVersionArn, 'solutionVersion', 'CreateCampaign')
+        arn = self._create('campaign', f'campaign/{name}', name, 'CreateCampaign',
+                           solutionVersionArn=solutionVersionArn, solutionArn=version['solutionArn'],
+                           minProvisionedTPS=minProvisionedTPS, campaignConfig=campaignConfig or {})
+        return {'campaignArn': arn}
+
+    @operation
+    def update_campaign(self, campaignArn, solutionVersionArn=None, minProvisionedTPS=None, campaignConfig=None,
+                        **kwargs):
+        with self.backend.lock:
+            campaign = self.backend.require_active(campaignArn, 'campaign', 'UpdateCampaign')
+            if '_update' in campaign:
+                raise client_error('ResourceInUseException', f'{campaignArn} is being updated', 'UpdateCampaign')
+            if solutionVersionArn is not None:
+                self.backend.require_active(solutionVersionArn, 'solutionVersion', 'UpdateCampaign')
+            changes = {
+                'solutionVersionArn': solutionVersionArn,
+                'minProvisionedTPS': minProvisionedTPS,
+                'campaignConfig': campaignConfig,
+            }
+            changes = {key: value for key, value in changes.items() if value is not None}
+            campaign['_update'] = {**changes, '_started': time.monotonic(),
+                                   '_duration': self.backend.durations['campaignUpdate']}
+            campaign['latestCampaignUpdate'] = {**changes, 'status': 'CREATE PENDING',
+                                                'creationDateTime': datetime.now(timezone.utc)}
+        return {'campaignArn': campaignArn}
+
+    @operation
+    def describe_campaign(self, campaignArn):
+        return {'campaign': self.backend.describe(self.backend.get(campaignArn, 'campaign', 'DescribeCampaign'))}
+
+    # Event trackers
+    @operation
+    def list_event_trackers(self, datasetGroupArn=None, **kwargs):
+        scope = {'datasetGroupArn': datasetGroupArn} if datasetGroupArn else {}
+        return {'eventTrackers': [{k: tracker[k] for k in ('name', 'eventTrackerArn', 'status')}
+                                  for tracker in self.backend.find('eventTracker', **scope)]}
+
+    @operation
+    def create_event_tracker(self, name, datasetGroupArn, **kwargs):
+        self.backend.require_active(datasetGroupArn, 'datasetGroup', 'CreateEventTracker')
+        if self.backend.find('eventTracker', datasetGroupArn=datasetGroupArn):
+            raise client_error('LimitExceededException', 'A dataset group has one event tracker',
+                               'CreateEventTracker')
+        tracking_id = str(uuid.uuid4())
+        arn = self._create('eventTracker', f'event-tracker/{tracking_id[:8]}', name, 'CreateEventTracker',
+                           datasetGroupArn=datasetGroupArn, trackingId=tracking_id)
+        return {'eventTrackerArn': arn, 'trackingId': tracking_id}
+
+    @operation
+    def describe_event_tracker(self, eventTrackerArn):
+        record = self.backend.get(eventTrackerArn, 'eventTracker', 'DescribeEventTracker')
+        return {'eventTracker': self.backend.describe(record)}
+
+
+class FakePersonalizeRuntimeClient(_FakeClient):
+    service_name = 'personalize-runtime'
+
+    @operation
+    def get_recommendations(self, campaignArn=None, userId=None, numResults=25, context=None,
+                            metadataColumns=None, **kwargs):
+        backend = self.backend
+        with backend.lock:
+            campaign = backend.require_active(campaignArn, 'campaign', 'GetRecommendations')
+            solution = backend.resources[campaign['solutionArn']]
+            items = backend.items.get(solution['datasetGroupArn'], {})
+            solution_version_arn = campaign['solutionVersionArn']
+            return_metadata = campaign['campaignConfig'].get('enableMetadataWithRecommendations', False)
+            latency = max(0.0, backend.random.gauss(backend.runtime_latency, backend.runtime_jitter))
+        time.sleep(latency)
+
+        # Stable per solution version, user and context, a new version changes the ranking
+        rng = random.Random(f'{solution_version_arn}|{userId}|{sorted((context or {}).items())}')
+        item_ids = rng.sample(sorted(items), min(numResults, len(items)))
+        item_list = []
+        for rank, item_id in enumerate(item_ids):
+            item = {'itemId': item_id, 'score': round(1.0 / (rank + 2), 6)}
+            if metadataColumns and return_metadata:
+                item['metadata'] = {'item_name': items[item_id]}
+            item_list.append(item)
+        return {'itemList': item_list, 'recommendationId': f'RID-{uuid.uuid4()}'}
+
+
+class FakePersonalizeEventsClient(_FakeClient):
+    service_name = 'personalize-events'
+
+    @operation
+    def put_events(self, trackingId, sessionId, eventList, userId=None, **kwargs):
+        if not self.backend.find('eventTracker', trackingId=trackingId):
+            raise client_error('ResourceNotFoundException', f'Tracking ID {trackingId} not found', 'PutEvents')
+        if not 1 <= len(eventList) <= 10:
+            raise client_error('InvalidInputException', 'eventList has 1 to 10 events', 'PutEvents')
+        with self.backend.lock:
+            self.backend.events.extend((trackingId, userId, sessionId, event) for event in eventList)
+        return {}
+
+
+class FakeS3Client(_FakeClient):
+    service_name = 's3'
+
+    def _bucket(self, bucket_name, operation_name):
+        bucket = self.backend.buckets.get(bucket_name)
+        if bucket is None:
+            raise client_error('NoSuchBucket', f'The bucket {bucket_name} does not exist', operation_name, 404)
+        return bucket
+
+    @operation
+    def list_buckets(self):
+        return {'Buckets': [{'Name': name} for name in sorted(self.backend.buckets)]}
+
+    @operation
+    def create_bucket(self, Bucket, **kwargs):
+        with self.backend.lock:
+            if Bucket in self.backend.buckets:
+                raise client_error('BucketAlreadyOwnedByYou', f'{Bucket} already exists', 'CreateBucket', 409)
+            self.backend.buckets[Bucket] = {}
+        return {'Location': f'/{Bucket}'}
+
+    @operation
+    def put_bucket_policy(self, Bucket, Policy, **kwargs):
+        # TrainPipeline may create the bucket after Personalization sets the policy, keep both orders working
+        with self.backend.lock:
+            self.backend.buckets.setdefault(Bucket, {})
+        return {}
+
+    @operation
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as f:
+            body = f.read()
+        with self.backend.lock:
+            self._bucket(Bucket, 'PutObject')[Key] = body
+
+    @operation
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        body = Body.encode('utf-8') if isinstance(Body, str) else Body if isinstance(Body, bytes) else Body.read()
+        with self.backend.lock:
+            self._bucket(Bucket, 'PutObject')[Key] = body
+        return {'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    @operation
+    def get_object(self, Bucket, Key, **kwargs):
+        body = self._bucket(Bucket, 'GetObject').get(Key)
+        if body is None:
+            raise client_error('NoSuchKey', 'The specified key does not exist.', 'GetObject', 404)
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    @operation
+    def head_object(self, Bucket, Key, **kwargs):
+        body = self._bucket(Bucket, 'HeadObject').get(Key)
+        if body is None:
+            raise client_error('404', 'Not Found', 'HeadObject', 404)
+        return {'ContentLength': len(body)}
+
+    @operation
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        keys = sorted(key for key in self._bucket(Bucket, 'ListObjectsV2') if key.startswith(Prefix))
+        contents = [{'Key': key, 'Size': len(self.backend.buckets[Bucket][key])} for key in keys]
+        return {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': False}
+
+
+class FakeIAMRole:
+    service_name = 'iam'
+
+    def __init__(self, backend, name, max_attempts=None):
+        self.backend = backend
+        self.name = name
+        self.max_attempts = max_attempts
+
+    @property
+    def arn(self):
+        return f'arn:aws:iam::{ACCOUNT_ID}:role/{self.name}'
+
+    @operation
+    def load(self):
+        if self.name not in self.backend.roles:
+            raise client_error('NoSuchEntity', f'The role with name {self.name} cannot be found.', 'GetRole', 404)
+
+    @operation
+    def attach_policy(self, PolicyArn):
+        with self.backend.lock:
+            self.backend.roles[self.name]['policies'].append(PolicyArn)
+
+
+class FakeIAMResource:
+    service_name = 'iam'
+
+    def __init__(self, backend, max_attempts=None):
+        self.backend = backend
+        self.max_attempts = max_attempts
+
+    def Role(self, name):
+        return FakeIAMRole(self.backend, name)
+
+    @operation
+    def create_role(self, RoleName, AssumeRolePolicyDocument, **kwargs):
+        with self.backend.lock:
+            if RoleName in self.backend.roles:
+                raise client_error('EntityAlreadyExists', f'Role {RoleName} already exists', 'CreateRole', 409)
+            self.backend.roles[RoleName] = {'assume_role_policy': AssumeRolePolicyDocument, 'policies': []}
+        logger.info(f"Fake IAM role {RoleName} created")
+        return FakeIAMRole(self.backend, RoleName)
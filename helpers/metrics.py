@@ -0,0 +1,181 @@
+import bisect
+import csv
+import os
+import threading
+import time
+
+from config.log_config import logger
+
+
+class LatencyHistogram:
+    """
+    Thread-safe latency histogram with log-spaced buckets, from 0.1 ms to ~100 s.
+    Percentiles are read from the bucket upper bounds, so they are accurate to the bucket width (~12%).
+    """
+
+    def __init__(self, min_seconds=1e-4, max_seconds=100.0, growth=1.12):
+        bounds = [min_seconds]
+        while bounds[-1] < max_seconds:
+            bounds.append(bounds[-1] * growth)
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """
+        Record one latency
+
+        :param seconds: float, the latency in seconds
+        :return: None
+        """
+        index = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """
+        Get a latency percentile
+
+        :param q: float, the percentile in [0, 100]
+        :return: float, the latency in seconds, 0.0 when nothing was recorded
+        """
+        with self._lock:
+            counts, count, max_seconds = list(self.counts), self.count, self.max
+
+        if count == 0:
+            return 0.0
+
+        rank = q / 100.0 * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            cumulative += bucket_count
+            if cumulative >= rank and bucket_count:
+                return min(self.bounds[index], max_seconds) if index < len(self.bounds) else max_seconds
+        return max_seconds
+
+    def snapshot(self):
+        """
+        Get the summary of the histogram
+
+        :return: dict, count, mean, p50, p95, p99 and max in milliseconds
+        """
+        with self._lock:
+            count, total, max_seconds = self.count, self.total, self.max
+
+        return {
+            'count': count,
+            'mean_ms': total / count * 1000 if count else 0.0,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': max_seconds * 1000,
+        }
+
+
+class Gauge:
+    """
+    Thread-safe gauge, e.g. the number of in-flight requests, that also keeps its peak value
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+            self.peak = max(self.peak, self.value)
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def snapshot(self):
+        return {'value': self.value, 'peak': self.peak}
+
+
+class RequestRateRecorder:
+    """
+    Per-key request counts in fixed time buckets, e.g. requests per second per campaign.
+    Completed buckets are appended to a CSV file by `export` and dropped from memory,
+    so the memory only holds the buckets since the last export, at most `max_buckets` per key
+    when nothing exports them.
+    """
+
+    def __init__(self, bucket_seconds=1, max_buckets=3600):
+        """
+        :param bucket_seconds: int, the bucket width in seconds
+        :param max_buckets: int, the buckets kept per key, the oldest are dropped first. Default: one hour
+                            of 1 second buckets
+        """
+        self.bucket_seconds = bucket_seconds
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def observe(self, key, now=None):
+        """
+        Count one request
+
+        :param key: str, the series key, e.g. the campaign ARN
+        :param now: float, the unix time of the request. Default: None, the current time
+        :return: None
+        """
+        bucket = int((now if now is not None else time.time()) // self.bucket_seconds) * self.bucket_seconds
+        with self._lock:
+            series = self.buckets.setdefault(key, {})
+            series[bucket] = series.get(bucket, 0) + 1
+            if len(series) > self.max_buckets:
+                # The buckets are inserted in time order, the first one is the oldest
+                if not self.dropped:
+                    logger.warning(f"Request rates are not exported, keeping the last {self.max_buckets} buckets")
+                self.dropped += series.pop(next(iter(series)))
+
+    def drain(self, now=None):
+        """
+        Remove and return the completed buckets
+
+        :param now: float, the current unix time. Default: None, the current time
+        :return: list, (key, bucket start, count) rows
+        """
+        current_bucket = int((now if now is not None else time.time()) // self.bucket_seconds) * self.bucket_seconds
+        rows = []
+        with self._lock:
+            for key, series in self.buckets.items():
+                for bucket in sorted(series):
+                    if bucket < current_bucket:
+                        rows.append((key, bucket, series.pop(bucket)))
+        return rows
+
+    def export(self, path, now=None):
+        """
+        Append the completed buckets to a CSV file with the columns KEY, TIMESTAMP, REQUESTS
+
+        :param path: str, the CSV file path
+        :param now: float, the current unix time. Default: None, the current time
+        :return: int, the number of exported rows
+        """
+        rows = self.drain(now)
+        if not rows:
+            return 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        write_header = not os.path.exists(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(['KEY', 'TIMESTAMP', 'REQUESTS'])
+            writer.writerows(rows)
+        return len(rows)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: sum(series.values()) for key, series in self.buckets.items()}
@@ -0,0 +1,216 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from config.log_config import logger
+
+PROFILE_MODES = ('cpu', 'sample', 'memory')
+
+
+class _StackSampler:
+    """
+    Sampling CPU profiler: a background thread records the Python stack of the profiled thread
+    every `interval` seconds. Unlike cProfile, the profiled code runs at full speed.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.n_samples = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                # Label functions by their first line, so samples on different lines add up
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.n_samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def summary(self, top_n):
+        """
+        Top functions by the share of samples they were running in (self) or on the stack of (total)
+        """
+        self_counts, total_counts = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+
+        n_samples = max(self.n_samples, 1)
+        lines = [f'{self.n_samples} samples every {self.interval * 1000:.1f} ms', '', 'self %  function']
+        lines += [f'{count / n_samples:6.1%}  {frame}' for frame, count in self_counts.most_common(top_n)]
+        lines += ['', 'total %  function']
+        lines += [f'{count / n_samples:7.1%}  {frame}' for frame, count in total_counts.most_common(top_n)]
+        return '\n'.join(lines)
+
+
+class Profiler:
+    """
+    On-demand profiling of one pipeline stage or of the whole run.
+
+    Modes:
+        cpu: deterministic profiling with cProfile, a .prof file (snakeviz, pstats) and the top-N by cumulative time
+        sample: a sampling profiler, a .folded file of collapsed stacks (flamegraph.pl, speedscope)
+                and the top-N by self and total samples
+        memory: allocation tracing with tracemalloc, a .tracemalloc snapshot and the top-N allocation sites
+
+    `profile(name)` only profiles the stage named like `stage`, every other stage runs untouched.
+    """
+
+    def __init__(self, mode, output_dir, prefix, stage='run', top_n=30, sample_interval=0.005):
+        """
+        :param mode: str, 'cpu'|'sample'|'memory'
+        :param output_dir: str, the directory of the profile files, next to the run report
+        :param prefix: str, the file name prefix, e.g. the run report name and run ID
+        :param stage: str, the profiled stage. Default: 'run', the whole run
+        :param top_n: int, the number of entries of the summaries
+        :param sample_interval: float, seconds between two samples of the sampling profiler
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode}, expected one of {PROFILE_MODES}")
+        self.mode = mode
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.stage = stage
+        self.top_n = top_n
+        self.sample_interval = sample_interval
+        self.output_paths = []
+
+    def should_profile(self, name):
+        return name == self.stage
+
+    @contextmanager
+    def profile(self, name):
+        """
+        Profile a block if it is the chosen stage
+
+        :param name: str, the stage name
+        """
+        if not self.should_profile(name):
+            yield
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base_path = os.path.join(self.output_dir, f'{self.prefix}.{name}.{self.mode}')
+        logger.info(f"Profiling stage {name} ({self.mode})...")
+
+        if self.mode == 'cpu':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(f'{base_path}.prof')
+                summary = io.StringIO()
+                pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(self.top_n)
+                self._write(base_path, ['.prof'], summary.getvalue())
+
+        elif self.mode == 'sample':
+            sampler = _StackSampler(threading.get_ident(), self.sample_interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                with open(f'{base_path}.folded', 'w') as f:
+                    for stack, count in sampler.stacks.most_common():
+                        f.write(f'{stack} {count}\n')
+                self._write(base_path, ['.folded'], sampler.summary(self.top_n))
+
+        else:
+            already_tracing = tracemalloc.is_tracing()
+            if not already_tracing:
+                tracemalloc.start(25)
+            tracemalloc.reset_peak()
+            start_snapshot = tracemalloc.take_snapshot()
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                if not already_tracing:
+                    tracemalloc.stop()
+                snapshot.dump(f'{base_path}.tracemalloc')
+
+                # What the stage allocated and still holds, e.g. the DataFrames it returns
+                trace_filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+                snapshot = snapshot.filter_traces(trace_filters)
+                growth = snapshot.compare_to(start_snapshot.filter_traces(trace_filters), 'lineno')
+                lines = [f'traced current {current / 1024 ** 2:.1f} MB | peak {peak / 1024 ** 2:.1f} MB '
+                         f'| {time.perf_counter() - start_time:.2f}s', '', 'top retained allocation sites:']
+                lines += [str(statistic) for statistic in growth[:self.top_n]]
+                lines += ['', 'top allocation tracebacks:']
+                for statistic in snapshot.statistics('traceback')[:min(self.top_n, 5)]:
+                    lines.append(f'{statistic.count} blocks, {statistic.size / 1024 ** 2:.1f} MB')
+                    lines += [f'    {line}' for line in statistic.traceback.format()]
+                self._write(base_path, ['.tracemalloc'], '\n'.join(lines))
+
+    def _write(self, base_path, suffixes, summary):
+        with open(f'{base_path}.txt', 'w') as f:
+            f.write(summary)
+        self.output_paths += [f'{base_path}{suffix}' for suffix in suffixes] + [f'{base_path}.txt']
+        logger.info(f"Profile written to {base_path}.txt")
+
+
+def add_profiling_args(parser):
+    """
+    Add the profiling switches to an entry point's argument parser
+
+    :param parser: argparse.ArgumentParser, the parser
+    :return: argparse.ArgumentParser, the parser
+    """
+    group = parser.add_argument_group('profiling')
+    group.add_argument('--profile', choices=PROFILE_MODES, default=None,
+                       help="cpu: cProfile, sample: sampling profiler, memory: tracemalloc. Default: off")
+    group.add_argument('--profile-stage', default='run',
+                       help="The run report stage to profile, e.g. load_data. Default: the whole run")
+    group.add_argument('--profile-top', type=int, default=30, help="The number of entries of the summaries")
+    group.add_argument('--profile-interval', type=float, default=0.005,
+                       help="Seconds between two samples of the sampling profiler")
+    return parser
+
+
+def profiler_from_args(args, run_report):
+    """
+    Create the profiler of the parsed profiling switches, its files go next to the run report
+
+    :param args: argparse.Namespace, the parsed arguments
+    :param run_report: RunReport, the run report
+    :return: Profiler | None, None when profiling is off
+    """
+    if args.profile is None:
+        return None
+    return Profiler(
+        args.profile,
+        output_dir=run_report.report_dir,
+        prefix=f'{run_report.name}-{run_report.run_id}',
+        stage=args.profile_stage,
+        top_n=args.profile_top,
+        sample_interval=args.profile_interval
+    )
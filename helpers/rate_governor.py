@@ -0,0 +1,221 @@
+import random
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError, IncompleteReadError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+
+THROTTLING_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException', 'SlowDown',
+    'ProvisionedThroughputExceededException', 'BandwidthLimitExceeded',
+}
+TRANSIENT_ERROR_CODES = {'InternalError', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout',
+                         'RequestTimeoutException'}
+# Connection errors, timeouts and broken responses, the clients under the governor don't retry them on their own
+TRANSIENT_BOTOCORE_ERRORS = (BotoConnectionError, HTTPClientError, IncompleteReadError)
+# Client methods that don't send a request
+UNGOVERNED_METHODS = {'can_paginate', 'close', 'generate_presigned_url', 'generate_presigned_post'}
+# Methods sending many requests out of the governor: S3 managed transfers (e.g. one request per multipart part),
+# paginators and waiters. They are sent by a client retrying on its own
+RETRYING_METHODS = {'upload_file', 'upload_fileobj', 'download_file', 'download_fileobj', 'copy',
+                    'get_paginator', 'get_waiter'}
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket whose rate adapts to the throttles (AIMD): halved on a throttle, increased by `increase`
+    tokens per second on each success, between `min_rate` and `max_rate`.
+
+    Callers reserve a token and sleep outside the lock, so concurrent callers queue fairly.
+    """
+
+    def __init__(self, max_rate, burst=None, min_rate=0.5, increase=None, decrease=0.5):
+        """
+        :param max_rate: float, the tokens per second when nothing is throttled
+        :param burst: float, the bucket size. Default: None, one second of max_rate
+        :param min_rate: float, the lowest rate after throttles
+        :param increase: float, the rate increase per success. Default: None, 5% of max_rate
+        :param decrease: float, the rate factor on a throttle
+        """
+        self.max_rate = float(max_rate)
+        self.rate = float(max_rate)
+        self.burst = float(burst if burst is not None else max(max_rate, 1))
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.increase = increase if increase is not None else self.max_rate * 0.05
+        self.decrease = decrease
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Take a token, waiting for it when the bucket is empty
+
+        :return: float, the seconds waited
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def on_success(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+class RateGovernor:
+    """
+    Process-wide rate limits and retries of the AWS control-plane calls, shared by every client of a service.
+
+    Each call takes a token of its service's bucket, a throttled or transient error is retried with
+    exponential backoff and full jitter, and the throttles slow the whole service down instead of
+    each client retrying on its own. Calls, throttles, retries and the time spent waiting are counted
+    per service, see `snapshot`.
+    """
+
+    def __init__(self, rates=None, default_rate=10.0, max_attempts=8, backoff_base=0.2, backoff_cap=20.0,
+                 min_rate=0.5, seed=None):
+        """
+        :param rates: dict, service -> the tokens per second when nothing is throttled, e.g. {'personalize': 8}
+        :param default_rate: float, the rate of the other services
+        :param max_attempts: int, the attempts per call, including the first one
+        :param backoff_base: float, the first backoff in seconds, doubled on each retry
+        :param backoff_cap: float, the longest backoff in seconds
+        :param min_rate: float, the lowest rate of a service after throttles
+        :param seed: int, the backoff jitter seed. Default: None
+        """
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.min_rate = min_rate
+        self.buckets = {}
+        self.stats = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def bucket(self, service):
+        """
+        :param service: str, the service name, e.g. 'personalize'
+        :return: AdaptiveTokenBucket, the bucket of the service
+        """
+        with self._lock:
+            if service not in self.buckets:
+                rate = self.rates.get(service, self.default_rate)
+                self.buckets[service] = AdaptiveTokenBucket(rate, min_rate=self.min_rate)
+                self.stats[service] = {'calls': 0, 'throttles': 0, 'retries': 0, 'errors': 0,
+                                       'wait_seconds': 0.0, 'backoff_seconds': 0.0}
+            return self.buckets[service]
+
+    def _count(self, service, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self.stats[service][name] += value
+
+    @staticmethod
+    def is_retryable(error):
+        """
+        :param error: ClientError | BotoCoreError, the error
+        :return: (bool, bool), whether the error is a throttle and whether it is retryable
+        """
+        if isinstance(error, BotoCoreError):
+            return False, isinstance(error, TRANSIENT_BOTOCORE_ERRORS)
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        throttled = code in THROTTLING_ERROR_CODES or status == 429
+        return throttled, throttled or code in TRANSIENT_ERROR_CODES or (status is not None and status >= 500)
+
+    def call(self, service, method, *args, **kwargs):
+        """
+        Call a client method under the rate limit of its service, retrying the throttled and transient errors
+
+        :param service: str, the service name
+        :param method: callable, the bound client method
+        :return: the method result
+        """
+        bucket = self.bucket(service)
+        for attempt in range(self.max_attempts):
+            self._count(service, calls=1, wait_seconds=bucket.acquire())
+            try:
+                result = method(*args, **kwargs)
+            except (ClientError, BotoCoreError) as error:
+                throttled, retryable = self.is_retryable(error)
+                if throttled:
+                    bucket.on_throttle()
+                    self._count(service, throttles=1)
+                if not retryable or attempt == self.max_attempts - 1:
+                    self._count(service, errors=1)
+                    raise
+                with self._lock:
+                    backoff = self._random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                self._count(service, retries=1, backoff_seconds=backoff)
+                time.sleep(backoff)
+                continue
+            bucket.on_success()
+            return result
+
+    def snapshot(self):
+        """
+        :return: dict, service -> calls, throttles, retries, errors, wait and backoff seconds and current rate
+        """
+        with self._lock:
+            return {
+                service: {**stats, 'rate': round(self.buckets[service].rate, 3)}
+                for service, stats in self.stats.items()
+            }
+
+
+class GovernedClient:
+    """
+    Proxy of a boto3 client sending every API call through a RateGovernor, the other attributes
+    (meta, exceptions) are the client's own.
+    Managed transfers, paginators and waiters go to `retrying_client`, their requests don't go through
+    the governor and would give up on the first throttle with a single attempt per request.
+    """
+
+    def __init__(self, client, service, governor, retrying_client=None):
+        """
+        :param client: object, the boto3 client
+        :param service: str, the service name of the rate limit
+        :param governor: RateGovernor, the governor
+        :param retrying_client: callable, creates a client with its own retries for the RETRYING_METHODS
+                                on first use. Default: None, `client`
+        """
+        self._client = client
+        self._service = service
+        self._governor = governor
+        self._retrying_client_factory = retrying_client
+        self._retrying_client = None
+
+    def __getattr__(self, name):
+        if name in RETRYING_METHODS:
+            if self._retrying_client_factory is None:
+                return getattr(self._client, name)
+            if self._retrying_client is None:
+                self._retrying_client = self._retrying_client_factory()
+            return getattr(self._retrying_client, name)
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or name in UNGOVERNED_METHODS or not callable(attribute):
+            return attribute
+
+        def governed(*args, **kwargs):
+            return self._governor.call(self._service, attribute, *args, **kwargs)
+
+        governed.__name__ = name
+        return governed
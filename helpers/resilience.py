@@ -0,0 +1,218 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, TimeoutError as FutureTimeoutError, wait
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a call is rejected because the circuit breaker is open
+    """
+
+
+class PoolSaturatedError(Exception):
+    """
+    Raised when a call is rejected because the pool already runs its maximum of calls in flight
+    """
+
+
+class CircuitBreaker:
+    """
+    Fail fast after repeated errors or timeouts.
+
+    CLOSED: calls go through, `failure_threshold` consecutive failures open the circuit.
+    OPEN: calls are rejected for `reset_timeout` seconds.
+    HALF_OPEN: one trial call goes through, its success closes the circuit, its failure opens it again.
+    A trial without an outcome after `reset_timeout` seconds is given up and another one goes through.
+    """
+    CLOSED = 'CLOSED'
+    OPEN = 'OPEN'
+    HALF_OPEN = 'HALF_OPEN'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        :param failure_threshold: int, the number of consecutive failures that opens the circuit
+        :param reset_timeout: float, seconds the circuit stays open before a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.counters = {'opened': 0, 'rejected': 0, 'successes': 0, 'failures': 0}
+        self._trial_in_flight = False
+        self._trial_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        Whether a call may go through, moves OPEN to HALF_OPEN once the reset timeout is over
+
+        :return: bool
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and \
+                    (not self._trial_in_flight or now - self._trial_started_at >= self.reset_timeout):
+                self._trial_in_flight = True
+                self._trial_started_at = now
+                return True
+
+            self.counters['rejected'] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.counters['successes'] += 1
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.counters['failures'] += 1
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.counters['opened'] += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def snapshot(self):
+        return {'state': self.state, 'consecutive_failures': self.consecutive_failures, **self.counters}
+
+
+class HedgedCaller:
+    """
+    Run blocking calls on a thread pool under a deadline, and optionally send a second (hedged) request
+    when the first one is slower than the recent p95 latency. The first successful response wins.
+
+    A call past its deadline keeps its thread until it returns, so the calls in flight are bounded by
+    `max_in_flight`: once they are all taken, new calls are rejected at once instead of queueing behind
+    calls nobody waits for anymore, and no hedged request is sent.
+    """
+
+    def __init__(self, executor, hedge=False, hedge_percentile=95, min_hedge_delay=0.005, window=1000,
+                 max_in_flight=None):
+        """
+        :param executor: ThreadPoolExecutor, the pool running the calls
+        :param hedge: bool, whether to send hedged requests
+        :param hedge_percentile: float, the latency percentile after which the hedged request is sent
+        :param min_hedge_delay: float, the lower bound of the hedge delay in seconds
+        :param window: int, the number of recent latencies the percentile is computed on
+        :param max_in_flight: int, the maximum of calls running or queued on the pool, usually its number of
+                              threads. Default: None, unbounded
+        """
+        self.executor = executor
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.latencies = deque(maxlen=window)
+        self.hedge_delay = None
+        self.counters = {'calls': 0, 'timeouts': 0, 'rejected': 0, 'hedges_sent': 0, 'hedges_won': 0}
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._lock = threading.Lock()
+
+    def _submit(self, fn, kwargs):
+        """
+        Submit a call if a slot is free, the slot is freed when the call returns or is cancelled
+
+        :return: Future | None, None when every slot is taken
+        """
+        if self._slots is None:
+            return self.executor.submit(fn, **kwargs)
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = self.executor.submit(fn, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _record_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+            # Recompute the delay every few calls, sorting the window on every call isn't needed
+            if len(self.latencies) >= 20 and len(self.latencies) % 10 == 0:
+                ordered = sorted(self.latencies)
+                index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+                self.hedge_delay = max(self.min_hedge_delay, ordered[index])
+
+    def call(self, fn, deadline=None, **kwargs):
+        """
+        Call fn(**kwargs) on the pool
+
+        :param fn: callable, the blocking call
+        :param deadline: float, seconds before giving up. Default: None, no deadline
+        :param kwargs: the call arguments
+        :return: the result of the first successful call
+        :raises: PoolSaturatedError when every slot is taken, concurrent.futures.TimeoutError when the deadline
+                 is over, otherwise the error of the last call
+        """
+        start_time = time.monotonic()
+        end_time = start_time + deadline if deadline is not None else None
+        self._count('calls')
+
+        primary = self._submit(fn, kwargs)
+        if primary is None:
+            self._count('rejected')
+            raise PoolSaturatedError("Every runtime call slot is in flight")
+        futures = {primary}
+
+        hedge_delay = self.hedge_delay
+        if self.hedge and hedge_delay is not None and (end_time is None or start_time + hedge_delay < end_time):
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                hedged = self._submit(fn, kwargs)
+                if hedged is not None:
+                    futures.add(hedged)
+                    self._count('hedges_sent')
+
+        error = None
+        while futures:
+            timeout = None if end_time is None else max(0.0, end_time - time.monotonic())
+            done, futures = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                self._count('timeouts')
+                self._cancel(futures)
+                raise FutureTimeoutError(f"No response within the {deadline}s deadline")
+
+            for future in done:
+                if future.exception() is None:
+                    self._record_latency(time.monotonic() - start_time)
+                    if future is not primary:
+                        self._count('hedges_won')
+                    self._cancel(futures)
+                    return future.result()
+                error = future.exception()
+
+        raise error
+
+    @staticmethod
+    def _cancel(futures):
+        # Only the calls still queued can be cancelled, the running ones finish on their thread
+        for future in futures:
+            future.cancel()
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+            hedge_delay = self.hedge_delay
+        return {
+            **counters,
+            'hedge_delay_ms': hedge_delay * 1000 if hedge_delay is not None else None,
+            'hedge_win_rate': counters['hedges_won'] / counters['hedges_sent'] if counters['hedges_sent'] else 0.0,
+        }
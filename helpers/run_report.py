@@ -0,0 +1,251 @@
+import glob
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from config.config import settings
+from config.log_config import logger
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+COMPARED_METRICS = ('wall_seconds', 'cpu_seconds', 'peak_rss_mb')
+# Differences below these are noise, whatever the relative change
+MIN_ABSOLUTE_CHANGE = {'wall_seconds': 0.5, 'cpu_seconds': 0.5, 'peak_rss_mb': 20.0}
+
+
+def current_rss_mb():
+    """
+    Get the resident set size of the process
+
+    :return: float, the RSS in MB. On platforms without /proc, the peak RSS of the process
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / 1024 ** 2
+    except OSError:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB on Linux
+        return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+class _RssSampler:
+    """
+    Sample the RSS in a background thread while a stage runs, the peak of the process lifetime
+    (ru_maxrss) can't tell the peak of one stage
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = current_rss_mb()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+        return self.peak
+
+
+class StageRecord(dict):
+    """
+    The measures of one stage, the caller fills rows_in, rows_out and bytes while the stage runs
+    """
+
+    def set(self, **measures):
+        self.update({key: value for key, value in measures.items() if value is not None})
+        return self
+
+
+class RunReport:
+    """
+    Per-stage performance report of a pipeline run: wall time, CPU time, peak RSS, rows in/out and bytes.
+
+    Usage:
+        report = RunReport('train')
+        with report.stage('load_data', bytes_in=os.path.getsize(path)) as stage:
+            df = load()
+            stage.set(rows_out=len(df))
+        report.save()
+
+    The JSON report is comparable across runs with `compare`, `save` logs the regressions against the
+    previous report of the same pipeline.
+    """
+
+    def __init__(self, name, run_id=None, report_dir=None, profiler=None):
+        """
+        :param name: str, the pipeline name, e.g. 'train'
+        :param run_id: str, the run ID. Default: None, the start time
+        :param report_dir: str, the report directory. Default: None, settings.RUN_REPORT_DIR
+        :param profiler: Profiler, profiles the stage it was set up for. Default: None, no profiling
+        """
+        self.name = name
+        self.run_id = run_id or time.strftime('%Y%m%d-%H%M%S')
+        self.report_dir = report_dir or settings.RUN_REPORT_DIR
+        self.started_at = time.time()
+        self.stages = []
+        self.info = {}
+        self.status = 'running'
+        self.profiler = profiler
+        self._depth = 0
+
+    @property
+    def path(self):
+        return os.path.join(self.report_dir, f'{self.name}-{self.run_id}.json')
+
+    @contextmanager
+    def stage(self, name, **measures):
+        """
+        Measure a stage, stages can be nested
+
+        :param name: str, the stage name
+        :param measures: the measures known upfront, e.g. rows_in or bytes_in
+        :return: StageRecord, to set the measures known at the end, e.g. rows_out
+        """
+        record = StageRecord(name=name, depth=self._depth, status='running')
+        record.set(**measures)
+        self.stages.append(record)
+        self._depth += 1
+
+        profile = nullcontext()
+        if self.profiler is not None and self.profiler.should_profile(name):
+            profile = self.profiler.profile(name)
+            record['profiled'] = self.profiler.mode
+
+        sampler = _RssSampler()
+        rss_start = current_rss_mb()
+        start_time = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            with profile:
+                yield record
+            record['status'] = 'ok'
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - start_time
+            record['cpu_seconds'] = time.process_time() - cpu_start
+            record['peak_rss_mb'] = sampler.stop()
+            record['rss_delta_mb'] = current_rss_mb() - rss_start
+            self._depth -= 1
+            logger.info(f"Stage {name}: {record['wall_seconds']:.2f}s wall, {record['cpu_seconds']:.2f}s CPU, "
+                        f"peak RSS {record['peak_rss_mb']:.0f} MB")
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'run_id': self.run_id,
+            'status': self.status,
+            'started_at': self.started_at,
+            'wall_seconds': time.time() - self.started_at,
+            'info': self.info,
+            'profiles': self.profiler.output_paths if self.profiler is not None else [],
+            'stages': self.stages,
+        }
+
+    def save(self, status='ok', compare_previous=True):
+        """
+        Write the JSON report and log the regressions against the previous report
+
+        :param status: str, the run status, e.g. 'ok' or 'failed'
+        :param compare_previous: bool, whether to compare with the previous report. Default: True
+        :return: str, the report path
+        """
+        self.status = status
+        previous_path = self.find_previous() if compare_previous else None
+
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        logger.info(f"Run report written to {self.path}")
+
+        if previous_path is not None:
+            regressions = self.compare(self.to_dict(), self.load(previous_path))
+            for regression in regressions:
+                logger.warning(f"Regression against {os.path.basename(previous_path)}: {regression}")
+        return self.path
+
+    def find_previous(self):
+        """
+        Find the latest successful report of the same pipeline
+
+        :return: str | None, the report path
+        """
+        for path in sorted(glob.glob(os.path.join(self.report_dir, f'{self.name}-*.json')), reverse=True):
+            if path == self.path:
+                continue
+            # train-* also matches the reports of the shards, e.g. train-roswell-*
+            report = self.load(path)
+            if report.get('name') == self.name and report.get('status') == 'ok':
+                return path
+        return None
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def stage_totals(stages, metrics=COMPARED_METRICS):
+        """
+        Sum the metrics of the stages by stage name, a stage can run several times, e.g. one upload per dataset
+
+        :param stages: list, the stage records of a report
+        :param metrics: tuple, the stage metrics
+        :return: dict, stage name -> metric -> total, the maximum for peak_rss_mb
+        """
+        result = {}
+        for stage in stages:
+            stage_totals = result.setdefault(stage['name'], {})
+            for metric in metrics:
+                if metric == 'peak_rss_mb':
+                    stage_totals[metric] = max(stage_totals.get(metric, 0.0), stage.get(metric, 0.0))
+                else:
+                    stage_totals[metric] = stage_totals.get(metric, 0.0) + stage.get(metric, 0.0)
+        return result
+
+    @staticmethod
+    def compare(report, baseline, tolerance=0.2, metrics=COMPARED_METRICS):
+        """
+        Compare the stages of two reports
+
+        :param report: dict, the report
+        :param baseline: dict, the baseline report
+        :param tolerance: float, the relative increase reported as a regression
+        :param metrics: tuple, the compared stage metrics
+        :return: list, the regressions, dicts with the stage, metric, baseline and current values
+        """
+        current_totals = RunReport.stage_totals(report['stages'], metrics)
+        baseline_totals = RunReport.stage_totals(baseline['stages'], metrics)
+        regressions = []
+        for name, stage_totals in current_totals.items():
+            if name not in baseline_totals:
+                continue
+            for metric, value in stage_totals.items():
+                baseline_value = baseline_totals[name][metric]
+                if value - baseline_value > max(tolerance * baseline_value, MIN_ABSOLUTE_CHANGE.get(metric, 0.0)):
+                    regressions.append({
+                        'stage': name,
+                        'metric': metric,
+                        'baseline': baseline_value,
+                        'current': value,
+                        'change': value / baseline_value - 1 if baseline_value else None,
+                    })
+        return regressions
+
+
+if __name__ == '__main__':
+    # python -m helpers.run_report <report.json> <baseline.json>
+    current_report, baseline_report = RunReport.load(sys.argv[1]), RunReport.load(sys.argv[2])
+    found_regressions = RunReport.compare(current_report, baseline_report)
+    print(json.dumps(found_regressions, indent=2))
+    sys.exit(1 if found_regressions else 0)
@@ -0,0 +1,253 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+# Bound the (rows x string width) padded copy of one block of `hash_series`
+HASH_BLOCK_BYTES = 8 * 1024 ** 2
+# The hashes added to a HyperLogLog at once
+ADD_BLOCK_SIZE = 1 << 18
+
+
+def _mix64(values):
+    """
+    splitmix64 finalizer, a bijection of uint64 that spreads every input bit over the output
+    """
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _hash_strings(array):
+    """
+    Hash an Arrow string array 8 bytes at a time: Arrow pads each block of strings with zero bytes to
+    the same width, a fixed-width copy that numpy reads as a (rows, width / 8) uint64 matrix.
+    Several times faster than hashing Python string objects one by one, and the memory is bounded by
+    HASH_BLOCK_BYTES whatever the number of strings.
+
+    :param array: pa.Array, a string array without nulls
+    :return: np.ndarray, uint64 hashes
+    """
+    if len(array) == 0:
+        return np.empty(0, dtype=np.uint64)
+    lengths = pc.binary_length(array).to_numpy()
+    # ascii_rpad counts bytes, not characters, so UTF-8 strings are padded to the same byte width
+    width = max(8, -(-int(lengths.max()) // 8) * 8)
+    block_rows = max(1, HASH_BLOCK_BYTES // width)
+    hashes = np.empty(len(array), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for first in range(0, len(array), block_rows):
+            block = array.slice(first, block_rows)
+            fixed = pc.ascii_rpad(block, width=width, padding='\0').cast(pa.large_binary()).cast(pa.binary(width))
+            words = np.frombuffer(fixed.buffers()[1], dtype=np.uint64,
+                                  count=len(block) * width // 8, offset=fixed.offset * width)
+            words = words.reshape(len(block), width // 8)
+            block_hashes = _mix64(lengths[first:first + len(block)].astype(np.uint64) * GOLDEN_GAMMA)
+            for j in range(words.shape[1]):
+                block_hashes = _mix64(block_hashes ^ words[:, j])
+            hashes[first:first + len(block)] = block_hashes
+    return hashes
+
+
+def hash_series(series):
+    """
+    Hash the non-null values of a column to uint64.
+    Strings hash alike whatever their dtype (str, object, category), integers are hashed by value.
+
+    :param series: pd.Series, the column
+    :return: np.ndarray, uint64 hashes of the non-null values
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        category_hashes = hash_series(pd.Series(series.cat.categories))
+        return category_hashes[codes[codes >= 0]]
+
+    series = series.dropna()
+    if pd.api.types.is_integer_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        with np.errstate(over='ignore'):
+            return _mix64(series.to_numpy().astype(np.int64).view(np.uint64) + GOLDEN_GAMMA)
+
+    if not pd.api.types.is_string_dtype(series.dtype):
+        series = series.astype(str)
+    # Arrow-backed strings are hashed from their own buffers, without a copy
+    array = pa.array(series, from_pandas=True)
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if not (pa.types.is_string(array.type) or pa.types.is_large_string(array.type)):
+        array = array.cast(pa.large_string())
+    return _hash_strings(array)
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct count sketch: 2^precision uint8 registers, a relative error of ~1.04 / sqrt(2^precision)
+    (0.8% at the default precision 14, 16 KB) whatever the number of values.
+    Two sketches of the same precision merge into the sketch of the union, e.g. of chunks or partitions.
+    """
+
+    def __init__(self, precision=14, registers=None):
+        """
+        :param precision: int, 11 to 18, the number of index bits
+        :param registers: np.ndarray, uint8 registers of an existing sketch. Default: None, an empty sketch
+        """
+        if not 11 <= precision <= 18:
+            raise ValueError(f"HyperLogLog precision must be between 11 and 18, got {precision}")
+        self.precision = precision
+        self.registers = registers if registers is not None else np.zeros(1 << precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        """
+        Add uint64 hashes of values to the sketch
+
+        :param hashes: np.ndarray, uint64 hashes, see `hash_series`
+        :return: HyperLogLog, self
+        """
+        n_rank_bits = 64 - self.precision
+        # Blocks bound the temporary index and rank arrays
+        for first in range(0, len(hashes), ADD_BLOCK_SIZE):
+            block = hashes[first:first + ADD_BLOCK_SIZE]
+            indices = (block >> np.uint64(n_rank_bits)).astype(np.int64)
+            # The rank is the position of the leftmost 1 bit of the remaining bits, at most 53 bits so exact in float64
+            _, bit_lengths = np.frexp((block & np.uint64((1 << n_rank_bits) - 1)).astype(np.float64))
+            ranks = (n_rank_bits - bit_lengths + 1).astype(np.uint8)
+            np.maximum.at(self.registers, indices, ranks)
+        return self
+
+    def update(self, series):
+        """
+        Add the non-null values of a column to the sketch
+
+        :param series: pd.Series, the column
+        :return: HyperLogLog, self
+        """
+        return self.add_hashes(hash_series(series))
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one
+
+        :param other: HyperLogLog, a sketch of the same precision
+        :return: HyperLogLog, self
+        """
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HyperLogLog sketches of precision {self.precision} and {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        """
+        Estimate the number of distinct values
+
+        :return: int, the estimate
+        """
+        n_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / n_registers)
+        estimate = alpha * n_registers ** 2 / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        n_zeros = int((self.registers == 0).sum())
+        # Linear counting is more accurate while many registers are still empty
+        if estimate <= 2.5 * n_registers and n_zeros > 0:
+            estimate = n_registers * math.log(n_registers / n_zeros)
+        return int(round(estimate))
+
+
+class DatasetStatistics:
+    """
+    Row and null counters and distinct count sketches of a few columns, updated chunk by chunk as the data streams
+    through the loader, without a separate pass. Statistics of chunks or partitions merge into the statistics of
+    the whole data. Exact distinct counts are opt-in, they hold every distinct value in memory.
+    """
+
+    def __init__(self, columns, precision=14, exact=False):
+        """
+        :param columns: list, the columns to count the distinct values of
+        :param precision: int, the HyperLogLog precision, see `HyperLogLog`
+        :param exact: bool, whether to also count the distinct values exactly. Default: False
+        """
+        self.columns = list(columns)
+        self.precision = precision
+        self.exact = exact
+        self.rows = 0
+        self.counters = {}
+        self.nulls = {col: 0 for col in self.columns}
+        self.sketches = {col: HyperLogLog(precision) for col in self.columns}
+        self.distinct_values = {col: set() for col in self.columns} if exact else None
+
+    def count(self, name, value=1):
+        """
+        Increment a named counter, e.g. the rows read or dropped by a step
+
+        :param name: str, the counter name
+        :param value: int, the increment
+        :return: None
+        """
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def update(self, data):
+        """
+        Add a chunk of the data
+
+        :param data: pd.DataFrame, the chunk, with every column of `columns`
+        :return: DatasetStatistics, self
+        """
+        return self.update_columns({col: data[col] for col in self.columns}, rows=len(data))
+
+    def update_columns(self, columns, rows=0):
+        """
+        Add a chunk given column by column, e.g. columns taken from different rows of a raw export
+
+        :param columns: dict, column name -> pd.Series, a subset of `columns`
+        :param rows: int, the rows of the chunk
+        :return: DatasetStatistics, self
+        """
+        self.rows += rows
+        for col, series in columns.items():
+            self.nulls[col] += int(series.isna().sum())
+            self.sketches[col].update(series)
+            if self.exact:
+                self.distinct_values[col].update(series.dropna().unique().tolist())
+        return self
+
+    def merge(self, other):
+        """
+        Merge the statistics of another chunk or partition
+
+        :param other: DatasetStatistics, statistics of the same columns
+        :return: DatasetStatistics, self
+        """
+        for name, value in other.counters.items():
+            self.count(name, value)
+        self.rows += other.rows
+        for col in self.columns:
+            self.nulls[col] += other.nulls[col]
+            self.sketches[col].merge(other.sketches[col])
+            if self.exact:
+                if not other.exact:
+                    raise ValueError("Cannot merge approximate statistics into exact statistics")
+                self.distinct_values[col] |= other.distinct_values[col]
+        return self
+
+    def distinct(self, col):
+        """
+        The number of distinct non-null values of a column, exact when `exact` is set
+
+        :param col: str, the column
+        :return: int, the distinct count
+        """
+        if self.exact:
+            return len(self.distinct_values[col])
+        return self.sketches[col].count()
+
+    def summary(self):
+        """
+        :return: dict, the counters, for run reports and logs
+        """
+        return {
+            'rows': self.rows,
+            'exact': self.exact,
+            'distinct': {col: self.distinct(col) for col in self.columns},
+            'nulls': dict(self.nulls),
+            'counters': dict(self.counters),
+        }
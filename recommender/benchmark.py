@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from config.config import Config, settings
+from config.log_config import logger
+from helpers.connection import (get_rate_governor, restore_rate_governor, use_aws_backend, use_fake_backend,
+                                use_rate_governor)
+from helpers.fake_aws import FakeAWSBackend
+from helpers.profiling import add_profiling_args, profiler_from_args
+from helpers.rate_governor import RateGovernor
+from helpers.run_report import RunReport
+from recommender.pipeline_inference import Inference
+from recommender.pipeline_train import TrainPipeline
+from recommender.synthetic_data import SyntheticExport
+
+# The output paths of TrainPipeline, redirected to a temporary directory while benchmarking
+ISOLATED_SETTINGS = (
+    'SERVING_DIR', 'FALLBACK_RECOMMENDER_PATH', 'ITEM_CATALOG_PATH', 'USER_TABLE_PATH', 'KNOWN_USERS_PATH',
+    'COLD_START_RECOMMENDER_PATH', 'DATASET_FINGERPRINT_PATH', 'EVENT_TRACKER_PATH', 'RECOMMENDATION_STORE_DIR',
+    'REQUEST_RATE_DIR', 'REQUEST_RATE_DOWNLOAD_DIR', 'CAPACITY_REPORT_PATH', 'SHARD_ROUTER_PATH', 'SHARD_DIR',
+)
+HISTORY_FILE = 'history.jsonl'
+
+
+@contextmanager
+def isolated_settings(work_dir, **overrides):
+    """
+    Point the pipeline outputs to `work_dir`, so a benchmark never overwrites the datasets, fingerprints
+    and serving files of a real run
+
+    :param work_dir: str, the directory replacing settings.BASE_DIR
+    :param overrides: other settings for the duration of the benchmark, e.g. PERSONALIZE_POLL_INTERVAL
+    """
+    saved = {name: getattr(settings, name) for name in (*ISOLATED_SETTINGS, *overrides)}
+    try:
+        for name in ISOLATED_SETTINGS:
+            setattr(settings, name, os.path.join(work_dir, os.path.relpath(saved[name], Config.BASE_DIR)))
+        for name, value in overrides.items():
+            setattr(settings, name, value)
+        settings.BASE_DIR = work_dir
+        yield
+    finally:
+        for name, path in saved.items():
+            setattr(settings, name, path)
+        # BASE_DIR is a class attribute, drop the instance one
+        del settings.BASE_DIR
+
+
+def git_commit():
+    """
+    :return: str | None, the checked out commit, suffixed with '-dirty' when there are local changes
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Config.BASE_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=Config.BASE_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{commit}-dirty' if status else commit
+
+
+def synthetic_export(n_rows, generator_params=None):
+    """
+    The synthetic export of a scale, generated on first use
+
+    :param n_rows: int, the number of rows
+    :param generator_params: dict, the SyntheticExport parameters. Default: None
+    :return: str, the export path
+    """
+    generator_params = generator_params or {}
+    suffix = '_'.join(f'{key}{value}' for key, value in sorted(generator_params.items()))
+    data_path = os.path.join(settings.BENCHMARK_DATA_DIR, f"raw_{n_rows}{'_' + suffix if suffix else ''}.csv")
+    if not os.path.exists(data_path):
+        SyntheticExport(n_rows=n_rows, **generator_params).write(data_path)
+    return data_path
+
+
+def benchmark_scale(n_rows, data_path=None, import_mode='FULL', generator_params=None, report_dir=None,
+                    profiler_args=None):
+    """
+    Time every stage of process_data and build_data_for_personalize on a synthetic export.
+    Nothing is uploaded, the import files are written to a temporary directory.
+
+    :param n_rows: int, the number of rows of the export
+    :param data_path: str, an existing export. Default: None, a synthetic export generated once and reused
+    :param import_mode: str, 'FULL'|'INCREMENTAL'. Default: 'FULL'
+    :param generator_params: dict, the SyntheticExport parameters, e.g. user_skew. Default: None
+    :param report_dir: str, the report directory. Default: settings.BENCHMARK_REPORT_DIR
+    :param profiler_args: argparse.Namespace, the parsed profiling switches. Default: None, no profiling
+    :return: dict, the run report
+    """
+    generator_params = generator_params or {}
+    data_path = data_path or synthetic_export(n_rows, generator_params)
+    report = RunReport(f'benchmark-{n_rows}', report_dir=report_dir or settings.BENCHMARK_REPORT_DIR)
+    if profiler_args is not None:
+        report.profiler = profiler_from_args(profiler_args, report)
+    report.info.update(
+        rows=n_rows,
+        data_path=data_path,
+        data_bytes=os.path.getsize(data_path),
+        import_mode=import_mode,
+        generator_params=generator_params,
+        git_commit=git_commit(),
+        python=platform.python_version(),
+        pandas=pd.__version__,
+        numpy=np.__version__,
+        cpu_count=os.cpu_count(),
+    )
+
+    status = 'ok'
+    try:
+        with tempfile.TemporaryDirectory(prefix='benchmark-') as work_dir, isolated_settings(work_dir):
+            train_pipeline = TrainPipeline(data_path, run_report=report)
+            with report.stage('run'):
+                processed_data = train_pipeline.process_data()
+                train_pipeline.build_data_for_personalize(processed_data, import_mode=import_mode, upload=False)
+                with report.stage('build_fallback_recommender', rows_in=len(processed_data)):
+                    train_pipeline.build_fallback_recommender(processed_data)
+    except Exception as e:
+        # e.g. a MemoryError at the largest scales, the other scales still run
+        logger.error(f"Benchmark of {n_rows} rows failed: {e!r}")
+        status = 'failed'
+
+    report.save(status=status)
+    result = report.to_dict()
+    append_history(result, os.path.join(report.report_dir, HISTORY_FILE))
+    return result
+
+
+def benchmark_cycle(n_rows, data_path=None, generator_params=None, backend=None, n_requests=200,
+                    poll_interval=0.05, report_dir=None, profiler_args=None):
+    """
+    Run a full training and inference cycle against the fake AWS backend: process the export, upload the
+    datasets, import, train, deploy the campaign, then serve recent bookings through Inference.
+    Times the orchestration, polling and concurrency of Personalization in seconds instead of hours.
+
+    :param n_rows: int, the number of rows of the export
+    :param data_path: str, an existing export. Default: None, a synthetic export generated once and reused
+    :param generator_params: dict, the SyntheticExport parameters. Default: None
+    :param backend: FakeAWSBackend, the backend with its durations, failures and throttling.
+                    Default: None, the default durations
+    :param n_requests: int, the number of inference requests
+    :param poll_interval: float, seconds between two status checks of Personalization
+    :param report_dir: str, the report directory. Default: settings.BENCHMARK_REPORT_DIR
+    :param profiler_args: argparse.Namespace, the parsed profiling switches. Default: None, no profiling
+    :return: dict, the run report
+    """
+    generator_params = generator_params or {}
+    data_path = data_path or synthetic_export(n_rows, generator_params)
+    backend = use_fake_backend(backend or FakeAWSBackend())
+    # Time runs `speed_up` times faster on the fake backend, so do the rate limits and the backoff
+    speed_up = settings.PERSONALIZE_POLL_INTERVAL / poll_interval
+    previous_governor = get_rate_governor()
+    governor = use_rate_governor(RateGovernor(
+        rates={'personalize': settings.PERSONALIZE_CONTROL_TPS * speed_up, 's3': settings.S3_CONTROL_TPS * speed_up},
+        max_attempts=settings.CONTROL_MAX_ATTEMPTS, backoff_base=backend.retry_backoff
+    ))
+
+    report = RunReport(f'cycle-{n_rows}', report_dir=report_dir or settings.BENCHMARK_REPORT_DIR)
+    if profiler_args is not None:
+        report.profiler = profiler_from_args(profiler_args, report)
+    report.info.update(
+        rows=n_rows,
+        data_path=data_path,
+        import_mode='FULL',
+        generator_params=generator_params,
+        fake_aws={'durations': backend.durations, 'failure_rates': backend.failure_rates,
+                  'throttle_rates': backend.throttle_rates, 'runtime_latency': backend.runtime_latency},
+        git_commit=git_commit(),
+    )
+
+    status = 'ok'
+    try:
+        with tempfile.TemporaryDirectory(prefix='benchmark-') as work_dir, \
+                isolated_settings(work_dir, PERSONALIZE_POLL_INTERVAL=poll_interval, IAM_PROPAGATION_DELAY=0):
+            train_pipeline = TrainPipeline(data_path, run_report=report)
+            with report.stage('run'):
+                processed_data = train_pipeline.process_data()
+                train_pipeline.build_data_for_personalize(processed_data, import_mode='FULL')
+                with report.stage('build_fallback_recommender', rows_in=len(processed_data)):
+                    train_pipeline.build_fallback_recommender(processed_data)
+                campaign_arn = train_pipeline.train_recommendation(import_mode='FULL')
+
+                requests = train_pipeline.build_shadow_requests(n_requests)
+                with report.stage('load_artifacts'):
+                    inference = Inference.from_serving_artifacts()
+                with report.stage('get_recommendations', rows_in=len(requests)):
+                    for user_id, context in requests:
+                        inference.get_recommendations(campaign_arn, user_id, context)
+            report.info.update(campaign_arn=campaign_arn, inference=inference.get_metrics())
+    except Exception as e:
+        logger.error(f"Cycle benchmark of {n_rows} rows failed: {e!r}")
+        status = 'failed'
+    finally:
+        use_aws_backend()
+        restore_rate_governor(previous_governor)
+
+    report.info['fake_aws_calls'] = backend.snapshot()
+    report.info['rate_governor'] = governor.snapshot()
+    report.save(status=status)
+    result = report.to_dict()
+    append_history(result, os.path.join(report.report_dir, HISTORY_FILE))
+    return result
+
+
+def append_history(report, history_path):
+    """
+    Append the stage totals of a benchmark report to the history, one JSON line per run
+
+    :param report: dict, the run report
+    :param history_path: str, the JSONL history file
+    :return: dict, the history entry
+    """
+    entry = {
+        'name': report['name'],
+        'run_id': report['run_id'],
+        'started_at': report['started_at'],
+        'status': report['status'],
+        'rows': report['info']['rows'],
+        'git_commit': report['info']['git_commit'],
+        'import_mode': report['info']['import_mode'],
+        'stages': RunReport.stage_totals(report['stages']),
+    }
+    os.makedirs(os.path.dirname(history_path), exist_ok=True)
+    with open(history_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def load_history(history_path=None, metric='wall_seconds'):
+    """
+    Load the benchmark history as a table
+
+    :param history_path: str, the JSONL history file. Default: the history of settings.BENCHMARK_REPORT_DIR
+    :param metric: str, the stage metric, 'wall_seconds'|'cpu_seconds'|'peak_rss_mb'
+    :return: pd.DataFrame, one row per run and one column per stage
+    """
+    history_path = history_path or os.path.join(settings.BENCHMARK_REPORT_DIR, HISTORY_FILE)
+    if not os.path.exists(history_path):
+        return pd.DataFrame()
+
+    records = []
+    with open(history_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            record = {
+                'name': entry.get('name'),
+                'run_id': entry['run_id'],
+                'rows': entry['rows'],
+                'git_commit': entry['git_commit'],
+                'status': entry['status'],
+            }
+            record.update({name: totals.get(metric) for name, totals in entry['stages'].items()})
+            records.append(record)
+    return pd.DataFrame(records).sort_values(['name', 'rows', 'run_id']).reset_index(drop=True)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the data stages of the train pipeline")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1_000_000],
+                        help="The export sizes in rows, e.g. 1000000 10000000")
+    parser.add_argument('--data-path', default=None, help="Benchmark an existing export instead, one scale only")
+    parser.add_argument('--import-mode', choices=['FULL', 'INCREMENTAL'], default='FULL')
+    parser.add_argument('--user-skew', type=float, default=None)
+    parser.add_argument('--item-skew', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--cycle', action='store_true',
+                        help="Run a full training and inference cycle against the fake AWS backend instead")
+    parser.add_argument('--requests', type=int, default=200, help="The inference requests of --cycle")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="The probability of a throttled call of the fake backend, every service")
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help="The probability of a CREATE FAILED solution version of the fake backend")
+    parser.add_argument('--poll-interval', type=float, default=0.05,
+                        help="Seconds between two status checks of Personalization in --cycle")
+    parser.add_argument('--history', action='store_true', help="Print the benchmark history and exit")
+    parser.add_argument('--metric', choices=['wall_seconds', 'cpu_seconds', 'peak_rss_mb'], default='wall_seconds',
+                        help="The stage metric printed by --history")
+    add_profiling_args(parser)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.history:
+        with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.precision', 2):
+            print(load_history(metric=args.metric))
+        return None
+
+    generator_params = {
+        key: value for key, value in [('user_skew', args.user_skew), ('item_skew', args.item_skew),
+                                      ('seed', args.seed)]
+        if value is not None
+    }
+    start_time = time.time()
+    if args.cycle:
+        reports = [
+            benchmark_cycle(
+                n_rows, data_path=args.data_path, generator_params=generator_params,
+                backend=FakeAWSBackend(throttle_rates=args.throttle_rate,
+                                       failure_rates={'solutionVersion': args.failure_rate}),
+                n_requests=args.requests, poll_interval=args.poll_interval, profiler_args=args
+            )
+            for n_rows in args.scales
+        ]
+    else:
+        reports = [
+            benchmark_scale(n_rows, data_path=args.data_path, import_mode=args.import_mode,
+                            generator_params=generator_params, profiler_args=args)
+            for n_rows in args.scales
+        ]
+    logger.info(f"Benchmarked {len(reports)} scales in {time.time() - start_time:.0f}s")
+    return reports
+
+
+if __name__ == '__main__':
+    # python -m recommender.benchmark --scales 1000000 10000000
+    # python -m recommender.benchmark --cycle --scales 100000 --throttle-rate 0.05
+    # python -m recommender.benchmark --history
+    main()
@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from config.log_config import logger
+from helpers.connection import connect_to_s3_client
+
+
+class CampaignPointer:
+    """
+    S3 object naming the live campaign of a blue/green deployment.
+
+    A rollout writes the pointer only after the standby campaign is ACTIVE and passed the shadow check.
+    A PUT replaces an S3 object atomically, so readers see either the previous or the new campaign, never
+    a partial write. `Inference` resolves the campaign through `resolve`, which caches the pointer for
+    `refresh_interval` seconds and keeps the last known campaign when S3 can't be read.
+    """
+
+    def __init__(self, bucket_name, object_name='campaign-pointer.json', s3_client=None, profile_name=None,
+                 refresh_interval=30):
+        """
+        :param bucket_name: str, the S3 bucket holding the pointer
+        :param object_name: str, the object name of the pointer
+        :param s3_client: object, an existing S3 client. Default: None, a new client is created
+        :param profile_name: str, the profile name in ~/.aws/credentials
+        :param refresh_interval: float, seconds the resolved campaign is cached
+        """
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.s3_client = s3_client or connect_to_s3_client(profile_name=profile_name)
+        self.refresh_interval = refresh_interval
+        self._campaign_arn = None
+        self._last_check = None
+        self._lock = threading.Lock()
+
+    def read(self):
+        """
+        Read the pointer
+
+        :return: dict | None, the pointer, None when no campaign was published yet
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.object_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+    def publish(self, campaign_arn, solution_version_arn=None, **details):
+        """
+        Point to a new live campaign
+
+        :param campaign_arn: str, the campaign ARN
+        :param solution_version_arn: str, the solution version deployed on the campaign
+        :param details: extra fields kept in the pointer, e.g. the shadow check report
+        :return: dict, the pointer
+        """
+        pointer = {
+            'campaignArn': campaign_arn,
+            'solutionVersionArn': solution_version_arn,
+            'updatedAt': int(time.time()),
+            **details,
+        }
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=self.object_name,
+            Body=json.dumps(pointer, default=str).encode('utf-8')
+        )
+        with self._lock:
+            self._campaign_arn = campaign_arn
+            self._last_check = time.monotonic()
+        logger.info(f"Campaign pointer s3://{self.bucket_name}/{self.object_name} -> {campaign_arn}")
+        return pointer
+
+    def resolve(self, default=None):
+        """
+        Get the live campaign ARN
+
+        :param default: str, the campaign ARN when no pointer was published yet
+        :return: str, the campaign ARN
+        """
+        if self._last_check is not None and time.monotonic() - self._last_check < self.refresh_interval:
+            return self._campaign_arn or default
+
+        with self._lock:
+            # Another thread may have refreshed it while this one waited
+            if self._last_check is not None and time.monotonic() - self._last_check < self.refresh_interval:
+                return self._campaign_arn or default
+            try:
+                pointer = self.read()
+                campaign_arn = pointer['campaignArn'] if pointer is not None else None
+                if campaign_arn != self._campaign_arn:
+                    logger.info(f"Live campaign: {campaign_arn}")
+                self._campaign_arn = campaign_arn
+            except (ClientError, BotoCoreError) as error:
+                logger.warning(f"Couldn't read the campaign pointer, keeping {self._campaign_arn}: {error!r}")
+            self._last_check = time.monotonic()
+            return self._campaign_arn or default
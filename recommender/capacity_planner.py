@@ -0,0 +1,146 @@
+import glob
+import json
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from config.log_config import logger
+
+
+def load_request_rates(paths, campaign_arns=None, exclude_campaign_arns=None):
+    """
+    Load the request rate history exported by `Inference.export_request_rates`
+
+    :param paths: str | list, CSV files or glob patterns
+    :param campaign_arns: list, the campaigns to keep. Default: None, all of them
+    :param exclude_campaign_arns: list, the campaigns to leave out. Default: None
+    :return: pd.Series, requests per second indexed by unix second, the campaigns summed,
+             seconds without requests filled with 0
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = sorted(file for path in paths for file in glob.glob(path))
+    if not files:
+        return pd.Series(dtype='int64')
+
+    rates_df = pd.concat([pd.read_csv(file) for file in files], ignore_index=True)
+    if campaign_arns is not None:
+        rates_df = rates_df[rates_df['KEY'].isin(campaign_arns)]
+    if exclude_campaign_arns:
+        rates_df = rates_df[~rates_df['KEY'].isin(exclude_campaign_arns)]
+    if rates_df.empty:
+        return pd.Series(dtype='int64')
+
+    rates = rates_df.groupby('TIMESTAMP')['REQUESTS'].sum()
+    full_index = np.arange(rates.index.min(), rates.index.max() + 1)
+    return rates.reindex(full_index, fill_value=0)
+
+
+class CapacityPlanner:
+    """
+    Recommend the minProvisionedTPS of a campaign from its request rate history.
+
+    The campaign bills max(minProvisionedTPS, actual TPS) per hour and scales above the minimum
+    only after a delay, so traffic over the minimum risks throttling. The recommendation is a high
+    percentile of the per-second rate with some headroom. Peaks above it are left to auto-scaling
+    instead of paying for them all night.
+    """
+
+    def __init__(self, percentile=95, headroom=1.2, min_tps=1, max_tps=None):
+        """
+        :param percentile: float, the percentile of the per-second request rate to provision for
+        :param headroom: float, the factor applied on the percentile
+        :param min_tps: int, the lowest recommended TPS, Personalize requires at least 1
+        :param max_tps: int, the highest recommended TPS. Default: None, no limit
+        """
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_tps = min_tps
+        self.max_tps = max_tps
+
+    def recommend(self, rates):
+        """
+        Recommend the minProvisionedTPS
+
+        :param rates: pd.Series, requests per second, see `load_request_rates`
+        :return: int, the recommended minProvisionedTPS
+        """
+        tps = math.ceil(float(np.percentile(rates.to_numpy(), self.percentile)) * self.headroom)
+        tps = max(self.min_tps, tps)
+        return min(self.max_tps, tps) if self.max_tps is not None else tps
+
+    @staticmethod
+    def simulate(rates, min_provisioned_tps):
+        """
+        Replay the history against a minProvisionedTPS
+
+        :param rates: pd.Series, requests per second
+        :param min_provisioned_tps: int, the minProvisionedTPS
+        :return: dict, the billed TPS-hours, the share of seconds above the minimum and the largest excess
+        """
+        values = rates.to_numpy()
+        hourly_mean = rates.groupby(rates.index // 3600).mean().to_numpy()
+        above = values > min_provisioned_tps
+        return {
+            'min_provisioned_tps': int(min_provisioned_tps),
+            'billed_tps_hours': float(np.maximum(hourly_mean, min_provisioned_tps).sum()),
+            'seconds_above_min': int(above.sum()),
+            'share_above_min': float(above.mean()) if len(values) else 0.0,
+            'requests_above_min': int(np.maximum(values - min_provisioned_tps, 0).sum()),
+            'max_excess_tps': float(max(values.max() - min_provisioned_tps, 0)) if len(values) else 0.0,
+        }
+
+    def plan(self, rates, current_tps=None, candidates=None, report_path=None):
+        """
+        Build the capacity report: rate statistics, hourly profile, recommendation and simulations
+
+        :param rates: pd.Series, requests per second, see `load_request_rates`
+        :param current_tps: int, the current minProvisionedTPS, simulated for comparison. Default: None
+        :param candidates: list, other minProvisionedTPS values to simulate. Default: None
+        :param report_path: str, the JSON report path. Default: None, no file written
+        :return: dict, the report, None when there is no history
+        """
+        if rates.empty:
+            logger.warning("No request rate history, keeping the current provisioned TPS")
+            return None
+
+        values = rates.to_numpy()
+        recommended_tps = self.recommend(rates)
+        hours_of_day = (rates.index.to_numpy() // 3600) % 24
+        hourly_profile = rates.groupby(hours_of_day).quantile(self.percentile / 100)
+
+        simulated = {recommended_tps, math.ceil(values.max()) or 1}
+        if current_tps is not None:
+            simulated.add(current_tps)
+        simulated.update(candidates or [])
+
+        report = {
+            'created_at': int(time.time()),
+            'history_start': int(rates.index.min()),
+            'history_seconds': int(len(rates)),
+            'total_requests': int(values.sum()),
+            'mean_tps': float(values.mean()),
+            'p50_tps': float(np.percentile(values, 50)),
+            'p95_tps': float(np.percentile(values, 95)),
+            'p99_tps': float(np.percentile(values, 99)),
+            'peak_tps': float(values.max()),
+            'hourly_p_tps': {int(hour): float(tps) for hour, tps in hourly_profile.items()},
+            'percentile': self.percentile,
+            'headroom': self.headroom,
+            'current_tps': current_tps,
+            'recommended_tps': recommended_tps,
+            'simulations': [self.simulate(rates, tps) for tps in sorted(simulated)],
+        }
+        logger.info(f"Recommended minProvisionedTPS {recommended_tps} "
+                    f"(p{self.percentile} {np.percentile(values, self.percentile):.2f}, peak {values.max()})")
+
+        if report_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Capacity report written to {report_path}")
+
+        return report
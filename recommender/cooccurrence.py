@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+
+from config.log_config import logger
+
+KEY_SEPARATOR = '\x1f'
+
+
+class CooccurrenceRecommender:
+    """
+    Massage -> enhancement recommender built from the co-occurrence of massages and enhancements
+    in the same invoice, i.e. the output of `DataLoader.merge_massages_enhancements`.
+
+    Scores are kept for several context levels, from the most specific one
+    (massage_name + all condition columns) down to the massage alone and the global popularity.
+    A request backs off to the next level when its context has too little support.
+    Only the top-K items of every context are stored, as fixed-width code/score arrays.
+
+    It exposes the same `get_recommendations` interface as `Inference`, so it can be used as a fallback.
+    """
+
+    def __init__(self, item_ids, item_names, condition_cols, levels):
+        """
+        :param item_ids: np.ndarray, the item IDs, indexed by item code
+        :param item_names: np.ndarray, the item names, indexed by item code
+        :param condition_cols: list, the extra context columns, e.g. ['center_name', 'service_length']
+        :param levels: list, (keys, items, scores) per context level, most specific first
+        """
+        self.item_ids = [str(i) for i in item_ids]
+        self.item_names = [str(i) for i in item_names]
+        self.condition_cols = list(condition_cols)
+        self.levels = levels
+        self._indexes = [{key: row for row, key in enumerate(keys)} for keys, _, _ in levels]
+
+    @classmethod
+    def fit(cls, data, condition_cols=('center_name', 'service_length'), top_k=25, score='lift',
+            min_support=5):
+        """
+        Build the recommender from the merged massage/enhancement data
+
+        :param data: pd.DataFrame, the output of DataLoader.merge_massages_enhancements
+        :param condition_cols: tuple, the context columns to condition on, besides massage_name
+        :param top_k: int, the number of items kept per context
+        :param score: str, the ranking score, 'lift'|'confidence'|'count'. Default: 'lift'
+        :param min_support: int, the minimum number of purchases for a context (or a context-item pair)
+                            to be kept
+        :return: CooccurrenceRecommender
+        """
+        logger.info("Building co-occurrence recommender...")
+
+        item_codes, item_ids = pd.factorize(data['item_id'].astype(str))
+        item_names = (
+            pd.Series(data['item_name'].astype(str).to_numpy(), index=item_codes)
+            .groupby(level=0).first()
+            .reindex(range(len(item_ids)))
+            .to_numpy()
+        )
+        n_items = len(item_ids)
+
+        # Global item probability, used by the lift
+        item_counts = np.bincount(item_codes, minlength=n_items).astype(np.float64)
+        item_prob = item_counts / item_counts.sum()
+
+        context_cols = ['massage_name', *condition_cols]
+        levels = []
+        for n_cols in range(len(context_cols), -1, -1):
+            cols = context_cols[:n_cols]
+            if cols:
+                keys = data[cols[0]].astype(str)
+                for col in cols[1:]:
+                    keys = keys + KEY_SEPARATOR + data[col].astype(str)
+            else:
+                keys = pd.Series('', index=data.index)
+
+            # Sparse (context, item) counts as COO triplets
+            context_codes, context_keys = pd.factorize(keys)
+            pair_counts = pd.Series(1, index=[context_codes, item_codes]).groupby(level=[0, 1]).sum()
+            context_idx = pair_counts.index.get_level_values(0).to_numpy()
+            item_idx = pair_counts.index.get_level_values(1).to_numpy()
+            counts = pair_counts.to_numpy().astype(np.float64)
+            context_totals = np.bincount(context_idx, weights=counts, minlength=len(context_keys))
+
+            keep = counts >= min_support if cols else np.ones(len(counts), dtype=bool)
+            keep &= context_totals[context_idx] >= min_support
+            context_idx, item_idx, counts = context_idx[keep], item_idx[keep], counts[keep]
+
+            confidence = counts / context_totals[context_idx]
+            if score == 'lift':
+                values = confidence / item_prob[item_idx]
+            elif score == 'confidence':
+                values = confidence
+            elif score == 'count':
+                values = counts
+            else:
+                raise ValueError(f"Unknown score {score}")
+
+            # Rank inside every context: score desc, then count desc
+            order = np.lexsort((-counts, -values, context_idx))
+            context_idx, item_idx, values = context_idx[order], item_idx[order], values[order]
+            used_contexts, starts = np.unique(context_idx, return_index=True)
+            ranks = np.arange(len(context_idx)) - np.repeat(starts, np.diff(np.append(starts, len(context_idx))))
+            rows = np.searchsorted(used_contexts, context_idx)
+            in_top_k = ranks < top_k
+
+            level_items = np.full((len(used_contexts), top_k), -1, dtype=np.int32)
+            level_scores = np.zeros((len(used_contexts), top_k), dtype=np.float32)
+            level_items[rows[in_top_k], ranks[in_top_k]] = item_idx[in_top_k]
+            level_scores[rows[in_top_k], ranks[in_top_k]] = values[in_top_k]
+            level_keys = np.asarray(context_keys, dtype=str)[used_contexts]
+
+            levels.append((level_keys, level_items, level_scores))
+            logger.info(f"Context level {cols or ['global']}: {len(level_keys)} contexts")
+
+        return cls(np.asarray(item_ids, dtype=str), item_names.astype(str), condition_cols, levels)
+
+    def save(self, path):
+        """
+        Save the recommender to a compressed .npz file
+
+        :param path: str, the file path
+        :return: None
+        """
+        arrays = {
+            'item_ids': np.asarray(self.item_ids, dtype=str),
+            'item_names': np.asarray(self.item_names, dtype=str),
+            'condition_cols': np.asarray(self.condition_cols, dtype=str),
+        }
+        for i, (keys, items, scores) in enumerate(self.levels):
+            arrays[f'keys_{i}'] = keys
+            arrays[f'items_{i}'] = items
+            arrays[f'scores_{i}'] = scores
+
+        np.savez_compressed(path, **arrays)
+        logger.info(f"Co-occurrence recommender saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a recommender saved with `save`
+
+        :param path: str, the file path
+        :return: CooccurrenceRecommender
+        """
+        with np.load(path) as arrays:
+            levels = []
+            i = 0
+            while f'keys_{i}' in arrays:
+                levels.append((arrays[f'keys_{i}'], arrays[f'items_{i}'], arrays[f'scores_{i}']))
+                i += 1
+            return cls(arrays['item_ids'], arrays['item_names'], arrays['condition_cols'], levels)
+
+    def recommend(self, massage_name, num_results=5, **conditions):
+        """
+        Get the top items for a massage, backing off to less specific contexts when needed
+
+        :param massage_name: str, the massage name
+        :param num_results: int, the number of results
+        :param conditions: the condition column values, e.g. center_name='Roswell', service_length='60.0'
+        :return: list, (item code, score) tuples
+        """
+        values = [massage_name] + [conditions.get(col) for col in self.condition_cols]
+        n_levels = len(self.levels)
+        for level, ((_, items, scores), index) in enumerate(zip(self.levels, self._indexes)):
+            n_cols = n_levels - 1 - level
+            if any(value is None for value in values[:n_cols]):
+                continue
+
+            row = index.get(KEY_SEPARATOR.join(str(value) for value in values[:n_cols]))
+            if row is None:
+                continue
+
+            codes = items[row]
+            n_valid = int((codes >= 0).sum())
+            if n_valid >= num_results or n_cols == 0:
+                return list(zip(codes[:min(n_valid, num_results)].tolist(), scores[row][:num_results].tolist()))
+
+        return []
+
+    def get_recommendations(self, campaign_arn, user_id, context, num_results=5, return_item_metadata=True):
+        """
+        Get recommendations with the same interface and response format as `Inference.get_recommendations`.
+        The campaign ARN and the user ID are not used.
+
+        :param campaign_arn: str, the campaign ARN
+        :param user_id: str, the user ID
+        :param context: dict, the context
+        :param num_results: int, the number of results
+        :param return_item_metadata: bool, whether to return item metadata. Default: True
+        :return: list, the recommendations
+        """
+        conditions = {col: context.get(col.upper()) for col in self.condition_cols}
+        item_list = []
+        for code, score in self.recommend(context.get('MASSAGE_NAME'), num_results, **conditions):
+            item = {'itemId': self.item_ids[code], 'score': score}
+            if return_item_metadata:
+                item['metadata'] = {'item_name': self.item_names[code]}
+            item_list.append(item)
+        return item_list
@@ -1,6 +1,20 @@
+import contextlib
+import fnmatch
+import glob
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from config.config import settings
 from config.log_config import logger
+from helpers.aws_data_ops import list_s3_keys, open_s3_object, split_s3_path
+from helpers.connection import connect_to_s3_client
+from helpers.sketches import DatasetStatistics, hash_series
+from helpers.time_handler import get_lack_dates, get_next_date
 import pandas as pd
+import pyarrow.parquet as pq
 
 
 class DataLoader:
@@ -10,30 +24,145 @@ class DataLoader:
     The recommender will recommend the enhancement based on the massage that the customer has chosen.
     The customers go to the massages and can choose to add >= 1 enhancements to their massages.
 
+    The raw data is one export or several daily and partial exports whose date ranges overlap.
+    Several exports are read concurrently and spilled to disk in partitions by invoice ID, every invoice
+    is then deduplicated and filtered within its partition, one partition in memory at a time.
+
     https://thenowmassage.com/
     """
 
-    def __init__(self, data_path):
+    # Distinct counts logged and reported per run
+    STATISTICS_COLUMNS = ['user_id', 'item_id', 'massage_name']
+    # A line exported by several files is taken from the last of them
+    DEDUPLICATION_KEYS = ['invoice_id', 'item_name']
+
+    def __init__(self, data_path, exact_statistics=False, profile_name=None, max_workers=4, n_partitions=16,
+                 chunk_rows=500_000, spill_dir=None):
+        """
+        :param data_path: str | list, a raw export, a glob of exports, e.g. data/exports/*.csv, or a list of them,
+                          s3://bucket/key paths and globs are read from S3. Later exports win on overlaps
+        :param exact_statistics: bool, whether to count the distinct users, items and massages exactly
+                                 instead of estimating them with HyperLogLog sketches. Default: False
+        :param profile_name: str, the profile name in ~/.aws/credentials, for S3 exports. Default: None
+        :param max_workers: int, the number of exports read concurrently
+        :param n_partitions: int, the number of invoice ID partitions of several exports
+        :param chunk_rows: int, the rows read at once from one of several exports
+        :param spill_dir: str, the parent directory of the partition files. Default: None, the temp directory
+        """
         self.data_path = data_path
+        self.profile_name = profile_name
+        self.max_workers = max_workers
+        self.n_partitions = n_partitions
+        self.chunk_rows = chunk_rows
+        self.spill_dir = spill_dir
+        self.statistics = DatasetStatistics(self.STATISTICS_COLUMNS, exact=exact_statistics)
+        self.bytes_read = 0
+        self.missing_dates = []
+        self._s3_client = None
 
-    def load_data(self):
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            self._s3_client = connect_to_s3_client(profile_name=self.profile_name)
+        return self._s3_client
+
+    def resolve_paths(self):
         """
-        The customers go to the massages and can choose to add >= 1 enhancements to their massages.
+        Expand the globs of `data_path`, each glob in name order
 
-        :return: pd.DataFrame, the data
+        :return: list, the export paths
         """
-        logger.info("Loading data...")
+        patterns = list(self.data_path) if isinstance(self.data_path, (list, tuple)) else [self.data_path]
+        paths = []
+        for pattern in patterns:
+            if not any(char in pattern for char in '*?['):
+                paths.append(pattern)
+            elif pattern.startswith('s3://'):
+                bucket_name, key_pattern = split_s3_path(pattern)
+                prefix = re.split(r'[*?\[]', key_pattern, maxsplit=1)[0]
+                paths += sorted(f"s3://{bucket_name}/{obj['Key']}" for obj in
+                                list_s3_keys(self.s3_client, bucket_name, prefix)
+                                if fnmatch.fnmatchcase(obj['Key'], key_pattern))
+            else:
+                paths += sorted(glob.glob(pattern))
+
+        if not paths:
+            raise FileNotFoundError(f"No raw export matches {self.data_path}")
+        return paths
+
+    def read_export(self, path, chunk_rows=None):
+        """
+        Read one raw export, local or on S3, csv (optionally compressed) or parquet.
+        S3 exports are streamed, a chunk is parsed as soon as its bytes arrive.
+
+        :param path: str, the export path
+        :param chunk_rows: int, the rows per chunk. Default: None, the whole export at once
+        :return: (iterable of pd.DataFrame, int), the chunks and the export size in bytes
+        """
+        if path.startswith('s3://'):
+            source, n_bytes = open_s3_object(self.s3_client, *split_s3_path(path))
+        else:
+            source, n_bytes = path, os.path.getsize(path)
 
-        df = pd.read_csv(self.data_path)
+        if path.endswith('.parquet'):
+            chunks = self.read_parquet(source, chunk_rows)
+            return (list(chunks) if chunk_rows is None else chunks), n_bytes
+        compression = 'infer' if isinstance(source, str) else ('gzip' if path.endswith('.gz') else None)
+        if chunk_rows is None:
+            return [pd.read_csv(source, compression=compression)], n_bytes
+        return pd.read_csv(source, compression=compression, chunksize=chunk_rows), n_bytes
+
+    def read_parquet(self, source, chunk_rows=None):
+        """
+        Read a parquet export batch by batch
+
+        :param source: str | file-like, the export path or an S3 stream
+        :param chunk_rows: int, the rows per chunk. Default: None, the whole export at once
+        :return: generator of pd.DataFrame, the chunks
+        """
+        with contextlib.ExitStack() as stack:
+            if not isinstance(source, str):
+                # Parquet starts reading from its footer, the stream is spooled to disk rather than memory
+                spool = stack.enter_context(tempfile.TemporaryFile(dir=self.spill_dir))
+                shutil.copyfileobj(source, spool)
+                spool.seek(0)
+                source = spool
+            parquet_file = pq.ParquetFile(source)
+            if chunk_rows is None:
+                yield parquet_file.read().to_pandas()
+                return
+            for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+                yield batch.to_pandas()
+
+    @staticmethod
+    def clean_export(df):
+        """
+        Normalize the column names and keep the massage and enhancement lines of an export
+
+        :param df: pd.DataFrame, rows of a raw export
+        :return: pd.DataFrame, the cleaned rows
+        """
         df.columns = [i.lower().replace(' ', '_') for i in df.columns]
 
         # Drop unnecessary columns
         drop_cols = ['service_name', 'center_zip']
         df.drop(columns=drop_cols, inplace=True)
 
+        # An export may read the invoice IDs as numbers and another one as strings, they are compared as strings
+        df['invoice_id'] = df['invoice_id'].astype(str)
+
         # Only calculate the recommendation for the massages and enhancements
-        df = df[df.service_parent_category.isin(['Massages', 'Enhancement'])]
+        return df[df.service_parent_category.isin(['Massages', 'Enhancement'])]
 
+    @staticmethod
+    def filter_invoices(df):
+        """
+        Keep the massage invoices and one line per massage and enhancement,
+        every line of an invoice must be in `df`
+
+        :param df: pd.DataFrame, the cleaned rows
+        :return: pd.DataFrame, the filtered rows
+        """
         # Filter message_df where massages invoice_id has exactly 3 rows
         invoice_id_counts = df[df.service_parent_category == 'Massages'].invoice_id.value_counts()
         df = df[df.invoice_id.isin(invoice_id_counts[invoice_id_counts == 3].index)]
@@ -42,9 +171,134 @@ class DataLoader:
         # --> remove duplicates for massages with the same invoice_id
 
         index_li = df[['invoice_id', 'item_name']].drop_duplicates().index
-
         return df.loc[index_li]
 
+    def load_data(self):
+        """
+        The customers go to the massages and can choose to add >= 1 enhancements to their massages.
+
+        :return: pd.DataFrame, the data
+        """
+        logger.info("Loading data...")
+
+        paths = self.resolve_paths()
+        self.statistics.count('files', len(paths))
+        if len(paths) == 1:
+            chunks, self.bytes_read = self.read_export(paths[0])
+            df = chunks[0]
+            self.statistics.count('rows_read', len(df))
+            df = self.filter_invoices(self.clean_export(df))
+            self.update_statistics(df)
+        else:
+            df = self.load_partitioned(paths)
+
+        self.statistics.count('rows_loaded', len(df))
+        self.report_missing_dates(df)
+        return df
+
+    def load_partitioned(self, paths):
+        """
+        Read several exports concurrently into invoice ID partitions on disk, then deduplicate
+        and filter the invoices partition by partition
+
+        :param paths: list, the export paths, later exports win on overlaps
+        :return: pd.DataFrame, the data
+        """
+        spill_dir = tempfile.mkdtemp(prefix='raw_partitions_', dir=self.spill_dir)
+        try:
+            for partition in range(self.n_partitions):
+                os.makedirs(os.path.join(spill_dir, str(partition)))
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self.partition_export, source, path, spill_dir)
+                           for source, path in enumerate(paths)]
+                for path, future in zip(paths, futures):
+                    n_rows, n_bytes = future.result()
+                    self.statistics.count('rows_read', n_rows)
+                    self.bytes_read += n_bytes
+                    logger.info(f"Partitioned {path}: {n_rows} rows, {n_bytes / 1024 ** 2:.1f} MB")
+
+            frames = []
+            for partition in range(self.n_partitions):
+                partition_dir = os.path.join(spill_dir, str(partition))
+                files = sorted(os.listdir(partition_dir))
+                if not files:
+                    continue
+                df = pd.concat([pd.read_pickle(os.path.join(partition_dir, file)) for file in files],
+                               ignore_index=True)
+                # Each line is taken from the last export that has it, so the lines of an invoice are not counted
+                # once per overlapping export
+                latest = df.groupby(self.DEDUPLICATION_KEYS, sort=False, dropna=False)['_source'].transform('max')
+                keep = df['_source'] == latest
+                self.statistics.count('rows_overlapping', int((~keep).sum()))
+                df = self.filter_invoices(df[keep].drop(columns='_source'))
+                self.update_statistics(df)
+                frames.append(df)
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+        return pd.concat(frames, ignore_index=True)
+
+    def partition_export(self, source, path, spill_dir):
+        """
+        Split one export into the invoice ID partitions, chunk by chunk
+
+        :param source: int, the position of the export, later exports win on overlaps
+        :param path: str, the export path
+        :param spill_dir: str, the directory of the partition directories
+        :return: (int, int), the rows and bytes read
+        """
+        chunks, n_bytes = self.read_export(path, chunk_rows=self.chunk_rows)
+        n_rows = 0
+        for chunk_index, chunk in enumerate(chunks):
+            n_rows += len(chunk)
+            chunk = self.clean_export(chunk)
+            chunk['_source'] = source
+            partitions = hash_series(chunk['invoice_id']) % self.n_partitions
+            for partition, part in chunk.groupby(partitions, sort=False):
+                part.to_pickle(os.path.join(spill_dir, str(partition), f'{source:05d}-{chunk_index:05d}.pkl'))
+        return n_rows, n_bytes
+
+    def update_statistics(self, df):
+        """
+        Add the users, items and massages of filtered rows to the statistics, as they would be after
+        `merge_massages_enhancements`. Every line of an invoice must be in `df`, so the statistics of
+        the partitions add up to the statistics of the whole data without another pass over it.
+
+        :param df: pd.DataFrame, the filtered rows, see `filter_invoices`
+        :return: None
+        """
+        massages = df[df.service_parent_category == 'Massages']
+        enhancements = df[(df.service_parent_category == 'Enhancement') & df.item_code.notna()
+                          & df.invoice_id.isin(massages.invoice_id)]
+        massages = massages[massages.invoice_id.isin(enhancements.invoice_id)]
+        # The merge pairs every massage line of an invoice with every enhancement line
+        massage_counts = massages.invoice_id.value_counts()
+        rows = int((massage_counts * enhancements.invoice_id.value_counts().reindex(massage_counts.index)).sum())
+        self.statistics.update_columns({
+            'user_id': massages['user_id'],
+            'item_id': enhancements['item_code'],
+            'massage_name': massages['item_name'],
+        }, rows=rows)
+
+    def report_missing_dates(self, df):
+        """
+        Log the days without any booking between the first and the last booking,
+        e.g. a daily export that never arrived
+
+        :param df: pd.DataFrame, the loaded data
+        :return: list, the missing days, %Y%m%d
+        """
+        if df.empty:
+            return []
+        days = pd.to_datetime(pd.Series(df['invoice_closed_date'].astype(str).str.split(' ', n=1).str[0].unique()))
+        days = days.dropna().dt.strftime('%Y%m%d')
+        self.missing_dates = sorted(get_lack_dates(days.min(), get_next_date(days.max()), days.tolist()))
+        self.statistics.count('missing_days', len(self.missing_dates))
+        if self.missing_dates:
+            logger.warning(f"{len(self.missing_dates)} days without bookings between {days.min()} and {days.max()}: "
+                           f"{', '.join(self.missing_dates[:10])}{' ...' if len(self.missing_dates) > 10 else ''}")
+        return self.missing_dates
+
     @staticmethod
     def merge_massages_enhancements(data):
         """
@@ -85,12 +339,14 @@ class DataLoader:
         return merged_df
 
     @staticmethod
-    def process_data_types(data, days_in_year=365.25):
+    def process_data_types(data, days_in_year=365.25, statistics=None):
         """
         Process the data types of the data
 
         :param data: pd.DataFrame, the data to process
         :param days_in_year: float, the number of days in a year
+        :param statistics: DatasetStatistics, the statistics of the loaded data to log, see `update_statistics`.
+                           Default: None, new approximate ones of the processed data
         :return:
         """
         logger.info("Processing data types...")
@@ -109,9 +365,13 @@ class DataLoader:
         for col in cat_cols:
             data[col] = data[col].astype('category')
 
+        # The sketches hash each value once, the categorical columns only hash their categories
+        if statistics is None:
+            statistics = DatasetStatistics(DataLoader.STATISTICS_COLUMNS).update(data)
+        approx = '' if statistics.exact else '~'
         logger.info(f"Data rows {data.shape[0]} "
-                    f"| Unique users {data.user_id.nunique()} "
-                    f"| unique items {data.item_id.nunique()} "
-                    f"| unique massages {data.massage_name.nunique()} ")
+                    f"| Unique users {approx}{statistics.distinct('user_id')} "
+                    f"| unique items {approx}{statistics.distinct('item_id')} "
+                    f"| unique massages {approx}{statistics.distinct('massage_name')} ")
 
         return data
@@ -1,6 +1,12 @@
+import hashlib
+import os
+
+import numpy as np
 import pandas as pd
 from config.config import settings
 from config.log_config import logger
+from helpers.sketches import HyperLogLog, hash_series
+from helpers.time_handler import get_previous_date, get_previous_month
 
 
 class DatasetBuilder:
@@ -9,6 +15,13 @@ class DatasetBuilder:
     The dataset will be uploaded to S3 bucket for Personalize to use.
     The format of the dataset is csv
     """
+    # The columns identifying a record, a record whose other columns change is sent again.
+    # Interactions are append-only, the whole row is the key.
+    DATASET_KEYS = {
+        'interaction': None,
+        'user': ['USER_ID'],
+        'item': ['ITEM_ID'],
+    }
 
     def __init__(self, data=None, data_path=None):
         if data is None:
@@ -28,6 +41,68 @@ class DatasetBuilder:
 
         return pd.read_parquet(data_path)
 
+    def apply_training_window(self, months=None, days=None, start_date=None, end_date=None):
+        """
+        Keep the interactions of the training window [start_date, end_date) only.
+        The user and item datasets are built from the interactions, so the users and items
+        only referenced outside the window are pruned as well.
+
+        :param months: int, the window length in months before end_date. Default: None, 0 is the whole history
+                       before end_date
+        :param days: int, the window length in days before end_date, when months is not set. Default: None
+        :param start_date: str, the first date of the window, e.g. 20230101 or 2023-01-01,
+                           overrides months and days. Default: None
+        :param end_date: str, the day after the window, e.g. 20240101 or 2024-01-01.
+                         Default: None, the day after the latest interaction
+        :return: dict, the window and the rows, users, items and bytes before and after, None without a window
+        """
+        if not months and not days and start_date is None and end_date is None:
+            return None
+
+        if end_date is None:
+            end_date = (self.data['timestamp'].max() + pd.Timedelta(days=1)).strftime('%Y%m%d')
+        else:
+            end_date = pd.Timestamp(str(end_date)).strftime('%Y%m%d')
+        if start_date is not None:
+            start_date = pd.Timestamp(str(start_date)).strftime('%Y%m%d')
+        elif months:
+            start_date = get_previous_month(end_date, delta_months=months)
+        elif days:
+            start_date = get_previous_date(end_date, delta_days=days)
+        else:
+            # Only an end date, the whole history before it
+            start_date = self.data['timestamp'].min().strftime('%Y%m%d')
+
+        bytes_before = int(self.data.memory_usage(index=False, deep=True).sum())
+        mask = (self.data['timestamp'] >= pd.Timestamp(start_date)) & (self.data['timestamp'] < pd.Timestamp(end_date))
+        rows = [len(self.data), int(mask.sum())]
+        # Each column is hashed once, the rows in the window are a subset of the hashes
+        distinct = {}
+        for col in ['user_id', 'item_id']:
+            values = self.data[col]
+            hashes = hash_series(values)
+            in_window = mask.to_numpy()[values.notna().to_numpy()]
+            distinct[col] = [HyperLogLog().add_hashes(hashes).count(),
+                             HyperLogLog().add_hashes(hashes[in_window]).count()]
+        self.data = self.data[mask]
+        bytes_after = int(self.data.memory_usage(index=False, deep=True).sum())
+
+        report = {
+            'start_date': start_date,
+            'end_date': end_date,
+            'rows': rows,
+            'users': distinct['user_id'],
+            'items': distinct['item_id'],
+            'bytes': [bytes_before, bytes_after],
+        }
+        logger.info(f"Training window [{start_date}, {end_date}): "
+                    f"rows {rows[0]} -> {rows[1]} "
+                    f"| users ~{report['users'][0]} -> ~{report['users'][1]} "
+                    f"| items ~{report['items'][0]} -> ~{report['items'][1]} "
+                    f"| {bytes_before / 1024 ** 2:.1f} -> {bytes_after / 1024 ** 2:.1f} MB "
+                    f"({1 - bytes_after / max(bytes_before, 1):.0%} less)")
+        return report
+
     def build_interaction_dataset(self):
         """
         Build the interaction dataset for the recommendation system
@@ -75,3 +150,124 @@ class DatasetBuilder:
         item_df = item_df.drop_duplicates(subset=['item_id'])
         item_df.columns = [col.upper() for col in item_df.columns]
         return item_df
+
+    @staticmethod
+    def fingerprint_dataset(df, key_cols=None):
+        """
+        Hash every row of a dataset.
+        The values are hashed as strings, so the fingerprints match whatever the dtypes of the run were.
+
+        :param df: pd.DataFrame, the dataset
+        :param key_cols: list, the columns identifying a record. Default: None, the whole row
+        :return: (np.ndarray, np.ndarray), uint64 key hashes and row hashes
+        """
+        str_df = df.astype(str)
+        row_hashes = pd.util.hash_pandas_object(str_df, index=False).to_numpy()
+        if key_cols is None:
+            return row_hashes, row_hashes
+        key_hashes = pd.util.hash_pandas_object(str_df[key_cols], index=False).to_numpy()
+        return key_hashes, row_hashes
+
+    @staticmethod
+    def build_delta(df, key_cols=None, previous_fingerprint=None):
+        """
+        Keep the rows of a dataset that are new or changed since the previous fingerprint
+
+        :param df: pd.DataFrame, the dataset
+        :param key_cols: list, the columns identifying a record. Default: None, the whole row
+        :param previous_fingerprint: (np.ndarray, np.ndarray), the key and row hashes of the previous import,
+                                     sorted by key. Default: None, every row is new
+        :return: (pd.DataFrame, (np.ndarray, np.ndarray)), the delta and the fingerprint after importing it
+        """
+        key_hashes, row_hashes = DatasetBuilder.fingerprint_dataset(df, key_cols)
+        if previous_fingerprint is None or len(previous_fingerprint[0]) == 0:
+            mask = np.ones(len(df), dtype=bool)
+            previous_keys = previous_rows = np.empty(0, dtype=np.uint64)
+        else:
+            previous_keys, previous_rows = previous_fingerprint
+            index = np.minimum(np.searchsorted(previous_keys, key_hashes), len(previous_keys) - 1)
+            found = previous_keys[index] == key_hashes
+            mask = ~found | (previous_rows[index] != row_hashes)
+
+        # Records missing from this run are still in the dataset, keep their fingerprints.
+        # np.unique keeps the first occurrence, so the current rows take precedence.
+        keys, first_index = np.unique(np.concatenate([key_hashes, previous_keys]), return_index=True)
+        rows = np.concatenate([row_hashes, previous_rows])[first_index]
+        return df[mask], (keys, rows)
+
+    def build_delta_datasets(self, previous_fingerprints=None, datasets=None):
+        """
+        Build the interaction, user and item datasets and keep the new or changed rows only
+
+        :param previous_fingerprints: dict, dataset name -> fingerprint, see `load_fingerprints`. Default: None
+        :param datasets: dict, dataset name -> dataset already built. Default: None, build them
+        :return: (dict, dict, dict), dataset name -> full dataset, dataset name -> delta,
+                 dataset name -> fingerprint to save once the deltas are imported
+        """
+        previous_fingerprints = previous_fingerprints or {}
+        datasets = datasets or {
+            'interaction': self.build_interaction_dataset(),
+            'user': self.build_user_dataset(),
+            'item': self.build_item_dataset(),
+        }
+
+        deltas, fingerprints = {}, {}
+        for name, df in datasets.items():
+            deltas[name], fingerprints[name] = self.build_delta(
+                df, self.DATASET_KEYS[name], previous_fingerprints.get(name)
+            )
+            logger.info(f"{name} delta: {len(deltas[name])} of {len(df)} rows")
+        return datasets, deltas, fingerprints
+
+    @staticmethod
+    def hash_fingerprints(fingerprints):
+        """
+        Reduce the fingerprints of the imported datasets to one digest of the dataset content
+
+        :param fingerprints: dict, dataset name -> (key hashes, row hashes) sorted by key
+        :return: str, the hex digest
+        """
+        digest = hashlib.sha256()
+        for name in sorted(fingerprints):
+            keys, rows = fingerprints[name]
+            digest.update(name.encode('utf-8'))
+            digest.update(np.ascontiguousarray(keys).tobytes())
+            digest.update(np.ascontiguousarray(rows).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def load_fingerprints(path):
+        """
+        Load the fingerprints of the last imported snapshot
+
+        :param path: str, the .npz file
+        :return: dict, dataset name -> (key hashes, row hashes), empty when nothing was imported yet
+        """
+        if not os.path.exists(path):
+            logger.info(f"No dataset fingerprints at {path}, the full datasets will be imported")
+            return {}
+        with np.load(path) as arrays:
+            return {
+                name: (arrays[f'{name}_keys'], arrays[f'{name}_rows'])
+                for name in DatasetBuilder.DATASET_KEYS if f'{name}_keys' in arrays
+            }
+
+    @staticmethod
+    def save_fingerprints(fingerprints, path):
+        """
+        Save the fingerprints of the imported snapshot, call it once the import jobs succeeded
+
+        :param fingerprints: dict, dataset name -> (key hashes, row hashes)
+        :param path: str, the .npz file
+        :return: None
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {}
+        for name, (keys, rows) in fingerprints.items():
+            arrays[f'{name}_keys'] = keys
+            arrays[f'{name}_rows'] = rows
+        # np.savez adds the .npz suffix to other names, write to a .npz temp file
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        logger.info(f"Dataset fingerprints saved to {path}")
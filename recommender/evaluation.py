@@ -0,0 +1,171 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from config.log_config import logger
+
+
+def time_based_split(interaction_df, holdout_fraction=0.1, cutoff=None):
+    """
+    Split the interaction dataset by TIMESTAMP into train and holdout
+
+    :param interaction_df: pd.DataFrame, the output of DatasetBuilder.build_interaction_dataset
+    :param holdout_fraction: float, the fraction of the most recent interactions kept for holdout
+    :param cutoff: int, the unix timestamp starting the holdout, overrides holdout_fraction. Default: None
+    :return: (pd.DataFrame, pd.DataFrame, int), the train and holdout interactions and the cutoff
+    """
+    if cutoff is None:
+        cutoff = int(np.quantile(interaction_df['TIMESTAMP'].to_numpy(), 1 - holdout_fraction))
+
+    is_holdout = interaction_df['TIMESTAMP'].to_numpy() >= cutoff
+    train_df, holdout_df = interaction_df[~is_holdout], interaction_df[is_holdout]
+    logger.info(f"Time split at {cutoff}: train {len(train_df)} rows | holdout {len(holdout_df)} rows")
+    return train_df, holdout_df, cutoff
+
+
+class Evaluator:
+    """
+    Offline evaluation of any recommender exposing `get_recommendations` (Inference, LocalRecommender,
+    CooccurrenceRecommender, ...) on a holdout of interactions.
+
+    One query is one (USER_ID, MASSAGE_NAME) pair of the holdout, its relevant items are the enhancements
+    bought with that massage. Recommenders exposing `recommend_batch` are scored in one batch call.
+    The metrics are computed on (query, item) integer keys with numpy, without Python loops.
+    """
+
+    def __init__(self, holdout_df, k=5, catalog=None):
+        """
+        :param holdout_df: pd.DataFrame, the holdout interactions
+        :param k: int, the cut-off of the ranking metrics
+        :param catalog: list, the item IDs the coverage is computed against. Default: the holdout items
+        """
+        self.k = k
+
+        holdout_df = holdout_df.sort_values('TIMESTAMP')
+        query_codes, queries = pd.MultiIndex.from_arrays(
+            [holdout_df['USER_ID'].astype(str), holdout_df['MASSAGE_NAME'].astype(str)]
+        ).factorize()
+        self.queries = queries
+
+        catalog = pd.Index(catalog if catalog is not None else holdout_df['ITEM_ID'].unique()).astype(str)
+        self.catalog = catalog.append(pd.Index(holdout_df['ITEM_ID'].astype(str).unique())).unique()
+        item_codes = self.catalog.get_indexer(holdout_df['ITEM_ID'].astype(str))
+
+        self.truth_keys = np.unique(query_codes.astype(np.int64) * len(self.catalog) + item_codes)
+        self.n_relevant = np.bincount(self.truth_keys // len(self.catalog), minlength=len(queries))
+
+        # The context of a query is taken from its first holdout interaction
+        first_rows = holdout_df.groupby(query_codes).head(1)
+        self.contexts = first_rows[[col for col in ['CENTER_NAME', 'SERVICE_LENGTH'] if col in first_rows.columns]]
+        logger.info(f"Evaluator: {len(queries)} queries | {len(self.truth_keys)} relevant pairs | k={self.k}")
+
+    def recommend(self, recommender, batch_size=100000):
+        """
+        Get the top-k item IDs of every query
+
+        :param recommender: object, the recommender
+        :param batch_size: int, the number of queries per recommend_batch call
+        :return: np.ndarray, (n_queries, k) item IDs, None where a list is shorter than k
+        """
+        user_ids = self.queries.get_level_values(0)
+        massage_names = self.queries.get_level_values(1)
+
+        if hasattr(recommender, 'recommend_batch'):
+            batches = []
+            for start in range(0, len(self.queries), batch_size):
+                item_ids, _ = recommender.recommend_batch(
+                    user_ids[start:start + batch_size], massage_names[start:start + batch_size], self.k
+                )
+                batches.append(item_ids)
+            recommended = np.concatenate(batches) if batches else np.empty((0, self.k), dtype=object)
+            if recommended.shape[1] < self.k:
+                padding = np.full((len(recommended), self.k - recommended.shape[1]), None, dtype=object)
+                recommended = np.hstack([recommended, padding])
+            return recommended
+
+        recommended = np.full((len(self.queries), self.k), None, dtype=object)
+        contexts = self.contexts.astype(str).to_dict('records')
+        for i, (user_id, massage_name) in enumerate(zip(user_ids, massage_names)):
+            context = {'MASSAGE_NAME': massage_name, **contexts[i]}
+            item_list = recommender.get_recommendations(None, user_id, context, self.k, return_item_metadata=False)
+            item_ids = [item['itemId'] for item in item_list[:self.k]]
+            recommended[i, :len(item_ids)] = item_ids
+        return recommended
+
+    def compute_metrics(self, recommended):
+        """
+        Compute precision@k, recall@k, NDCG@k, hit rate and catalog coverage
+
+        :param recommended: np.ndarray, (n_queries, k) item IDs
+        :return: dict, the metrics
+        """
+        n_items = len(self.catalog)
+        codes = self.catalog.get_indexer(pd.Index(recommended.ravel()).astype(str)).reshape(recommended.shape)
+        valid = (codes >= 0) & pd.notnull(recommended)
+
+        keys = np.arange(len(self.queries), dtype=np.int64)[:, None] * n_items + codes
+        hits = np.isin(keys, self.truth_keys) & valid
+
+        n_hits = hits.sum(axis=1)
+        discounts = 1.0 / np.log2(np.arange(2, self.k + 2))
+        dcg = (hits * discounts).sum(axis=1)
+        ideal = np.cumsum(discounts)[np.clip(np.minimum(self.n_relevant, self.k), 1, None) - 1]
+
+        return {
+            f'precision_at_{self.k}': float(np.mean(n_hits / self.k)),
+            f'recall_at_{self.k}': float(np.mean(n_hits / np.maximum(self.n_relevant, 1))),
+            f'ndcg_at_{self.k}': float(np.mean(dcg / ideal)),
+            f'hit_rate_at_{self.k}': float(np.mean(n_hits > 0)),
+            'coverage': float(len(np.unique(codes[valid])) / max(n_items, 1)),
+            'n_queries': int(len(self.queries)),
+        }
+
+    def evaluate(self, recommender, name=None):
+        """
+        Score a recommender on the holdout
+
+        :param recommender: object, the recommender exposing get_recommendations
+        :param name: str, the name in the report. Default: the class name
+        :return: dict, the metrics and timings
+        """
+        name = name or type(recommender).__name__
+        start_time = time.time()
+        recommended = self.recommend(recommender)
+        recommend_seconds = time.time() - start_time
+
+        start_time = time.time()
+        metrics = self.compute_metrics(recommended)
+        metrics['recommend_seconds'] = recommend_seconds
+        metrics['metrics_seconds'] = time.time() - start_time
+
+        logger.info(f"Evaluation {name}: {metrics}")
+        return {'name': name, **metrics}
+
+    def evaluate_all(self, recommenders, report_path=None, **report_info):
+        """
+        Score several recommenders and write the JSON report
+
+        :param recommenders: dict, name -> recommender
+        :param report_path: str, the JSON report path. Default: None, no file written
+        :param report_info: extra fields of the report, e.g. the split cutoff
+        :return: dict, the report
+        """
+        report = {
+            'created_at': int(time.time()),
+            'k': self.k,
+            'n_queries': int(len(self.queries)),
+            'catalog_size': int(len(self.catalog)),
+            **report_info,
+            'results': [self.evaluate(recommender, name) for name, recommender in recommenders.items()],
+        }
+
+        if report_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Evaluation report written to {report_path}")
+
+        return report
@@ -0,0 +1,270 @@
+import json
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from botocore.exceptions import BotoCoreError, ClientError, ParamValidationError
+
+from config.config import settings
+from config.log_config import logger
+from helpers.connection import connect_to_personalize_events
+
+MAX_BATCH_SIZE = 10  # PutEvents accepts at most 10 events per call
+RETRYABLE_ERROR_CODES = {
+    'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException',
+    'InternalFailure', 'InternalServerError', 'RequestTimeout', 'RequestTimeoutException',
+}
+
+
+class EventWriter:
+    """
+    Stream booking events to a Personalize event tracker, so new interactions reach the model
+    without waiting for the next full import of interaction.csv.
+
+    `record_booking` only puts the event on a bounded queue. A background thread drains it, groups the
+    events by (user, session) as PutEvents requires, and sends them in batches of 10. Throttling and
+    server errors are retried with exponential backoff. When the queue is full, callers wait at most
+    `put_timeout` seconds and the event is dropped, so a slow endpoint never holds up the caller
+    or grows the memory.
+    """
+
+    def __init__(self, tracking_id, personalize_events_client=None, profile_name=None, endpoint_url=None,
+                 max_queue_size=10000, put_timeout=0.1, flush_interval=1.0, max_drain_size=500,
+                 max_retries=5, backoff_base=0.1, backoff_max=5.0):
+        """
+        :param tracking_id: str, the tracking ID of the event tracker
+        :param personalize_events_client: object, a personalize events client. Default: None, connect with
+                                          `profile_name` and `endpoint_url`
+        :param profile_name: str, profile name in ~/.aws/credentials
+        :param endpoint_url: str, a custom endpoint, e.g. a local stub. Default: None, the AWS endpoint
+        :param max_queue_size: int, the maximum number of buffered events
+        :param put_timeout: float, seconds a caller waits for room in a full queue before the event is dropped
+        :param flush_interval: float, the maximum number of seconds an event waits to be sent
+        :param max_drain_size: int, the maximum number of events taken off the queue per send round
+        :param max_retries: int, the number of retries of a failed batch before it is dropped
+        :param backoff_base: float, the first retry delay in seconds, doubled on every retry
+        :param backoff_max: float, the maximum retry delay in seconds
+        """
+        self.tracking_id = tracking_id
+        self.personalize_events_client = personalize_events_client or connect_to_personalize_events(
+            profile_name=profile_name, endpoint_url=endpoint_url
+        )
+        self.put_timeout = put_timeout
+        self.flush_interval = flush_interval
+        self.max_drain_size = max_drain_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.counters = {'events_queued': 0, 'events_sent': 0, 'events_dropped': 0, 'events_failed': 0,
+                         'batches_sent': 0, 'retries': 0}
+        self._counters_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='event-writer', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_event_tracker_file(cls, path=None, **kwargs):
+        """
+        Create a writer for the event tracker saved by TrainPipeline
+
+        :param path: str, the event tracker file. Default: settings.EVENT_TRACKER_PATH
+        :param kwargs: the EventWriter parameters
+        :return: EventWriter
+        """
+        with open(path or settings.EVENT_TRACKER_PATH) as f:
+            event_tracker = json.load(f)
+        return cls(event_tracker['trackingId'], **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _count(self, name, value=1):
+        with self._counters_lock:
+            self.counters[name] += value
+
+    @staticmethod
+    def build_event(item_id, timestamp, service_length=None, massage_name=None, center_name=None,
+                    event_type='purchase'):
+        """
+        Build a PutEvents event from the fields of the interaction schema.
+        USER_ID is sent once per batch, TIMESTAMP becomes sentAt and EVENT_TYPE becomes eventType,
+        the other fields go to the properties under their camelCase names.
+
+        :param item_id: str, the ITEM_ID
+        :param timestamp: int | datetime, the TIMESTAMP, unix seconds
+        :param service_length: float, the SERVICE_LENGTH
+        :param massage_name: str, the MASSAGE_NAME
+        :param center_name: str, the CENTER_NAME
+        :param event_type: str, the EVENT_TYPE
+        :return: dict, the event
+        """
+        if not isinstance(timestamp, datetime):
+            timestamp = datetime.fromtimestamp(int(timestamp), tz=timezone.utc)
+
+        properties = {
+            'serviceLength': float(service_length) if service_length is not None else None,
+            'massageName': massage_name,
+            'centerName': center_name,
+        }
+        return {
+            'eventType': event_type,
+            'sentAt': timestamp,
+            'itemId': str(item_id),
+            'properties': json.dumps({key: value for key, value in properties.items() if value is not None}),
+        }
+
+    def record_booking(self, user_id, item_id, timestamp, service_length=None, massage_name=None, center_name=None,
+                       event_type='purchase', session_id=None):
+        """
+        Buffer one booking event
+
+        :param user_id: str, the USER_ID
+        :param item_id: str, the ITEM_ID
+        :param timestamp: int | datetime, the TIMESTAMP, unix seconds
+        :param service_length: float, the SERVICE_LENGTH
+        :param massage_name: str, the MASSAGE_NAME
+        :param center_name: str, the CENTER_NAME
+        :param event_type: str, the EVENT_TYPE
+        :param session_id: str, the session ID. Default: None, the user ID
+        :return: bool, False when the event was dropped because the queue stayed full
+        """
+        event = self.build_event(item_id, timestamp, service_length, massage_name, center_name, event_type)
+        return self.put_event(str(user_id), str(session_id or user_id), event)
+
+    def put_event(self, user_id, session_id, event):
+        """
+        Buffer one PutEvents event
+
+        :param user_id: str, the user ID
+        :param session_id: str, the session ID
+        :param event: dict, the event, see `build_event`
+        :return: bool, False when the event was dropped because the queue stayed full
+        """
+        if self._stop_event.is_set():
+            raise RuntimeError("The event writer is closed")
+        try:
+            self.queue.put((user_id, session_id, event), timeout=self.put_timeout)
+        except queue.Full:
+            self._count('events_dropped')
+            return False
+        self._count('events_queued')
+        return True
+
+    def _drain(self):
+        """
+        Take the events off the queue until `flush_interval` is over or `max_drain_size` events are taken
+        """
+        events = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(events) < self.max_drain_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout <= 0 or self._stop_event.is_set():
+                    events.append(self.queue.get_nowait())
+                else:
+                    events.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return events
+
+    def _run(self):
+        while not (self._stop_event.is_set() and self.queue.empty()):
+            events = self._drain()
+            if not events:
+                continue
+
+            try:
+                # PutEvents takes the events of one user and session per call
+                batches = {}
+                for user_id, session_id, event in events:
+                    batches.setdefault((user_id, session_id), []).append(event)
+                for (user_id, session_id), user_events in batches.items():
+                    for start in range(0, len(user_events), MAX_BATCH_SIZE):
+                        batch = user_events[start:start + MAX_BATCH_SIZE]
+                        # A bad batch is dropped, the thread keeps sending the others
+                        try:
+                            self._send(user_id, session_id, batch)
+                        except Exception:
+                            logger.exception(f"Dropped {len(batch)} events of user {user_id}")
+                            self._count('events_failed', len(batch))
+            finally:
+                # flush() waits for every event taken off the queue
+                for _ in events:
+                    self.queue.task_done()
+
+    def _send(self, user_id, session_id, events):
+        """
+        Send one batch, retrying throttling and server errors with exponential backoff and jitter
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.personalize_events_client.put_events(
+                    trackingId=self.tracking_id,
+                    userId=user_id,
+                    sessionId=session_id,
+                    eventList=events
+                )
+                self._count('events_sent', len(events))
+                self._count('batches_sent')
+                return True
+            except ClientError as e:
+                error_code = e.response['Error']['Code']
+                if error_code not in RETRYABLE_ERROR_CODES:
+                    logger.error(f"Dropped {len(events)} events of user {user_id}: {e}")
+                    break
+                error = e
+            except ParamValidationError as e:
+                # The events themselves are invalid, sending them again fails the same way
+                logger.error(f"Dropped {len(events)} invalid events of user {user_id}: {e}")
+                break
+            except BotoCoreError as e:
+                error = e
+
+            if attempt == self.max_retries:
+                logger.error(f"Dropped {len(events)} events of user {user_id} after {attempt + 1} attempts: {error}")
+                break
+
+            self._count('retries')
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+
+        self._count('events_failed', len(events))
+        return False
+
+    def flush(self, timeout=None):
+        """
+        Wait until every buffered event is sent or dropped
+
+        :param timeout: float, the maximum number of seconds to wait. Default: None, no limit
+        :return: bool, whether the queue was fully processed
+        """
+        end_time = time.monotonic() + timeout if timeout is not None else None
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if end_time is None else end_time - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Send the buffered events and stop the background thread
+
+        :param timeout: float, the maximum number of seconds to wait. Default: None, no limit
+        :return: None
+        """
+        self._stop_event.set()
+        self._thread.join(timeout)
+        logger.info(f"Event writer closed: {self.snapshot()}")
+
+    def snapshot(self):
+        with self._counters_lock:
+            return {**self.counters, 'queue_size': self.queue.qsize()}
@@ -0,0 +1,100 @@
+import json
+import os
+
+from config.log_config import logger
+
+
+class ItemCatalog:
+    """
+    In-memory ITEM_ID -> ITEM_NAME catalog built from `DatasetBuilder.build_item_dataset`.
+
+    With a catalog, `Inference` requests bare item IDs from the campaign and joins the names locally,
+    so the campaign doesn't have to return metadata columns.
+    The catalog is saved with the campaign and solution version it was built for, and the shard campaigns
+    trained with them, see `covers`.
+    """
+
+    def __init__(self, item_names, campaign_arn=None, solution_version_arn=None, shard_campaign_arns=None):
+        """
+        :param item_names: dict, ITEM_ID -> ITEM_NAME
+        :param campaign_arn: str, the campaign the catalog was deployed with
+        :param solution_version_arn: str, the solution version the catalog was deployed with
+        :param shard_campaign_arns: list, the shard campaigns trained on the same items. Default: None
+        """
+        self.item_names = item_names
+        self.campaign_arn = campaign_arn
+        self.solution_version_arn = solution_version_arn
+        self.shard_campaign_arns = list(shard_campaign_arns or [])
+
+    def __len__(self):
+        return len(self.item_names)
+
+    def covers(self, campaign_arn):
+        """
+        Whether the catalog was deployed with a campaign, an unversioned catalog covers every campaign
+
+        :param campaign_arn: str, the campaign ARN
+        :return: bool
+        """
+        if self.campaign_arn is None:
+            return True
+        return campaign_arn == self.campaign_arn or campaign_arn in self.shard_campaign_arns
+
+    @classmethod
+    def from_item_dataset(cls, item_df, campaign_arn=None, solution_version_arn=None):
+        """
+        Build the catalog from the item dataset
+
+        :param item_df: pd.DataFrame, the item dataset with ITEM_ID and ITEM_NAME columns
+        :param campaign_arn: str, the campaign ARN
+        :param solution_version_arn: str, the solution version ARN
+        :return: ItemCatalog
+        """
+        item_names = dict(zip(item_df['ITEM_ID'].astype(str), item_df['ITEM_NAME'].fillna('').astype(str)))
+        return cls(item_names, campaign_arn=campaign_arn, solution_version_arn=solution_version_arn)
+
+    def save(self, path):
+        """
+        Save the catalog to a JSON file, atomically replacing the previous version
+
+        :param path: str, the file path
+        :return: None
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({
+                'campaign_arn': self.campaign_arn,
+                'solution_version_arn': self.solution_version_arn,
+                'shard_campaign_arns': self.shard_campaign_arns,
+                'items': self.item_names,
+            }, f)
+        os.replace(f'{path}.tmp', path)
+        logger.info(f"Item catalog with {len(self)} items saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a catalog saved with `save`
+
+        :param path: str, the file path
+        :return: ItemCatalog
+        """
+        with open(path) as f:
+            data = json.load(f)
+
+        logger.info(f"Loaded item catalog with {len(data['items'])} items "
+                    f"for solution version {data['solution_version_arn']}")
+        return cls(data['items'], campaign_arn=data['campaign_arn'],
+                   solution_version_arn=data['solution_version_arn'],
+                   shard_campaign_arns=data.get('shard_campaign_arns'))
+
+    def attach_metadata(self, item_list):
+        """
+        Add the ITEM_NAME metadata to an item list, in the runtime response format
+
+        :param item_list: list, the items with an 'itemId' key
+        :return: list, the same items with metadata
+        """
+        for item in item_list:
+            item['metadata'] = {'item_name': self.item_names.get(item['itemId'], '')}
+        return item_list
@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from helpers.metrics import LatencyHistogram
+from recommender.pipeline_inference import Inference
+from recommender.serving import RecommendationServer
+
+
+class StubPersonalizeRuntime:
+    """
+    Local stand-in for the personalize-runtime client with a configurable response latency
+    """
+
+    def __init__(self, latency=0.03, jitter=0.01, n_items=30):
+        self.latency = latency
+        self.jitter = jitter
+        self.item_ids = [f'ENH{i:03d}' for i in range(n_items)]
+
+    def get_recommendations(self, campaignArn, userId, numResults=25, context=None, metadataColumns=None, **kwargs):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        rng = random.Random(f'{userId}{json.dumps(context, sort_keys=True)}')
+        item_ids = rng.sample(self.item_ids, min(numResults, len(self.item_ids)))
+
+        item_list = []
+        for rank, item_id in enumerate(item_ids):
+            item = {'itemId': item_id, 'score': 1.0 / (rank + 1)}
+            if metadataColumns:
+                item['metadata'] = {'item_name': f'Enhancement {item_id}'}
+            item_list.append(item)
+        return {'itemList': item_list, 'recommendationId': f'RID-{userId}'}
+
+
+async def request(reader, writer, path, payload=None):
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    method = 'POST' if payload is not None else 'GET'
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+
+async def run_load_test(host, port, n_requests=2000, concurrency=64, n_users=500, massages=None):
+    """
+    Send recommendation requests from `concurrency` keep-alive connections
+
+    :param host: str, the server host
+    :param port: int, the server port
+    :param n_requests: int, the total number of requests
+    :param concurrency: int, the number of concurrent connections
+    :param n_users: int, the number of distinct users, smaller values give more coalescing and cache hits
+    :param massages: list, the massage names drawn for the context
+    :return: dict, the client-side latency summary and the server metrics
+    """
+    massages = massages or ['The NOW 50', 'The NOW 80', 'Deep Tissue 50']
+    latency = LatencyHistogram()
+    statuses = {}
+    remaining = iter(range(n_requests))
+
+    async def worker():
+        reader, writer = await asyncio.open_connection(host, port)
+        for _ in remaining:
+            payload = {
+                'user_id': f'user-{random.randrange(n_users)}',
+                'context': {'MASSAGE_NAME': random.choice(massages), 'CENTER_NAME': 'Roswell'},
+            }
+            start_time = time.perf_counter()
+            status, _ = await request(reader, writer, '/recommendations', payload)
+            latency.observe(time.perf_counter() - start_time)
+            statuses[status] = statuses.get(status, 0) + 1
+        writer.close()
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start_time
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, server_metrics = await request(reader, writer, '/metrics')
+    writer.close()
+
+    return {
+        'requests': n_requests,
+        'seconds': elapsed,
+        'throughput_rps': n_requests / elapsed,
+        'statuses': statuses,
+        'client_latency': latency.snapshot(),
+        'server_metrics': server_metrics,
+    }
+
+
+async def run_against_stub(args):
+    runtime = StubPersonalizeRuntime(latency=args.stub_latency, jitter=args.stub_jitter)
+    inference = Inference(personalize_runtime_client=runtime)
+    # The stub traffic is not real traffic, it stays out of the request rate history of the capacity planner
+    server = RecommendationServer(
+        inference, campaign_arn='arn:aws:personalize:stub:campaign/stub', host='127.0.0.1', port=0,
+        max_workers=args.max_workers, cache_ttl=args.cache_ttl, rate_export_interval=0
+    )
+    await server.start()
+    try:
+        return await run_load_test('127.0.0.1', server.port, args.requests, args.concurrency, args.users)
+    finally:
+        await server.stop()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Load test the recommendation server")
+    parser.add_argument('--host', default=None, help="Target server, default: a local server with a stub runtime")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--max-workers', type=int, default=16)
+    parser.add_argument('--cache-ttl', type=float, default=30.0)
+    parser.add_argument('--stub-latency', type=float, default=0.03)
+    parser.add_argument('--stub-jitter', type=float, default=0.01)
+    args = parser.parse_args(args)
+
+    if args.host is None:
+        result = asyncio.run(run_against_stub(args))
+    else:
+        result = asyncio.run(run_load_test(args.host, args.port, args.requests, args.concurrency, args.users))
+
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == '__main__':
+    main()
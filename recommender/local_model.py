@@ -0,0 +1,263 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from config.log_config import logger
+
+
+class LocalRecommender:
+    """
+    Local CPU implicit-feedback recommender trained on the DatasetBuilder interaction, user and item datasets.
+    It is a fast iteration loop and a baseline for the Personalize solutions.
+
+    The training matrix has one row per user and one column per item plus one column per massage,
+    so the chosen massage (context MASSAGE_NAME) is scored in the same space as the items:
+        - 'item_item': cosine similarity between the columns
+        - 'als': implicit ALS (Hu, Koren, Volinsky 2008), solved in blocks of users on a thread pool
+
+    It exposes the same `get_recommendations` interface as `Inference`.
+    """
+
+    def __init__(self, algorithm='item_item', factors=32, regularization=0.1, alpha=10.0, iterations=10,
+                 context_weight=1.0, block_size=2048, n_jobs=None, random_state=42):
+        """
+        :param algorithm: str, 'item_item'|'als'. Default: 'item_item'
+        :param factors: int, the number of ALS latent factors
+        :param regularization: float, the ALS L2 regularization
+        :param alpha: float, the ALS confidence scaling, c = 1 + alpha * log1p(count)
+        :param iterations: int, the number of ALS iterations
+        :param context_weight: float, the weight of the chosen massage in the score
+        :param block_size: int, the number of users solved together in one ALS block
+        :param n_jobs: int, the number of threads. Default: os.cpu_count()
+        :param random_state: int, the seed of the ALS initialization
+        """
+        if algorithm not in ('item_item', 'als'):
+            raise ValueError(f"Unknown algorithm {algorithm}")
+
+        self.algorithm = algorithm
+        self.factors = factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self.iterations = iterations
+        self.context_weight = context_weight
+        self.block_size = block_size
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.random_state = random_state
+
+        self.user_index = None
+        self.item_ids = None
+        self.item_names = None
+        self.massage_index = None
+        self.user_items = None
+        self.popularity = None
+        self.similarity = None
+        self.user_factors = None
+        self.column_factors = None
+
+    def fit(self, interaction_df, user_df=None, item_df=None):
+        """
+        Fit the model
+
+        :param interaction_df: pd.DataFrame, the output of DatasetBuilder.build_interaction_dataset
+        :param user_df: pd.DataFrame, the output of DatasetBuilder.build_user_dataset, adds users without
+                        interactions to the index. Default: None
+        :param item_df: pd.DataFrame, the output of DatasetBuilder.build_item_dataset, gives the item names.
+                        Default: None
+        :return: LocalRecommender, self
+        """
+        start_time = time.time()
+        logger.info(f"Fitting local {self.algorithm} model on {len(interaction_df)} interactions...")
+
+        user_ids = pd.Index(interaction_df['USER_ID'].astype(str).unique())
+        if user_df is not None:
+            user_ids = user_ids.append(pd.Index(user_df['USER_ID'].astype(str))).unique()
+        self.user_index = user_ids
+
+        item_ids = pd.Index(interaction_df['ITEM_ID'].astype(str).unique())
+        if item_df is not None:
+            item_ids = item_ids.append(pd.Index(item_df['ITEM_ID'].astype(str))).unique()
+        self.item_ids = np.asarray(item_ids, dtype=object)
+
+        self.item_names = self.item_ids.copy()
+        if item_df is not None:
+            names = item_df.assign(ITEM_ID=item_df['ITEM_ID'].astype(str)).drop_duplicates('ITEM_ID') \
+                .set_index('ITEM_ID')['ITEM_NAME']
+            self.item_names = names.reindex(item_ids).fillna('').astype(str).to_numpy(dtype=object)
+
+        self.massage_index = pd.Index(interaction_df['MASSAGE_NAME'].astype(str).unique())
+
+        n_users, n_items = len(self.user_index), len(self.item_ids)
+        n_columns = n_items + len(self.massage_index)
+        rows = np.concatenate([
+            self.user_index.get_indexer(interaction_df['USER_ID'].astype(str)),
+            self.user_index.get_indexer(interaction_df['USER_ID'].astype(str)),
+        ])
+        columns = np.concatenate([
+            item_ids.get_indexer(interaction_df['ITEM_ID'].astype(str)),
+            n_items + self.massage_index.get_indexer(interaction_df['MASSAGE_NAME'].astype(str)),
+        ])
+        # Duplicates are summed into purchase counts
+        counts = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(n_users, n_columns)
+        )
+        counts.sum_duplicates()
+
+        self.user_items = counts
+        self.popularity = np.asarray(counts[:, :n_items].sum(axis=0)).ravel()
+        self.popularity = self.popularity / max(self.popularity.max(), 1.0)
+
+        if self.algorithm == 'item_item':
+            self._fit_item_item(counts)
+        else:
+            self._fit_als(counts)
+
+        logger.info(f"Fitted local {self.algorithm} model in {time.time() - start_time:.2f}s "
+                    f"| users {n_users} | items {n_items} | massages {len(self.massage_index)}")
+        return self
+
+    def _fit_item_item(self, counts):
+        n_items = len(self.item_ids)
+        weights = counts.copy()
+        weights.data = np.log1p(weights.data)
+
+        norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=0)).ravel())
+        norms[norms == 0] = 1.0
+        normalized = weights @ sparse.diags(1.0 / norms)
+
+        # Columns x items, dense: the number of items and massages is small
+        similarity = (normalized.T @ normalized[:, :n_items]).toarray().astype(np.float32)
+        np.fill_diagonal(similarity[:n_items], 0.0)
+        self.similarity = similarity
+
+    def _fit_als(self, counts):
+        rng = np.random.default_rng(self.random_state)
+        n_users, n_columns = counts.shape
+
+        confidence = counts.copy()
+        confidence.data = self.alpha * np.log1p(confidence.data)
+        confidence_t = confidence.T.tocsr()
+
+        self.user_factors = np.zeros((n_users, self.factors), dtype=np.float32)
+        self.column_factors = (rng.standard_normal((n_columns, self.factors)) * 0.01).astype(np.float32)
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            for iteration in range(self.iterations):
+                self.user_factors = self._als_step(confidence, self.column_factors, executor)
+                self.column_factors = self._als_step(confidence_t, self.user_factors, executor)
+                logger.info(f"ALS iteration {iteration + 1}/{self.iterations}")
+
+    def _als_step(self, confidence, fixed, executor):
+        """
+        Solve all rows of `confidence` against the fixed factors Y:
+            (YtY + Yt (C_u - I) Y + reg I) x_u = Yt C_u p_u, where (C_u - I) is the confidence row, p_u = 1 on non-zeros
+        """
+        n_rows, n_fixed = confidence.shape
+        gram = fixed.T @ fixed + self.regularization * np.eye(self.factors, dtype=np.float32)
+        solved = np.zeros((n_rows, self.factors), dtype=np.float32)
+
+        # When the fixed side is small (items and massages), the weighted outer products of a whole block
+        # are one sparse matmul, otherwise (users) they are accumulated row by row with BLAS
+        outer = None
+        if n_fixed * self.factors ** 2 <= 2 ** 26:
+            outer = (fixed[:, :, None] * fixed[:, None, :]).reshape(n_fixed, -1)
+
+        def solve_block(start):
+            block = confidence[start:start + self.block_size]
+            if outer is not None:
+                lhs = gram + (block @ outer).reshape(-1, self.factors, self.factors)
+            else:
+                lhs = np.empty((block.shape[0], self.factors, self.factors), dtype=np.float32)
+                for row in range(block.shape[0]):
+                    row_slice = slice(block.indptr[row], block.indptr[row + 1])
+                    y = fixed[block.indices[row_slice]]
+                    lhs[row] = gram + (y * block.data[row_slice, None]).T @ y
+
+            weights = block.copy()
+            weights.data = 1.0 + weights.data
+            rhs = weights @ fixed
+
+            solved[start:start + self.block_size] = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+
+        list(executor.map(solve_block, range(0, n_rows, self.block_size)))
+        return solved
+
+    def score(self, user_ids, massage_names=None):
+        """
+        Score all items for a batch of users
+
+        :param user_ids: list, the user IDs, unknown users only get the context and popularity scores
+        :param massage_names: list, the chosen massage per user. Default: None
+        :return: np.ndarray, (n_users, n_items) scores
+        """
+        n_items = len(self.item_ids)
+        user_rows = self.user_index.get_indexer(pd.Index(user_ids).astype(str))
+        known = user_rows >= 0
+
+        scores = np.zeros((len(user_ids), n_items), dtype=np.float32)
+        if self.algorithm == 'item_item':
+            if known.any():
+                scores[known] = (self.user_items[user_rows[known]] @ self.similarity).astype(np.float32)
+        elif known.any():
+            scores[known] = self.user_factors[user_rows[known]] @ self.column_factors[:n_items].T
+
+        if massage_names is not None:
+            massage_rows = self.massage_index.get_indexer(pd.Index(massage_names).astype(str))
+            has_massage = massage_rows >= 0
+            if has_massage.any():
+                if self.algorithm == 'item_item':
+                    context = self.similarity[n_items + massage_rows[has_massage]]
+                else:
+                    context = self.column_factors[n_items + massage_rows[has_massage]] @ \
+                        self.column_factors[:n_items].T
+                scores[has_massage] += self.context_weight * context
+
+        # Popularity breaks ties, and is the whole score for cold users without context
+        scores += 1e-3 * self.popularity.astype(np.float32)
+        return scores
+
+    def recommend_batch(self, user_ids, massage_names=None, num_results=5):
+        """
+        Get the top items for a batch of users
+
+        :param user_ids: list, the user IDs
+        :param massage_names: list, the chosen massage per user. Default: None
+        :param num_results: int, the number of results
+        :return: (np.ndarray, np.ndarray), the (n_users, num_results) item IDs and scores, best first
+        """
+        scores = self.score(user_ids, massage_names)
+        num_results = min(num_results, scores.shape[1])
+        top = np.argpartition(-scores, num_results - 1, axis=1)[:, :num_results]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        return self.item_ids[top], np.take_along_axis(top_scores, order, axis=1)
+
+    def get_recommendations(self, campaign_arn, user_id, context, num_results=5, return_item_metadata=True):
+        """
+        Get recommendations with the same interface and response format as `Inference.get_recommendations`.
+        The campaign ARN is not used.
+
+        :param campaign_arn: str, the campaign ARN
+        :param user_id: str, the user ID
+        :param context: dict, the context
+        :param num_results: int, the number of results
+        :param return_item_metadata: bool, whether to return item metadata. Default: True
+        :return: list, the recommendations
+        """
+        massage_name = context.get('MASSAGE_NAME') if context else None
+        scores = self.score([user_id], [massage_name] if massage_name is not None else None)[0]
+        num_results = min(num_results, len(scores))
+        top = np.argpartition(-scores, num_results - 1)[:num_results]
+        top = top[np.argsort(-scores[top])]
+
+        item_list = []
+        for code in top:
+            item = {'itemId': self.item_ids[code], 'score': float(scores[code])}
+            if return_item_metadata:
+                item['metadata'] = {'item_name': self.item_names[code]}
+            item_list.append(item)
+        return item_list
@@ -1,9 +1,18 @@
+import hashlib
+import os
 import time
 import json
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import BotoCoreError, ClientError
 from config.config import settings
 from config.log_config import logger
-from helpers.connection import (connect_to_personalize, connect_to_iam_resource, connect_to_s3_client)
+from helpers.connection import (connect_to_personalize, connect_to_iam_resource, connect_to_s3_client,
+                                connect_to_personalize_runtime)
+from helpers.aws_data_ops import list_s3_keys, read_s3_object
+from helpers.metrics import LatencyHistogram
+from recommender.capacity_planner import CapacityPlanner, load_request_rates
+
+DATA_FINGERPRINT_TAG = 'data-fingerprint'
 
 
 class Personalization:
@@ -11,7 +20,18 @@ class Personalization:
     Set up the AWS Personalize service
     Train and deploy the recommendation model
     """
-    def __init__(self, profile_name=None):
+    def __init__(self, profile_name=None, poll_interval=None, iam_propagation_delay=None):
+        """
+        :param profile_name: str, the profile name in ~/.aws/credentials
+        :param poll_interval: float, seconds between two status checks of a resource being created.
+                              Default: None, settings.PERSONALIZE_POLL_INTERVAL
+        :param iam_propagation_delay: float, seconds to wait after creating the IAM role.
+                                      Default: None, settings.IAM_PROPAGATION_DELAY
+        """
+        self.profile_name = profile_name
+        self.poll_interval = poll_interval if poll_interval is not None else settings.PERSONALIZE_POLL_INTERVAL
+        self.iam_propagation_delay = (iam_propagation_delay if iam_propagation_delay is not None
+                                      else settings.IAM_PROPAGATION_DELAY)
         self.s3_client = connect_to_s3_client(profile_name=profile_name)
         self.personalize_client = connect_to_personalize(profile_name=profile_name)
         self.iam_resource = connect_to_iam_resource(profile_name=profile_name)
@@ -136,7 +156,7 @@ class Personalization:
                     policy_arn,
                 )
         logger.info("Giving AWS time to create resources...")
-        time.sleep(10)
+        time.sleep(self.iam_propagation_delay)
         return role
 
     def create_dataset_group(self, name):
@@ -169,7 +189,7 @@ class Personalization:
             if status == "ACTIVE" or status == "CREATE FAILED":
                 break
 
-            time.sleep(60)
+            time.sleep(self.poll_interval)
 
         return response['datasetGroupArn']
 
@@ -381,7 +401,7 @@ class Personalization:
             if status == "ACTIVE" or status == "CREATE FAILED":
                 break
 
-            time.sleep(60)
+            time.sleep(self.poll_interval)
 
     def import_interactions_data(self, dataset_arn, s3_data_path, import_mode='FULL'):
         """
@@ -459,8 +479,16 @@ class Personalization:
         return response['datasetImportJobArn']
 
     def wait_import_dataset(self, response):
+        """
+        Wait until a dataset import job is ACTIVE
+
+        :param response: dict, the create_dataset_import_job response
+        :return: str, the final status, ACTIVE
+        :raises RuntimeError: when the job failed or is still running after 3 hours
+        """
         # Wait for the dataset import job to be created
         max_time = time.time() + 3 * 60 * 60
+        status, dataset_import_job = None, {}
         while time.time() < max_time:
             describe_dataset_import_job_response = self.personalize_client.describe_dataset_import_job(
                 datasetImportJobArn=response['datasetImportJobArn']
@@ -477,14 +505,22 @@ class Personalization:
             if status == "ACTIVE" or status == "CREATE FAILED":
                 break
 
-            time.sleep(60)
+            time.sleep(self.poll_interval)
+
+        if status != "ACTIVE":
+            raise RuntimeError(f"Dataset import job {response['datasetImportJobArn']} is {status}: "
+                               f"{dataset_import_job.get('failureReason', 'timed out')}")
+        return status
 
     def create_solution(self, name, dataset_group_arn,
                         keep_previous_solution=True,
                         recipe_arn=None,
-                        perform_hpo=False, perform_auto_ml=False):
+                        perform_hpo=False, perform_auto_ml=False,
+                        data_fingerprint=None, force_retrain=False,
+                        solution_config=None):
         """
-        Create a solution
+        Create a solution and train a new solution version.
+        When an active version of the solution was trained on the same data fingerprint, it is reused.
 
         :param name: str, the name of the solution
         :param dataset_group_arn: str, the dataset group ARN
@@ -492,7 +528,11 @@ class Personalization:
         :param recipe_arn: str, the recipe ARN
         :param perform_hpo: bool, whether to perform hyperparameter optimization
         :param perform_auto_ml: bool, whether to perform autoML
-        :return: str, the solution ARN
+        :param data_fingerprint: str, the fingerprint of the imported data, tagged on the solution version.
+                                 Default: None, always train
+        :param force_retrain: bool, whether to train even when a version matches the fingerprint. Default: False
+        :param solution_config: dict, the solutionConfig of the recipe, e.g. its hyperparameters. Default: None
+        :return: str, the solution version ARN
         """
         logger.info("List recipes...")
         recipes = self.personalize_client.list_recipes()
@@ -530,24 +570,52 @@ class Personalization:
                         if status == "DELETE PENDING" or status == "DELETE FAILED":
                             break
 
-                        time.sleep(60)
+                        time.sleep(self.poll_interval)
                     logger.info(f"Deleted solution {solution['solutionArn']}")
 
         if not solution_arn:
             # Not found the solution, then create a new solution
+            solution_params = {'solutionConfig': solution_config} if solution_config else {}
             solution_response = self.personalize_client.create_solution(
                 name=name,
                 datasetGroupArn=dataset_group_arn,
                 recipeArn=recipe_arn,
                 performHPO=perform_hpo,
-                performAutoML=perform_auto_ml
+                performAutoML=perform_auto_ml,
+                **solution_params
             )
             solution_arn = solution_response['solutionArn']
             logger.info(f"Created solution {solution_arn}")
 
-        solution_version_response = self.personalize_client.create_solution_version(
-            solutionArn=solution_arn
-        )
+            # A solution version can only be created once the solution is ACTIVE
+            max_time = time.time() + 3 * 60 * 60  # 3 hours
+            while time.time() < max_time:
+                describe_solution_response = self.personalize_client.describe_solution(solutionArn=solution_arn)
+                status = describe_solution_response["solution"]["status"]
+                logger.info(f"Solution: {status}")
+
+                if status == "ACTIVE" or status == "CREATE FAILED":
+                    break
+
+                time.sleep(self.poll_interval)
+
+        if data_fingerprint is not None:
+            fingerprint = self.build_training_fingerprint(
+                data_fingerprint, recipe_arn, perform_hpo, perform_auto_ml, solution_config
+            )
+            if not force_retrain:
+                solution_version_arn = self.find_solution_version(solution_arn, fingerprint)
+                if solution_version_arn is not None:
+                    logger.info(f"Data unchanged since solution version {solution_version_arn}, skipping training")
+                    return solution_version_arn
+            solution_version_response = self.personalize_client.create_solution_version(
+                solutionArn=solution_arn,
+                tags=[{'tagKey': DATA_FINGERPRINT_TAG, 'tagValue': fingerprint}]
+            )
+        else:
+            solution_version_response = self.personalize_client.create_solution_version(
+                solutionArn=solution_arn
+            )
 
         # Wait for the solution version to be created
         max_time = time.time() + 3 * 60 * 60  # 3 hours
@@ -561,10 +629,133 @@ class Personalization:
             if status == "ACTIVE" or status == "CREATE FAILED":
                 break
 
-            time.sleep(60)
+            time.sleep(self.poll_interval)
 
         return solution_version_response['solutionVersionArn']
 
+    @staticmethod
+    def build_training_fingerprint(data_fingerprint, recipe_arn, perform_hpo, perform_auto_ml, solution_config=None):
+        """
+        Combine the data fingerprint with the training settings, a new recipe or setting needs a new version
+
+        :param data_fingerprint: str, the fingerprint of the imported data
+        :param recipe_arn: str, the recipe ARN
+        :param perform_hpo: bool, whether to perform hyperparameter optimization
+        :param perform_auto_ml: bool, whether to perform autoML
+        :param solution_config: dict, the solutionConfig of the recipe
+        :return: str, the hex digest tagged on the solution version
+        """
+        training_config = json.dumps({
+            'data': data_fingerprint,
+            'recipe_arn': recipe_arn,
+            'perform_hpo': perform_hpo,
+            'perform_auto_ml': perform_auto_ml,
+            'solution_config': solution_config,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(training_config.encode('utf-8')).hexdigest()
+
+    def find_solution_version(self, solution_arn, fingerprint):
+        """
+        Find the latest active solution version tagged with a training fingerprint
+
+        :param solution_arn: str, the solution ARN
+        :param fingerprint: str, the training fingerprint
+        :return: str | None, the solution version ARN, None when there is no match
+        """
+        response = self.personalize_client.list_solution_versions(solutionArn=solution_arn)
+        solution_versions = sorted(
+            response['solutionVersions'], key=lambda version: version['creationDateTime'], reverse=True
+        )
+        for solution_version in solution_versions:
+            if solution_version['status'] != 'ACTIVE':
+                continue
+            tags = self.personalize_client.list_tags_for_resource(
+                resourceArn=solution_version['solutionVersionArn']
+            )['tags']
+            for tag in tags:
+                if tag['tagKey'] == DATA_FINGERPRINT_TAG and tag['tagValue'] == fingerprint:
+                    return solution_version['solutionVersionArn']
+        return None
+
+    def train_solutions(self, solution_configs, dataset_group_arn, keep_previous_solution=True,
+                        data_fingerprint=None, force_retrain=False, max_workers=None):
+        """
+        Train one solution version per configuration concurrently and gather their metrics.
+        The trainings run on Personalize, the threads only wait for them, so the wall-clock time
+        is about the one of the longest training.
+
+        :param solution_configs: list, dicts with the `create_solution` parameters, at least `name`, e.g.
+                                 {'name': 'staging-massage-solution', 'recipe_arn': ..., 'perform_hpo': False,
+                                 'solution_config': {...}}
+        :param dataset_group_arn: str, the dataset group ARN
+        :param keep_previous_solution: bool, whether to keep the previous solutions. Default: True
+        :param data_fingerprint: str, the fingerprint of the imported data, see `create_solution`. Default: None
+        :param force_retrain: bool, whether to train even when a version matches the fingerprint. Default: False
+        :param max_workers: int, the number of concurrent trainings. Default: None, all of them
+        :return: dict, solution name -> {'solutionVersionArn', 'status', 'metrics'}, and the 'error' of a failed one
+        """
+        def train(solution_config):
+            solution_version_arn = self.create_solution(
+                dataset_group_arn=dataset_group_arn,
+                keep_previous_solution=keep_previous_solution,
+                data_fingerprint=data_fingerprint,
+                force_retrain=force_retrain,
+                **solution_config
+            )
+            status = self.personalize_client.describe_solution_version(
+                solutionVersionArn=solution_version_arn
+            )["solutionVersion"]["status"]
+            metrics = self.get_solution_metrics(solution_version_arn) if status == "ACTIVE" else {}
+            return {'solutionVersionArn': solution_version_arn, 'status': status, 'metrics': metrics}
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers or len(solution_configs)) as executor:
+            futures = {
+                executor.submit(train, solution_config): solution_config['name']
+                for solution_config in solution_configs
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    # One recipe failing, e.g. on a timeout, leaves the others to be selected from
+                    logger.exception(f"Training of solution {name} failed: {e!r}")
+                    results[name] = {'solutionVersionArn': None, 'status': 'CREATE FAILED', 'metrics': {},
+                                     'error': repr(e)}
+                logger.info(f"Solution {name}: {results[name]}")
+        return results
+
+    @staticmethod
+    def select_best_solution_version(results, metric='normalized_discounted_cumulative_gain_at_10'):
+        """
+        Select the active solution version with the highest metric.
+        A single active version, or several without the metric, are deployed anyway with a warning.
+
+        :param results: dict, the output of `train_solutions`
+        :param metric: str, the solution metric to maximize
+        :return: (str, str), the solution name and its solution version ARN
+        """
+        active = {
+            name: result for name, result in results.items()
+            if result['status'] == "ACTIVE" and result['solutionVersionArn'] is not None
+        }
+        if not active:
+            raise ValueError("No active solution version to deploy")
+
+        candidates = {name: result for name, result in active.items() if metric in result['metrics']}
+        if len(active) == 1 or not candidates:
+            name = min(active)
+            if metric not in active[name]['metrics']:
+                reason = 'the only active solution version' if len(active) == 1 else 'the first active one by name'
+                logger.warning(f"Solution {name} doesn't report the {metric} metric, deploying it as {reason}")
+            return name, active[name]['solutionVersionArn']
+
+        best_name = max(candidates, key=lambda name: candidates[name]['metrics'][metric])
+        logger.info(f"Best solution by {metric}: {best_name} "
+                    f"({candidates[best_name]['metrics'][metric]:.4f})")
+        return best_name, candidates[best_name]['solutionVersionArn']
+
     def get_solution_metrics(self, solution_version_arn):
         """
         Get solution metrics
@@ -577,13 +768,15 @@ class Personalization:
         )
         return response['metrics']
 
-    def create_campaign(self, name, solution_version_arn, min_provisioned_tps=2):
+    def create_campaign(self, name, solution_version_arn, min_provisioned_tps=2, enable_metadata=True):
         """
         Create a campaign
 
         :param name: str, the name of the campaign
         :param solution_version_arn: str, the solution version ARN
         :param min_provisioned_tps: int, the minimum provisioned transactions per second
+        :param enable_metadata: bool, whether the campaign can return item metadata. Not needed when Inference
+                                joins the names from a local ItemCatalog. Default: True
         :return: str, the campaign ARN
         """
         logger.info(f"Creating campaign {name}...")
@@ -598,9 +791,10 @@ class Personalization:
                     solutionVersionArn=solution_version_arn,
                     minProvisionedTPS=min_provisioned_tps,
                     campaignConfig={
-                        "enableMetadataWithRecommendations": True
+                        "enableMetadataWithRecommendations": enable_metadata
                     }
                 )
+                self.wait_campaign(campaign_arn)
                 logger.info(f"Updated campaign {campaign_arn}")
                 return campaign_arn
 
@@ -610,7 +804,7 @@ class Personalization:
             solutionVersionArn=solution_version_arn,
             minProvisionedTPS=min_provisioned_tps,
             campaignConfig={
-                "enableMetadataWithRecommendations": True
+                "enableMetadataWithRecommendations": enable_metadata
             }
         )
 
@@ -626,5 +820,267 @@ class Personalization:
             if status == "ACTIVE" or status == "CREATE FAILED":
                 break
 
-            time.sleep(60)
+            time.sleep(self.poll_interval)
         return response['campaignArn']
+
+    def create_event_tracker(self, name, dataset_group_arn):
+        """
+        Create an event tracker for the dataset group, or reuse the existing one.
+        A dataset group can only have one event tracker.
+
+        :param name: str, the name of the event tracker
+        :param dataset_group_arn: str, the dataset group ARN
+        :return: dict | None, the event tracker ARN and the tracking ID PutEvents calls are sent with,
+                 None when the event tracker didn't become ACTIVE
+        """
+        logger.info(f"Creating event tracker {name}...")
+
+        # Check if the event tracker already exists
+        event_trackers = self.personalize_client.list_event_trackers(datasetGroupArn=dataset_group_arn)
+        for event_tracker in event_trackers['eventTrackers']:
+            if event_tracker['name'] == name:
+                event_tracker_arn = event_tracker['eventTrackerArn']
+                break
+        else:
+            response = self.personalize_client.create_event_tracker(
+                name=name,
+                datasetGroupArn=dataset_group_arn
+            )
+            event_tracker_arn = response['eventTrackerArn']
+
+        # Wait for the event tracker to be created
+        max_time = time.time() + 3 * 60 * 60  # 3 hours
+        while time.time() < max_time:
+            describe_event_tracker_response = self.personalize_client.describe_event_tracker(
+                eventTrackerArn=event_tracker_arn
+            )
+            event_tracker = describe_event_tracker_response["eventTracker"]
+            status = event_tracker["status"]
+            logger.info(f"EventTracker: {status}")
+
+            if status == "ACTIVE" or status == "CREATE FAILED":
+                break
+
+            time.sleep(self.poll_interval)
+
+        # Only an ACTIVE event tracker has a tracking ID
+        if status != "ACTIVE":
+            logger.error(f"Event tracker {event_tracker_arn} is {status}: {event_tracker.get('failureReason')}, "
+                         f"booking events won't be streamed until it is deleted and created again")
+            return None
+        return {'eventTrackerArn': event_tracker_arn, 'trackingId': event_tracker['trackingId']}
+
+    def wait_campaign(self, campaign_arn):
+        """
+        Wait until a campaign and its latest update are ACTIVE
+
+        :param campaign_arn: str, the campaign ARN
+        :return: str, the final status
+        """
+        max_time = time.time() + 3 * 60 * 60  # 3 hours
+        while time.time() < max_time:
+            campaign = self.personalize_client.describe_campaign(campaignArn=campaign_arn)["campaign"]
+            status = campaign["status"]
+            # An update in progress shows in latestCampaignUpdate, the campaign itself stays ACTIVE
+            latest_update = campaign.get("latestCampaignUpdate")
+            if status == "ACTIVE" and latest_update is not None:
+                status = latest_update["status"]
+            logger.info(f"Campaign: {status}")
+
+            if status == "ACTIVE" or status.endswith("FAILED"):
+                return status
+
+            time.sleep(self.poll_interval)
+        return status
+
+    def shadow_compare(self, live_campaign_arn, candidate_campaign_arn, shadow_requests, num_results=5):
+        """
+        Send the same requests to the live and the candidate campaigns and compare them
+
+        :param live_campaign_arn: str, the live campaign ARN
+        :param candidate_campaign_arn: str, the candidate campaign ARN
+        :param shadow_requests: list, (user_id, context) pairs, e.g. a sample of recent bookings
+        :param num_results: int, the number of results per request
+        :return: dict, per campaign latency and errors, and the mean overlap of the two item lists
+        """
+        personalize_runtime_client = connect_to_personalize_runtime(profile_name=self.profile_name)
+        campaigns = {'live': live_campaign_arn, 'candidate': candidate_campaign_arn}
+        latencies = {role: LatencyHistogram() for role in campaigns}
+        errors = {role: 0 for role in campaigns}
+        agreements = []
+
+        for i, (user_id, context) in enumerate(shadow_requests):
+            # Alternate the order, so the second call doesn't always benefit from a warm connection
+            roles = list(campaigns) if i % 2 == 0 else list(reversed(list(campaigns)))
+            item_ids = {}
+            for role in roles:
+                start_time = time.perf_counter()
+                try:
+                    response = personalize_runtime_client.get_recommendations(
+                        campaignArn=campaigns[role], userId=user_id, numResults=num_results, context=context
+                    )
+                    item_ids[role] = [item['itemId'] for item in response['itemList']]
+                except (ClientError, BotoCoreError) as e:
+                    errors[role] += 1
+                    logger.warning(f"Shadow request to the {role} campaign failed: {e}")
+                latencies[role].observe(time.perf_counter() - start_time)
+
+            if len(item_ids) == 2:
+                agreements.append(len(set(item_ids['live']) & set(item_ids['candidate'])) / num_results)
+
+        report = {
+            role: {**latencies[role].snapshot(), 'errors': errors[role]} for role in campaigns
+        }
+        report['agreement'] = sum(agreements) / len(agreements) if agreements else 0.0
+        logger.info(f"Shadow comparison: {report}")
+        return report
+
+    def deploy_campaign_blue_green(self, name, solution_version_arn, campaign_pointer, shadow_requests=None,
+                                   min_provisioned_tps=2, enable_metadata=True, max_latency_ratio=1.5,
+                                   min_agreement=0.0, max_error_rate=0.0, num_results=5):
+        """
+        Deploy a solution version without touching the live campaign.
+        The version goes to the standby campaign of the `{name}-blue` / `{name}-green` pair, which is
+        checked against the live one with shadow requests. Only then the campaign pointer is switched,
+        the previous campaign stays up as the standby and for rollbacks.
+
+        :param name: str, the name prefix of the campaigns
+        :param solution_version_arn: str, the solution version ARN
+        :param campaign_pointer: CampaignPointer, the pointer Inference resolves the live campaign from
+        :param shadow_requests: list, (user_id, context) pairs replayed on both campaigns. Default: None, no check
+        :param min_provisioned_tps: int, the minimum provisioned transactions per second
+        :param enable_metadata: bool, whether the campaign can return item metadata
+        :param max_latency_ratio: float, the highest accepted candidate / live p95 latency ratio
+        :param min_agreement: float, the lowest accepted mean overlap of the item lists
+        :param max_error_rate: float, the highest accepted candidate error rate
+        :param num_results: int, the number of results of the shadow requests
+        :return: dict, the campaign ARNs, the shadow report and whether the candidate was promoted
+        """
+        pointer = campaign_pointer.read()
+        live_campaign_arn = pointer['campaignArn'] if pointer is not None else None
+        standby_color = 'green' if live_campaign_arn is not None and live_campaign_arn.endswith('-blue') else 'blue'
+
+        logger.info(f"Deploying {solution_version_arn} to the {standby_color} campaign...")
+        candidate_campaign_arn = self.create_campaign(
+            name=f'{name}-{standby_color}',
+            solution_version_arn=solution_version_arn,
+            min_provisioned_tps=min_provisioned_tps,
+            enable_metadata=enable_metadata
+        )
+        status = self.wait_campaign(candidate_campaign_arn)
+        result = {
+            'liveCampaignArn': live_campaign_arn,
+            'candidateCampaignArn': candidate_campaign_arn,
+            'shadowReport': None,
+            'promoted': False,
+        }
+        if status != "ACTIVE":
+            logger.error(f"Campaign {candidate_campaign_arn} is {status}, keeping {live_campaign_arn}")
+            return result
+
+        if live_campaign_arn is not None and shadow_requests:
+            report = self.shadow_compare(live_campaign_arn, candidate_campaign_arn, shadow_requests, num_results)
+            result['shadowReport'] = report
+            live_p95 = report['live']['p95_ms']
+            latency_ratio = report['candidate']['p95_ms'] / live_p95 if live_p95 else 1.0
+            error_rate = report['candidate']['errors'] / len(shadow_requests)
+            failures = []
+            if latency_ratio > max_latency_ratio:
+                failures.append(f"p95 latency ratio {latency_ratio:.2f} > {max_latency_ratio}")
+            if error_rate > max_error_rate:
+                failures.append(f"error rate {error_rate:.3f} > {max_error_rate}")
+            if report['agreement'] < min_agreement:
+                failures.append(f"agreement {report['agreement']:.3f} < {min_agreement}")
+            if failures:
+                logger.error(f"Campaign {candidate_campaign_arn} failed the shadow check: {', '.join(failures)}")
+                return result
+
+        campaign_pointer.publish(
+            candidate_campaign_arn,
+            solution_version_arn,
+            previousCampaignArn=live_campaign_arn,
+            shadowReport=result['shadowReport']
+        )
+        result['promoted'] = True
+        return result
+
+    def download_request_rates(self):
+        """
+        Download the request rate files the serving hosts uploaded, see `Inference.upload_request_rates`.
+        Files with the size of their local copy are not downloaded again.
+
+        :return: list, the local files
+        """
+        prefix = f'{settings.REQUEST_RATE_S3_PREFIX}/'
+        try:
+            objects = list_s3_keys(self.s3_client, settings.S3_DATASET_BUCKET, prefix)
+        except ClientError as e:
+            logger.warning(f"Couldn't list the request rates in s3://{settings.S3_DATASET_BUCKET}/{prefix}: {e}")
+            return []
+
+        files = []
+        for obj in objects:
+            local_path = os.path.join(settings.REQUEST_RATE_DOWNLOAD_DIR, obj['Key'][len(prefix):])
+            if not os.path.exists(local_path) or os.path.getsize(local_path) != obj['Size']:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                # Readers never see a truncated file
+                with open(f'{local_path}.tmp', 'wb') as f:
+                    f.write(read_s3_object(self.s3_client, settings.S3_DATASET_BUCKET, obj['Key']))
+                os.replace(f'{local_path}.tmp', local_path)
+            files.append(local_path)
+        logger.info(f"{len(files)} request rate files from s3://{settings.S3_DATASET_BUCKET}/{prefix}")
+        return files
+
+    def request_rate_paths(self):
+        """
+        The request rate files to plan from, download them once for several plans
+
+        :return: str | list, the files of the serving hosts in S3, or every file in settings.REQUEST_RATE_DIR
+                 without settings.REQUEST_RATE_S3_PREFIX
+        """
+        if settings.REQUEST_RATE_S3_PREFIX:
+            return self.download_request_rates()
+        return os.path.join(settings.REQUEST_RATE_DIR, '*.csv')
+
+    def plan_provisioned_tps(self, campaign_arn=None, rate_paths=None, planner=None, apply=False,
+                             report_path=None, campaign_arns=None, exclude_campaign_arns=None):
+        """
+        Plan the minProvisionedTPS from the request rate history recorded by Inference
+
+        :param campaign_arn: str, the campaign whose current minProvisionedTPS is compared and updated.
+                             Default: None, only recommend
+        :param rate_paths: str | list, the request rate CSV files or glob patterns.
+                           Default: None, see `request_rate_paths`
+        :param planner: CapacityPlanner, the planner. Default: None, p95 with 20% headroom
+        :param apply: bool, whether to update the campaign with the recommended TPS. Default: False
+        :param report_path: str, the JSON report path. Default: None, settings.CAPACITY_REPORT_PATH
+        :param campaign_arns: list, the campaigns whose traffic is planned for, e.g. of one shard.
+                              Default: None, all of them
+        :param exclude_campaign_arns: list, the campaigns whose traffic is not planned for,
+                                      e.g. the shards in the plan of the global campaign. Default: None
+        :return: dict | None, the capacity report, None when there is no history
+        """
+        planner = planner or CapacityPlanner()
+        # Blue/green rollouts move the traffic between campaigns, plan for the total
+        if rate_paths is None:
+            rate_paths = self.request_rate_paths()
+        rates = load_request_rates(rate_paths, campaign_arns=campaign_arns, exclude_campaign_arns=exclude_campaign_arns)
+
+        current_tps = None
+        if campaign_arn is not None:
+            current_tps = self.personalize_client.describe_campaign(
+                campaignArn=campaign_arn
+            )["campaign"]["minProvisionedTPS"]
+
+        report = planner.plan(rates, current_tps=current_tps, report_path=report_path or settings.CAPACITY_REPORT_PATH)
+        if report is None or not apply or campaign_arn is None:
+            return report
+
+        if report['recommended_tps'] != current_tps:
+            self.personalize_client.update_campaign(
+                campaignArn=campaign_arn,
+                minProvisionedTPS=report['recommended_tps']
+            )
+            self.wait_campaign(campaign_arn)
+            logger.info(f"Campaign {campaign_arn} minProvisionedTPS: {current_tps} -> {report['recommended_tps']}")
+        return report
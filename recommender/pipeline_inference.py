@@ -1,12 +1,149 @@
-from helpers.connection import connect_to_personalize_runtime
+import argparse
+import json
+import os
+import socket
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import urlparse
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from config.config import settings
+from config.log_config import logger
+from helpers.bloom_filter import BloomFilter
+from helpers.connection import connect_to_personalize_runtime, connect_to_s3_client
+from helpers.metrics import LatencyHistogram, RequestRateRecorder
+from helpers.profiling import add_profiling_args, profiler_from_args
+from helpers.resilience import CircuitOpenError, HedgedCaller, PoolSaturatedError
+from helpers.run_report import RunReport
+from recommender.cooccurrence import CooccurrenceRecommender
+from recommender.item_catalog import ItemCatalog
+from recommender.recommendation_store import RecommendationStore
+from recommender.sharding import ShardRouter
+from recommender.user_table import UserTable
 
 
 class Inference:
-    def __init__(self, profile_name=None):
+    def __init__(self, profile_name=None, recommendation_store=None, fallback_recommender=None,
+                 latency_budget=None, max_workers=16, max_pool_connections=None, personalize_runtime_client=None,
+                 item_catalog=None, user_table=None, known_users=None, cold_start_recommender=None,
+                 hedge=False, hedge_percentile=95, circuit_breaker=None, connect_timeout=None, read_timeout=None,
+                 max_attempts=None, campaign_pointer=None, shard_router=None):
+        """
+        :param profile_name: str, the profile name in ~/.aws/credentials
+        :param recommendation_store: RecommendationStore, precomputed recommendations consulted before the
+                                     runtime. Default: None
+        :param fallback_recommender: object, a recommender with the same `get_recommendations` interface
+                                     (e.g. CooccurrenceRecommender) used when the runtime fails or is too slow
+        :param latency_budget: float, the default per-call deadline, seconds to wait for the runtime before using
+                               the fallback. Default: None
+        :param max_workers: int, the number of threads running runtime calls under a deadline or hedging, and the
+                            maximum of such calls in flight, the others go to the fallback at once
+        :param max_pool_connections: int, the size of the runtime HTTP connection pool. Default: botocore's 10
+        :param personalize_runtime_client: object, an existing runtime client to share, e.g. a local stub.
+                                           Default: None, a new client is created
+        :param item_catalog: ItemCatalog, joins ITEM_NAME locally so the campaign is asked for bare item IDs.
+                             Default: None, the campaign returns the metadata columns
+        :param user_table: UserTable, fills AGE, GENDER, ZIPCODE and BASE_CENTER missing from the request context.
+                           Default: None
+        :param known_users: BloomFilter, the user IDs the campaign was trained on. Default: None
+        :param cold_start_recommender: object, a recommender with the same `get_recommendations` interface
+                                       (e.g. a CooccurrenceRecommender per massage and center) serving the users
+                                       missing from `known_users` without a runtime call. Default: None
+        :param hedge: bool, whether to send a second request when the first is slower than the recent
+                      `hedge_percentile` latency, the first response wins. Default: False
+        :param hedge_percentile: float, the latency percentile that triggers the hedged request. Default: 95
+        :param circuit_breaker: CircuitBreaker, fails fast to the fallback after repeated errors or timeouts.
+                                Default: None
+        :param connect_timeout: float, the botocore connect timeout. Default: botocore's 60s
+        :param read_timeout: float, the botocore read timeout. Default: botocore's 60s
+        :param max_attempts: int, the botocore attempts per call, including retries. Default: botocore's
+        :param campaign_pointer: CampaignPointer, resolves the live campaign of a blue/green deployment when
+                                 no campaign ARN is given. Default: None
+        :param shard_router: ShardRouter, sends the requests of the sharded centers to the campaign of their shard,
+                             the other requests go to the given campaign. Default: None
+        """
         self.profile_name = profile_name
-        self.personalize_runtime_client = connect_to_personalize_runtime(profile_name=profile_name)
+        self.personalize_runtime_client = personalize_runtime_client or connect_to_personalize_runtime(
+            profile_name=profile_name,
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            max_attempts=max_attempts
+        )
+        self.recommendation_store = recommendation_store
+        self.fallback_recommender = fallback_recommender
+        self.latency_budget = latency_budget
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.hedged_caller = HedgedCaller(self.executor, hedge=hedge, hedge_percentile=hedge_percentile,
+                                          max_in_flight=max_workers)
+        self.circuit_breaker = circuit_breaker
+        self.runtime_latency = LatencyHistogram()
+        # Runtime calls per second and campaign, the history the provisioned TPS is planned from
+        self.request_rates = RequestRateRecorder()
+        self._s3_client = None
+        self.counters = {'runtime_calls': 0, 'runtime_errors': 0, 'fallbacks': 0, 'catalog_mismatches': 0}
+        self._counters_lock = threading.Lock()
+        self._catalog_mismatches_logged = set()
+        self.max_pool_connections = max_pool_connections or 10
+        self.warm_up_status = None
+        self.item_catalog = item_catalog
+        self.user_table = user_table
+        self.known_users = known_users
+        self.cold_start_recommender = cold_start_recommender
+        self.campaign_pointer = campaign_pointer
+        self.shard_router = shard_router
+
+    def _count(self, name):
+        with self._counters_lock:
+            self.counters[name] += 1
+
+    @classmethod
+    def from_serving_artifacts(cls, profile_name=None, **kwargs):
+        """
+        Create an Inference with the serving artifacts saved by TrainPipeline that exist on disk
+
+        :param profile_name: str, the profile name in ~/.aws/credentials
+        :param kwargs: the other Inference parameters
+        :return: Inference
+        """
+        if 'recommendation_store' not in kwargs and os.path.isdir(settings.RECOMMENDATION_STORE_DIR):
+            kwargs['recommendation_store'] = RecommendationStore(settings.RECOMMENDATION_STORE_DIR)
+        if 'fallback_recommender' not in kwargs and os.path.exists(settings.FALLBACK_RECOMMENDER_PATH):
+            kwargs['fallback_recommender'] = CooccurrenceRecommender.load(settings.FALLBACK_RECOMMENDER_PATH)
+        if 'item_catalog' not in kwargs and os.path.exists(settings.ITEM_CATALOG_PATH):
+            kwargs['item_catalog'] = ItemCatalog.load(settings.ITEM_CATALOG_PATH)
+        if 'user_table' not in kwargs and os.path.exists(settings.USER_TABLE_PATH):
+            kwargs['user_table'] = UserTable.load(settings.USER_TABLE_PATH)
+        if 'known_users' not in kwargs and os.path.exists(settings.KNOWN_USERS_PATH):
+            kwargs['known_users'] = BloomFilter.load(settings.KNOWN_USERS_PATH)
+        if 'cold_start_recommender' not in kwargs and os.path.exists(settings.COLD_START_RECOMMENDER_PATH):
+            kwargs['cold_start_recommender'] = CooccurrenceRecommender.load(settings.COLD_START_RECOMMENDER_PATH)
+        if 'shard_router' not in kwargs and os.path.exists(settings.SHARD_ROUTER_PATH):
+            kwargs['shard_router'] = ShardRouter.load(settings.SHARD_ROUTER_PATH)
 
-    def get_recommendations(self, campaign_arn, user_id, context, num_results=5, return_item_metadata=True):
+        return cls(profile_name=profile_name, **kwargs)
+
+    def is_global_campaign(self, campaign_arn):
+        """
+        Whether the campaign of a request is the global one the shard router routes from
+
+        :param campaign_arn: str, the campaign ARN, None for the live campaign
+        :return: bool
+        """
+        if campaign_arn is None:
+            return True
+        if self.shard_router.global_campaign_arn is not None:
+            return campaign_arn == self.shard_router.global_campaign_arn
+        if self.campaign_pointer is not None:
+            return campaign_arn == self.campaign_pointer.resolve()
+        # Without a global campaign or a pointer, the campaign given to Inference is the global one
+        return True
+
+    def get_recommendations(self, campaign_arn, user_id, context, num_results=5, return_item_metadata=True,
+                            deadline=None):
         """
         Get recommendations
         Example:
@@ -26,41 +163,345 @@ class Inference:
             inference = Inference()
             inference.get_recommendations(campaign_arn, user_id, context, num_results, return_item_metadata)
 
-        :param campaign_arn: str, the campaign ARN
+        :param campaign_arn: str, the campaign ARN, None for the live campaign of the campaign pointer.
+                             With a shard router, None or the global campaign route the sharded centers
+                             to their shard, another campaign, e.g. a candidate under test, is kept
         :param user_id: str, the user ID
-        :param context: dict, the context
+        :param context: dict, the context, the user fields can be left out when a user table is loaded.
+                        None for an empty context
         :param num_results: int, the number of results
         :param return_item_metadata: bool, whether to return item metadata. Default: True
+        :param deadline: float, seconds to wait for the runtime before using the fallback.
+                         Default: None, the latency budget
         :return: list, the recommendations
         """
+        context = context or {}
+        if self.user_table is not None:
+            context = self.user_table.fill_context(user_id, context)
+        # The BASE_CENTER filled from the user table picks the shard
+        if self.shard_router is not None and self.is_global_campaign(campaign_arn):
+            campaign_arn = self.shard_router.route(context, default=campaign_arn)
+        if campaign_arn is None and self.campaign_pointer is not None:
+            campaign_arn = self.campaign_pointer.resolve()
+
+        # First-time guests get popularity-like results from the campaign anyway, skip the round trip
+        if self.known_users is not None and self.cold_start_recommender is not None \
+                and user_id not in self.known_users:
+            return self.attach_item_metadata(
+                self.cold_start_recommender.get_recommendations(
+                    campaign_arn, user_id, context, num_results, return_item_metadata
+                ),
+                return_item_metadata
+            )
+
+        if self.recommendation_store is not None:
+            item_list = self.recommendation_store.lookup(
+                user_id, context.get('MASSAGE_NAME'), num_results, return_item_metadata
+            )
+            if item_list is not None:
+                return self.attach_item_metadata(item_list, return_item_metadata)
+
         params = {
             "campaignArn": campaign_arn,
             "userId": user_id,
             "numResults": num_results,
             "context": context
         }
-        if return_item_metadata:
+        # With a local catalog the names are joined here instead of returned by the campaign
+        if return_item_metadata and self.item_catalog is None:
             params['metadataColumns'] = {
                 "ITEMS": ["ITEM_NAME"]
             }
 
-        response = self.personalize_runtime_client.get_recommendations(**params)
-        return response['itemList']
+        try:
+            if self.circuit_breaker is not None and not self.circuit_breaker.allow_request():
+                raise CircuitOpenError("Personalize runtime circuit is open")
+            response = self.call_runtime(params, deadline if deadline is not None else self.latency_budget)
+        except (ClientError, BotoCoreError, FutureTimeoutError, CircuitOpenError, PoolSaturatedError) as error:
+            if self.fallback_recommender is None:
+                raise
+            logger.warning(f"Personalize runtime failed for user {user_id}, using fallback: {error!r}")
+            self._count('fallbacks')
+            return self.attach_item_metadata(
+                self.fallback_recommender.get_recommendations(
+                    campaign_arn, user_id, context, num_results, return_item_metadata
+                ),
+                return_item_metadata
+            )
 
+        return self.attach_item_metadata(response['itemList'], return_item_metadata, campaign_arn)
 
-if __name__ == '__main__':
-    inference = Inference(profile_name='nmtruong')
-    item_list = inference.get_recommendations(
-        'arn:aws:personalize:us-west-2:123456789012:campaign/staging-massage-campaign',
-        'da5cc281-7dae-4ef6-9d46-580102ec0784',
-        {
-            'SERVICE_LENGTH': "60.0",
-            'MASSAGE_NAME': 'The NOW 50',
-            'CENTER_NAME': 'Roswell',
-            'AGE': "30",
-            'GENDER': 'Female',
-            'ZIPCODE': "null",
-            'BASE_CENTER': 'Roswell'
+    def call_runtime(self, params, deadline=None):
+        """
+        Call the runtime, on the thread pool when there is a deadline or hedging, and record the outcome
+
+        :param params: dict, the get_recommendations parameters
+        :param deadline: float, seconds before giving up. Default: None
+        :return: dict, the runtime response
+        """
+        start_time = time.perf_counter()
+        self._count('runtime_calls')
+        self.request_rates.observe(params['campaignArn'])
+        try:
+            if deadline is None and not self.hedged_caller.hedge:
+                response = self.personalize_runtime_client.get_recommendations(**params)
+            else:
+                response = self.hedged_caller.call(
+                    self.personalize_runtime_client.get_recommendations, deadline=deadline, **params
+                )
+        except Exception:
+            # Any error settles the circuit breaker trial, not only the runtime ones
+            self._count('runtime_errors')
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_failure()
+            raise
+        finally:
+            self.runtime_latency.observe(time.perf_counter() - start_time)
+
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_success()
+        return response
+
+    def warm_up(self, campaign_arn=None, n_connections=None, user_id='warm-up', context=None, max_rounds=5,
+                tolerance=1.2):
+        """
+        Pay the first-request costs before taking traffic: DNS resolution, TLS handshakes of the pooled
+        connections, botocore request/response model loading and page faults of the local tables.
+
+        With a campaign ARN, rounds of `n_connections` concurrent calls are sent until the median latency of
+        a round is within `tolerance` of the previous round, i.e. first-request latency matches steady state.
+
+        :param campaign_arn: str, the campaign to send warm-up calls to. Default: None, the live campaign of the
+                             campaign pointer if any, otherwise no runtime calls
+        :param n_connections: int, the number of pooled connections to open. Default: the pool size
+        :param user_id: str, the user ID of the warm-up calls
+        :param context: dict, the context of the warm-up calls
+        :param max_rounds: int, the maximum number of warm-up rounds
+        :param tolerance: float, the ratio between two round medians considered steady
+        :return: dict, the warm-up status, with the error of a failed warm-up
+        """
+        start_time = time.perf_counter()
+        status = {'warm': False, 'connections': 0, 'round_median_ms': [], 'errors': [], 'error': None}
+        try:
+            self._warm_up(status, campaign_arn, n_connections, user_id, context, max_rounds, tolerance)
+        except Exception as error:
+            # Readiness reports the failed warm-up, the caller may retry it
+            logger.exception("Warm up failed")
+            status['warm'] = False
+            status['error'] = repr(error)
+
+        status['seconds'] = time.perf_counter() - start_time
+        self.warm_up_status = status
+        logger.info(f"Warm up: {status}")
+        return status
+
+    def _warm_up(self, status, campaign_arn, n_connections, user_id, context, max_rounds, tolerance):
+        """
+        The warm-up steps, filling `status`, see `warm_up`
+        """
+        if campaign_arn is None and self.campaign_pointer is not None:
+            campaign_arn = self.campaign_pointer.resolve()
+        n_connections = min(n_connections or self.max_pool_connections, self.max_pool_connections)
+
+        endpoint_url = getattr(getattr(self.personalize_runtime_client, 'meta', None), 'endpoint_url', None)
+        if endpoint_url:
+            try:
+                socket.getaddrinfo(urlparse(endpoint_url).hostname, 443)
+            except OSError as error:
+                status['errors'].append(f'DNS: {error!r}')
+
+        if self.recommendation_store is not None:
+            status['store_keys'] = self.recommendation_store.prefault()
+        if self.user_table is not None:
+            self.user_table.get(user_id)
+
+        def timed_call():
+            call_start = time.perf_counter()
+            try:
+                self.personalize_runtime_client.get_recommendations(
+                    campaignArn=campaign_arn, userId=user_id, numResults=1, context=context or {}
+                )
+            except ClientError:
+                # An API error still went through DNS, TLS and the botocore models
+                pass
+            return time.perf_counter() - call_start
+
+        if campaign_arn is not None:
+            previous_median = None
+            for _ in range(max_rounds):
+                futures = [self.executor.submit(timed_call) for _ in range(n_connections)]
+                latencies = []
+                for future in futures:
+                    try:
+                        latencies.append(future.result())
+                    except BotoCoreError as error:
+                        status['errors'].append(repr(error))
+
+                if not latencies:
+                    break
+                status['connections'] = max(status['connections'], len(latencies))
+                median = statistics.median(latencies)
+                status['round_median_ms'].append(median * 1000)
+                if previous_median is not None and median <= previous_median * tolerance:
+                    break
+                previous_median = median
+
+        status['warm'] = campaign_arn is None or status['connections'] > 0
+
+    def readiness(self):
+        """
+        Readiness check, an instance is ready once warmed up and while its circuit breaker isn't open.
+        After a failed warm-up it is not ready, `warm_up` holds the error, until a warm-up succeeds
+
+        :return: dict, ready flag and details
+        """
+        warm = bool(self.warm_up_status and self.warm_up_status['warm'])
+        breaker_state = self.circuit_breaker.state if self.circuit_breaker is not None else None
+        campaign_arn, pointer_error = None, None
+        if self.campaign_pointer is not None:
+            try:
+                campaign_arn = self.campaign_pointer.resolve()
+            except Exception as error:
+                pointer_error = repr(error)
+        return {
+            'ready': warm and breaker_state != 'OPEN' and pointer_error is None,
+            'warm_up': self.warm_up_status,
+            'circuit_breaker': breaker_state,
+            'campaign_arn': campaign_arn,
+            'campaign_pointer_error': pointer_error,
+            'artifacts': {
+                'recommendation_store': self.recommendation_store is not None,
+                'fallback_recommender': self.fallback_recommender is not None,
+                'item_catalog': self.item_catalog is not None,
+                'shard_router': self.shard_router is not None,
+                'user_table': self.user_table is not None,
+                'known_users': self.known_users is not None,
+                'cold_start_recommender': self.cold_start_recommender is not None,
+            },
+        }
+
+    def get_metrics(self):
+        """
+        Get the runtime latency, hedging and circuit breaker metrics
+
+        :return: dict, the metrics
+        """
+        with self._counters_lock:
+            counters = dict(self.counters)
+        return {
+            'runtime_latency': self.runtime_latency.snapshot(),
+            'hedging': self.hedged_caller.snapshot(),
+            'circuit_breaker': self.circuit_breaker.snapshot() if self.circuit_breaker is not None else None,
+            **counters,
         }
-    )
-    print(item_list)
+
+    def export_request_rates(self, path=None):
+        """
+        Append the completed per-second runtime call counts to the request rate history,
+        and copy the file to S3 for the capacity planner of the training host
+
+        :param path: str, the CSV file. Default: None, the file of the day in settings.REQUEST_RATE_DIR
+        :return: int, the number of exported rows
+        """
+        path = path or os.path.join(settings.REQUEST_RATE_DIR, f"requests-{time.strftime('%Y-%m-%d')}.csv")
+        n_rows = self.request_rates.export(path)
+        if n_rows and settings.REQUEST_RATE_S3_PREFIX:
+            self.upload_request_rates(path)
+        return n_rows
+
+    def upload_request_rates(self, path):
+        """
+        Copy a request rate file to S3, under the prefix of this host. A failed upload is retried with
+        the next export, the file holds the whole day
+
+        :param path: str, the CSV file
+        :return: bool, whether the file was uploaded
+        """
+        key = f'{settings.REQUEST_RATE_S3_PREFIX}/{socket.gethostname()}/{os.path.basename(path)}'
+        try:
+            if self._s3_client is None:
+                self._s3_client = connect_to_s3_client(profile_name=self.profile_name)
+            with open(path, 'rb') as f:
+                self._s3_client.put_object(Bucket=settings.S3_DATASET_BUCKET, Key=key, Body=f.read())
+        except (ClientError, BotoCoreError) as error:
+            logger.warning(f"Request rates upload to s3://{settings.S3_DATASET_BUCKET}/{key} failed: {error!r}")
+            return False
+        return True
+
+    def attach_item_metadata(self, item_list, return_item_metadata=True, campaign_arn=None):
+        """
+        Join the item names from the local catalog, if any
+
+        :param item_list: list, the recommendations
+        :param return_item_metadata: bool, whether to return item metadata
+        :param campaign_arn: str, the campaign the items come from, checked against the catalog version.
+                             Default: None, no check
+        :return: list, the recommendations
+        """
+        if not return_item_metadata or self.item_catalog is None:
+            return item_list
+
+        # The campaigns don't return metadata, a stale catalog still names the items it knows, loudly
+        if campaign_arn is not None and not self.item_catalog.covers(campaign_arn):
+            self._count('catalog_mismatches')
+            if campaign_arn not in self._catalog_mismatches_logged:
+                self._catalog_mismatches_logged.add(campaign_arn)
+                logger.warning(f"Item catalog of {self.item_catalog.campaign_arn} does not cover campaign "
+                               f"{campaign_arn}, item names may be stale until the catalog is redeployed")
+        return self.item_catalog.attach_metadata(item_list)
+
+
+EXAMPLE_CONTEXT = {
+    'SERVICE_LENGTH': "60.0",
+    'MASSAGE_NAME': 'The NOW 50',
+    'CENTER_NAME': 'Roswell',
+    'AGE': "30",
+    'GENDER': 'Female',
+    'ZIPCODE': "null",
+    'BASE_CENTER': 'Roswell'
+}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Get recommendations for one guest")
+    parser.add_argument('--campaign-arn',
+                        default='arn:aws:personalize:us-west-2:123456789012:campaign/staging-massage-campaign')
+    parser.add_argument('--user-id', default='da5cc281-7dae-4ef6-9d46-580102ec0784')
+    parser.add_argument('--context', type=json.loads, default=EXAMPLE_CONTEXT, help="The context as JSON")
+    parser.add_argument('--num-results', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=1, help="Repeat the lookup, e.g. to profile it")
+    parser.add_argument('--latency-budget', type=float, default=0.3)
+    parser.add_argument('--warm-up', action='store_true')
+    parser.add_argument('--profile-name', default='nmtruong')
+    add_profiling_args(parser)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    run_report = RunReport('inference')
+    run_report.profiler = profiler_from_args(args, run_report)
+    item_list = None
+    with run_report.stage('run'):
+        with run_report.stage('load_artifacts'):
+            inference = Inference.from_serving_artifacts(
+                profile_name=args.profile_name, latency_budget=args.latency_budget
+            )
+        if args.warm_up:
+            with run_report.stage('warm_up'):
+                inference.warm_up(args.campaign_arn)
+        with run_report.stage('get_recommendations', rows_in=args.requests):
+            for _ in range(args.requests):
+                item_list = inference.get_recommendations(
+                    args.campaign_arn, args.user_id, args.context, num_results=args.num_results
+                )
+
+    run_report.info['metrics'] = inference.get_metrics()
+    run_report.save()
+    return item_list
+
+
+if __name__ == '__main__':
+    # python -m recommender.pipeline_inference --requests 1000 --profile sample --profile-stage get_recommendations
+    print(main())
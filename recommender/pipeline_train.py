@@ -1,23 +1,80 @@
+import argparse
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from recommender.campaign_pointer import CampaignPointer
+from recommender.cooccurrence import CooccurrenceRecommender
 from recommender.data_loader import DataLoader
 from recommender.dataset_builder import DatasetBuilder
+from recommender.evaluation import Evaluator, time_based_split
+from recommender.item_catalog import ItemCatalog
+from recommender.local_model import LocalRecommender
 from recommender.personalization import Personalization
+from recommender.sharding import MIN_SHARD_INTERACTIONS, ShardRouter, assign_shards, load_regions, split_shards
+from recommender.user_table import UserTable
 
 from config.config import settings
 from config.log_config import logger
+from helpers.bloom_filter import BloomFilter
+from helpers.profiling import add_profiling_args, profiler_from_args
+from helpers.run_report import RunReport
 from helpers.aws_data_ops import upload_file_to_s3, create_bucket
-from helpers.connection import connect_to_s3_client
+from helpers.connection import connect_to_s3_client, get_rate_governor
 
 
 class TrainPipeline:
     """
     Full pipeline to train and release ARN for the recommendation model
     """
-    def __init__(self, data_path, profile_name=None):
+    def __init__(self, data_path, profile_name=None, run_report=None, exact_statistics=False, training_window=None,
+                 shard=None):
         self.data_path = data_path
         self.profile_name = profile_name
+        # Count the distinct users, items and massages exactly instead of estimating them
+        self.exact_statistics = exact_statistics
+        # DatasetBuilder.apply_training_window arguments, e.g. {'months': 24}
+        if training_window is None and settings.TRAINING_WINDOW_MONTHS:
+            training_window = {'months': settings.TRAINING_WINDOW_MONTHS}
+        self.training_window = training_window
         self.deploy_env = os.getenv('DEPLOY_ENV', 'staging').lower()
+        # A shard has its own datasets, fingerprints and Personalize resources, see train_shards
+        self.shard = shard
+        if shard is None:
+            self.data_dir = os.path.join(settings.BASE_DIR, 'data')
+            self.fingerprint_path = settings.DATASET_FINGERPRINT_PATH
+            self.s3_prefix = ''
+        else:
+            self.data_dir = os.path.join(settings.SHARD_DIR, shard)
+            self.fingerprint_path = os.path.join(self.data_dir, 'dataset_fingerprints.npz')
+            self.s3_prefix = f'shards/{shard}/'
+        # Left by a failed import, the next import is FULL, see resolve_import_mode
+        self.import_failed_path = f'{self.fingerprint_path}.import_failed'
         self.s3_client = connect_to_s3_client(profile_name=profile_name)
+        # Set by build_data_for_personalize, the defaults are the files of a previous full upload
+        self.s3_data_paths = {
+            name: f"s3://{settings.S3_DATASET_BUCKET}/{self.s3_prefix}{name}.csv"
+            for name in ['interaction', 'user', 'item']
+        }
+        self.pending_fingerprints = None
+        # Wall time, CPU time, peak RSS, rows and bytes per stage, saved by run()
+        self.run_report = run_report or RunReport('train')
+
+    def resource_name(self, name, shard=None):
+        """
+        The Personalize name of a resource of this pipeline, e.g. staging-massage-campaign,
+        staging-roswell-massage-campaign for the roswell shard
+
+        :param name: str, the resource name without environment and shard
+        :param shard: str, the shard. Default: None, the shard of this pipeline
+        :return: str, the resource name
+        """
+        shard = shard or self.shard
+        if shard is None:
+            return f'{self.deploy_env}-{name}'
+        return f'{self.deploy_env}-{shard}-{name}'
 
     def process_data(self):
         """
@@ -25,57 +82,223 @@ class TrainPipeline:
 
         :return: pd.DataFrame, the processed data
         """
-        data_loader = DataLoader(self.data_path)
-        data = data_loader.load_data()
-        merged_df = data_loader.merge_massages_enhancements(data)
-        processed_df = data_loader.process_data_types(merged_df)
+        data_loader = DataLoader(self.data_path, exact_statistics=self.exact_statistics, profile_name=self.profile_name)
+        with self.run_report.stage('load_data') as stage:
+            data = data_loader.load_data()
+            stage.set(rows_out=len(data), bytes_in=data_loader.bytes_read)
+        self.run_report.info['missing_dates'] = data_loader.missing_dates
+        with self.run_report.stage('merge_massages_enhancements', rows_in=len(data)) as stage:
+            merged_df = data_loader.merge_massages_enhancements(data)
+            stage.set(rows_out=len(merged_df))
+        with self.run_report.stage('process_data_types', rows_in=len(merged_df)) as stage:
+            processed_df = data_loader.process_data_types(merged_df, statistics=data_loader.statistics)
+            stage.set(rows_out=len(processed_df))
+        self.run_report.info['dataset_statistics'] = data_loader.statistics.summary()
         return processed_df
 
-    def build_data_for_personalize(self, process_data):
+    def resolve_import_mode(self, import_mode):
         """
-        Prepare user, item and interaction data for personalize and upload to S3 bucket
+        The import mode of this run, FULL instead of INCREMENTAL after a failed import
 
-        :return: None
+        :param import_mode: str, the requested import mode, 'FULL'|'INCREMENTAL'
+        :return: str, the import mode
+        """
+        if import_mode == 'INCREMENTAL' and os.path.exists(self.import_failed_path):
+            logger.warning(f"The last dataset import failed ({self.import_failed_path}), importing FULL datasets")
+            return 'FULL'
+        return import_mode
+
+    def build_data_for_personalize(self, process_data, import_mode='INCREMENTAL', upload=True):
+        """
+        Prepare user, item and interaction data for personalize and upload to S3 bucket.
+        In INCREMENTAL mode only the rows that are new or changed since the last import are uploaded,
+        every run uploads to its own S3 prefix.
+
+        :param process_data: pd.DataFrame, the processed data
+        :param import_mode: str, the import data mode, 'FULL'|'INCREMENTAL'. Default: 'INCREMENTAL'
+        :param upload: bool, whether to upload the import files to S3, False builds them locally only,
+                       e.g. for benchmarks. Default: True
+        :return: dict, dataset name -> S3 path to import, the local file when `upload` is False,
+                 None when there is nothing new
         """
         data_builder = DatasetBuilder(data=process_data)
-        interaction_df = data_builder.build_interaction_dataset()
-        user_df = data_builder.build_user_dataset()
-        item_df = data_builder.build_item_dataset()
+        if self.training_window:
+            with self.run_report.stage('apply_training_window', rows_in=len(process_data)) as stage:
+                self.run_report.info['training_window'] = data_builder.apply_training_window(**self.training_window)
+                stage.set(rows_out=len(data_builder.data))
+        builders = {
+            'interaction': data_builder.build_interaction_dataset,
+            'user': data_builder.build_user_dataset,
+            'item': data_builder.build_item_dataset,
+        }
+        datasets = {}
+        for name, build in builders.items():
+            with self.run_report.stage(f'build_{name}_dataset', rows_in=len(data_builder.data)) as stage:
+                datasets[name] = build()
+                stage.set(rows_out=len(datasets[name]))
 
-        os.makedirs(os.path.join(settings.BASE_DIR, 'data'), exist_ok=True)
+        previous_fingerprints = None
+        with self.run_report.stage('build_delta_datasets') as stage:
+            if import_mode == 'INCREMENTAL':
+                previous_fingerprints = DatasetBuilder.load_fingerprints(self.fingerprint_path)
+            datasets, deltas, self.pending_fingerprints = data_builder.build_delta_datasets(
+                previous_fingerprints, datasets=datasets
+            )
+            if import_mode == 'FULL':
+                deltas = datasets
+            stage.set(rows_in=sum(len(df) for df in datasets.values()),
+                      rows_out=sum(len(df) for df in deltas.values()))
 
-        interaction_df.to_csv(os.path.join(settings.BASE_DIR, 'data/interaction.csv'), index=False)
-        user_df.to_csv(os.path.join(settings.BASE_DIR, 'data/user.csv'), index=False)
-        item_df.to_csv(os.path.join(settings.BASE_DIR, 'data/item.csv'), index=False)
+        os.makedirs(self.data_dir, exist_ok=True)
+        with self.run_report.stage('write_datasets') as stage:
+            for name, df in datasets.items():
+                df.to_csv(os.path.join(self.data_dir, f'{name}.csv'), index=False)
+            stage.set(bytes_out=sum(os.path.getsize(os.path.join(self.data_dir, f'{name}.csv'))
+                                    for name in datasets))
+
+        # Inference fills the user fields of the context from this table, the shards share the global one.
+        # The window only trims the exports, Personalize still knows the users of the earlier imports
+        if self.shard is None:
+            user_df = datasets['user']
+            if self.training_window:
+                with self.run_report.stage('build_serving_user_dataset', rows_in=len(process_data)) as stage:
+                    user_df = DatasetBuilder(data=process_data).build_user_dataset()
+                    stage.set(rows_out=len(user_df))
+            os.makedirs(settings.SERVING_DIR, exist_ok=True)
+            with self.run_report.stage('build_user_table', rows_in=len(user_df)):
+                UserTable.from_user_dataset(user_df).save(settings.USER_TABLE_PATH)
+            with self.run_report.stage('build_known_users_filter', rows_in=len(user_df)):
+                self.build_known_users_filter(user_df)
 
         # Create bucket if not exist
-        create_bucket(self.s3_client, settings.S3_DATASET_BUCKET)
+        if upload:
+            create_bucket(settings.S3_DATASET_BUCKET, profile_name=self.profile_name)
 
-        upload_file_to_s3(
-            self.s3_client,
-            os.path.join(settings.BASE_DIR, 'data/interaction.csv'),
-            settings.S3_DATASET_BUCKET,
-            'interaction.csv'
-        )
-        upload_file_to_s3(
-            self.s3_client,
-            os.path.join(settings.BASE_DIR, 'data/user.csv'),
-            settings.S3_DATASET_BUCKET,
-            'user.csv'
+        run_id = time.strftime('%Y%m%d-%H%M%S')
+        import_dir = os.path.join(self.data_dir, 'imports', run_id)
+        os.makedirs(import_dir, exist_ok=True)
+        for name, df in deltas.items():
+            full_size = os.path.getsize(os.path.join(self.data_dir, f'{name}.csv'))
+            if df.empty:
+                logger.info(f"No new {name} rows, skipping the {name} import")
+                self.s3_data_paths[name] = None
+                continue
+
+            file_path = os.path.join(import_dir, f'{name}.csv')
+            with self.run_report.stage(f'write_{name}_import', rows_in=len(df)) as stage:
+                df.to_csv(file_path, index=False)
+                stage.set(bytes_out=os.path.getsize(file_path))
+            if not upload:
+                self.s3_data_paths[name] = file_path
+                continue
+            object_name = f'{self.s3_prefix}imports/{run_id}/{name}.csv'
+            with self.run_report.stage(f'upload_{name}', rows_in=len(df), bytes_out=os.path.getsize(file_path)):
+                upload_file_to_s3(self.s3_client, file_path, settings.S3_DATASET_BUCKET, object_name)
+            self.s3_data_paths[name] = f"s3://{settings.S3_DATASET_BUCKET}/{object_name}"
+            logger.info(f"{name}: uploaded {len(df)} of {len(datasets[name])} rows, "
+                        f"{os.path.getsize(file_path) / 1024 ** 2:.2f} of {full_size / 1024 ** 2:.2f} MB")
+
+        logger.info("Data uploaded to s3" if upload else f"Import files written to {import_dir}")
+        return self.s3_data_paths
+
+    @staticmethod
+    def build_known_users_filter(user_df, false_positive_rate=None):
+        """
+        Build the Bloom filter of the known user IDs, Inference routes the other users to the cold-start list
+
+        :param user_df: pd.DataFrame, the user dataset
+        :param false_positive_rate: float, the filter false positive rate.
+                                    Default: settings.KNOWN_USERS_FALSE_POSITIVE_RATE
+        :return: str, the path of the saved filter
+        """
+        false_positive_rate = false_positive_rate or settings.KNOWN_USERS_FALSE_POSITIVE_RATE
+        known_users = BloomFilter.for_capacity(len(user_df), false_positive_rate)
+        known_users.add_many(user_df['USER_ID'].astype(str))
+
+        os.makedirs(settings.SERVING_DIR, exist_ok=True)
+        known_users.save(settings.KNOWN_USERS_PATH)
+        logger.info(f"Known users filter: {len(user_df)} users | {known_users.bits.nbytes} bytes "
+                    f"| false positive rate {false_positive_rate}")
+        return settings.KNOWN_USERS_PATH
+
+    @staticmethod
+    def build_fallback_recommender(process_data):
+        """
+        Build the co-occurrence recommenders used by Inference:
+            - the fallback when the campaign is unavailable
+            - the cold-start list per massage and center, for users unknown to the campaign
+
+        :param process_data: pd.DataFrame, the processed data
+        :return: str, the path of the saved fallback recommender
+        """
+        os.makedirs(settings.SERVING_DIR, exist_ok=True)
+        CooccurrenceRecommender.fit(process_data).save(settings.FALLBACK_RECOMMENDER_PATH)
+        CooccurrenceRecommender.fit(
+            process_data, condition_cols=('center_name',), score='count'
+        ).save(settings.COLD_START_RECOMMENDER_PATH)
+        return settings.FALLBACK_RECOMMENDER_PATH
+
+    @staticmethod
+    def train_local_recommendation(process_data, algorithm='item_item', **model_params):
+        """
+        Train the local CPU baseline model on the same datasets that are imported to Personalize
+
+        :param process_data: pd.DataFrame, the processed data
+        :param algorithm: str, 'item_item'|'als'. Default: 'item_item'
+        :param model_params: the LocalRecommender parameters
+        :return: LocalRecommender, the fitted model, with the same get_recommendations interface as Inference
+        """
+        data_builder = DatasetBuilder(data=process_data)
+        model = LocalRecommender(algorithm=algorithm, **model_params)
+        return model.fit(
+            data_builder.build_interaction_dataset(),
+            user_df=data_builder.build_user_dataset(),
+            item_df=data_builder.build_item_dataset()
         )
-        upload_file_to_s3(
-            self.s3_client,
-            os.path.join(settings.BASE_DIR, 'data/item.csv'),
-            settings.S3_DATASET_BUCKET,
-            'item.csv'
+
+    @staticmethod
+    def evaluate_local_recommendation(process_data, algorithms=('item_item', 'als'), k=5, holdout_fraction=0.1,
+                                      report_path=None):
+        """
+        Train the local models on the oldest interactions and evaluate them on the most recent ones
+
+        :param process_data: pd.DataFrame, the processed data
+        :param algorithms: tuple, the LocalRecommender algorithms to compare
+        :param k: int, the cut-off of the ranking metrics
+        :param holdout_fraction: float, the fraction of the most recent interactions kept for holdout
+        :param report_path: str, the JSON report path. Default: data/evaluation_report.json
+        :return: dict, the evaluation report
+        """
+        data_builder = DatasetBuilder(data=process_data)
+        interaction_df = data_builder.build_interaction_dataset()
+        user_df = data_builder.build_user_dataset()
+        item_df = data_builder.build_item_dataset()
+
+        train_df, holdout_df, cutoff = time_based_split(interaction_df, holdout_fraction=holdout_fraction)
+        recommenders = {
+            algorithm: LocalRecommender(algorithm=algorithm).fit(train_df, user_df=user_df, item_df=item_df)
+            for algorithm in algorithms
+        }
+
+        evaluator = Evaluator(holdout_df, k=k, catalog=item_df['ITEM_ID'])
+        return evaluator.evaluate_all(
+            recommenders,
+            report_path=report_path or os.path.join(settings.BASE_DIR, 'data', 'evaluation_report.json'),
+            cutoff=cutoff
         )
-        logger.info("Data uploaded to s3")
 
     def train_recommendation(self,
                              import_mode='INCREMENTAL',
                              perform_hpo=False,
                              perform_auto_ml=False,
-                             keep_previous_solution=True
+                             keep_previous_solution=True,
+                             force_retrain=False,
+                             solution_configs=None,
+                             selection_metric='normalized_discounted_cumulative_gain_at_10',
+                             blue_green=False,
+                             shadow_sample_size=200,
+                             rate_paths=None,
+                             exclude_campaign_names=None
                              ):
         """
         Train the recommendation model
@@ -84,79 +307,442 @@ class TrainPipeline:
         :param perform_hpo: bool, whether to perform hyperparameter optimization. Default: False
         :param perform_auto_ml: bool, whether to perform auto ml. Default: False
         :param keep_previous_solution: bool, whether to keep the previous solution. Default: True
+        :param force_retrain: bool, whether to train a new solution version even when the imported data
+                              is unchanged since the last one. Default: False
+        :param solution_configs: list, the recipes to train concurrently, dicts with a `name` suffix of the
+                                 solution and the `create_solution` parameters, e.g.
+                                 {'name': 'massage-solution-v2',
+                                 'recipe_arn': 'arn:aws:personalize:::recipe/aws-user-personalization-v2'}.
+                                 Default: None, aws-user-personalization with perform_hpo and perform_auto_ml
+        :param selection_metric: str, the solution metric the deployed version is selected by.
+                                 Default: 'normalized_discounted_cumulative_gain_at_10'
+        :param blue_green: bool, whether to deploy to the standby campaign and switch the campaign pointer after
+                           a shadow check, instead of updating the campaign in place. Default: False
+        :param shadow_sample_size: int, the number of recent bookings replayed in the shadow check. Default: 200
+        :param rate_paths: str | list, the request rate files the provisioned TPS is planned from.
+                           Default: None, see `Personalization.request_rate_paths`
+        :param exclude_campaign_names: list, the campaigns whose traffic is left out of the plan of the global
+                                       campaign, e.g. of the shards. Default: None
         :return: str, the ARN of the campaign, this is endpoint for the recommendation model
         """
 
         personalize = Personalization(profile_name=self.profile_name)
-        dataset_group_arn = personalize.create_dataset_group(name=f'{self.deploy_env}-massage-dataset-group')
+        with self.run_report.stage('create_dataset_group'):
+            dataset_group_arn = personalize.create_dataset_group(name=self.resource_name('massage-dataset-group'))
 
         # Create datasets
-        interaction_dataset_arn = personalize.create_interaction_dataset(
-            schema_name=f'{self.deploy_env}-massage-interactions-schema',
-            dataset_group_arn=dataset_group_arn,
-            name=f'{self.deploy_env}-massage-interactions'
-        )
-        user_dataset_arn = personalize.create_user_dataset(
-            schema_name=f'{self.deploy_env}-massage-users-schema',
-            dataset_group_arn=dataset_group_arn,
-            name=f'{self.deploy_env}-massage-users'
-        )
-        item_dataset_arn = personalize.create_item_dataset(
-            schema_name=f'{self.deploy_env}-massage-items-schema',
-            dataset_group_arn=dataset_group_arn,
-            name=f'{self.deploy_env}-massage-items'
-        )
+        with self.run_report.stage('create_datasets'):
+            interaction_dataset_arn = personalize.create_interaction_dataset(
+                schema_name=self.resource_name('massage-interactions-schema'),
+                dataset_group_arn=dataset_group_arn,
+                name=self.resource_name('massage-interactions')
+            )
+            user_dataset_arn = personalize.create_user_dataset(
+                schema_name=self.resource_name('massage-users-schema'),
+                dataset_group_arn=dataset_group_arn,
+                name=self.resource_name('massage-users')
+            )
+            item_dataset_arn = personalize.create_item_dataset(
+                schema_name=self.resource_name('massage-items-schema'),
+                dataset_group_arn=dataset_group_arn,
+                name=self.resource_name('massage-items')
+            )
 
-        # Import the data
-        s3_data_path = f"s3://{settings.S3_DATASET_BUCKET}/interaction.csv"
-        personalize.import_interactions_data(interaction_dataset_arn, s3_data_path, import_mode=import_mode)
+        # Stream new bookings between the imports, see EventWriter
+        with self.run_report.stage('create_event_tracker'):
+            event_tracker = personalize.create_event_tracker(
+                name=self.resource_name('massage-event-tracker'),
+                dataset_group_arn=dataset_group_arn
+            )
+        if event_tracker is not None:
+            self.save_event_tracker(
+                event_tracker, None if self.shard is None else os.path.join(self.data_dir, 'event_tracker.json')
+            )
 
-        s3_data_path = f"s3://{settings.S3_DATASET_BUCKET}/user.csv"
-        personalize.import_users_data(user_dataset_arn, s3_data_path, import_mode=import_mode)
+        # Import the data, the deltas of build_data_for_personalize in INCREMENTAL mode
+        try:
+            if self.s3_data_paths['interaction'] is not None:
+                with self.run_report.stage('import_interactions_data'):
+                    personalize.import_interactions_data(
+                        interaction_dataset_arn, self.s3_data_paths['interaction'], import_mode=import_mode
+                    )
+            if self.s3_data_paths['user'] is not None:
+                with self.run_report.stage('import_users_data'):
+                    personalize.import_users_data(user_dataset_arn, self.s3_data_paths['user'],
+                                                  import_mode=import_mode)
+            if self.s3_data_paths['item'] is not None:
+                with self.run_report.stage('import_items_data'):
+                    personalize.import_items_data(item_dataset_arn, self.s3_data_paths['item'],
+                                                  import_mode=import_mode)
+        except Exception:
+            # The previous fingerprints are kept, but the imports that did succeed would be sent again by the next
+            # delta, so the next import replaces the whole datasets
+            self.pending_fingerprints = None
+            os.makedirs(os.path.dirname(self.import_failed_path), exist_ok=True)
+            with open(self.import_failed_path, 'w') as f:
+                f.write(time.strftime('%Y-%m-%d %H:%M:%S'))
+            logger.error("Dataset import failed, the next import will be FULL")
+            raise
 
-        s3_data_path = f"s3://{settings.S3_DATASET_BUCKET}/item.csv"
-        personalize.import_items_data(item_dataset_arn, s3_data_path, import_mode=import_mode)
+        # The next run diffs against what is imported now
+        if self.pending_fingerprints is not None:
+            DatasetBuilder.save_fingerprints(self.pending_fingerprints, self.fingerprint_path)
+            self.pending_fingerprints = None
+        if os.path.exists(self.import_failed_path):
+            os.remove(self.import_failed_path)
 
-        # Create a solution, aka train the model
-        solution_version_arn = personalize.create_solution(
-            name=f'{self.deploy_env}-massage-solution',
-            dataset_group_arn=dataset_group_arn,
-            perform_hpo=perform_hpo,
-            perform_auto_ml=perform_auto_ml,
-            keep_previous_solution=keep_previous_solution
-        )
+        # The content of the imported datasets, training is skipped when a solution version has the same one
+        fingerprints = DatasetBuilder.load_fingerprints(self.fingerprint_path)
+        data_fingerprint = DatasetBuilder.hash_fingerprints(fingerprints) if fingerprints else None
 
+        # Create the solutions, aka train the models, and keep the best one by the selection metric
+        if solution_configs is None:
+            solution_configs = [{
+                'name': 'massage-solution',
+                'perform_hpo': perform_hpo,
+                'perform_auto_ml': perform_auto_ml,
+            }]
+        solution_configs = [
+            {**solution_config, 'name': self.resource_name(solution_config['name'])}
+            for solution_config in solution_configs
+        ]
+        with self.run_report.stage('train_solutions'):
+            solution_results = personalize.train_solutions(
+                solution_configs,
+                dataset_group_arn=dataset_group_arn,
+                keep_previous_solution=keep_previous_solution,
+                data_fingerprint=data_fingerprint,
+                force_retrain=force_retrain
+            )
         # Get solution metrics, aka ranking metrics
-        solution_metrics = personalize.get_solution_metrics(solution_version_arn)
-        logger.info(solution_metrics)
+        for name, result in solution_results.items():
+            logger.info(f"{name}: {result['metrics']}")
+        _, solution_version_arn = personalize.select_best_solution_version(solution_results, selection_metric)
+
+        # Provision for the recorded traffic instead of a fixed TPS, a shard for the traffic of its own campaign
+        campaign_arn_prefix = f"{solution_version_arn.split(':solution/')[0]}:campaign/"
+        if self.shard is None:
+            capacity_report = personalize.plan_provisioned_tps(
+                rate_paths=rate_paths,
+                exclude_campaign_arns=[campaign_arn_prefix + name for name in exclude_campaign_names or []]
+            )
+        else:
+            capacity_report = personalize.plan_provisioned_tps(
+                rate_paths=rate_paths, campaign_arns=[campaign_arn_prefix + self.resource_name('massage-campaign')],
+                report_path=os.path.join(self.data_dir, 'capacity_report.json')
+            )
+        min_provisioned_tps = capacity_report['recommended_tps'] if capacity_report is not None else 2
 
         # Create a campaign
-        campaign_arn = personalize.create_campaign(
-            name=f'{self.deploy_env}-massage-campaign',
-            solution_version_arn=solution_version_arn
-        )
+        if blue_green:
+            campaign_pointer = CampaignPointer(
+                settings.S3_DATASET_BUCKET, settings.CAMPAIGN_POINTER_KEY, s3_client=self.s3_client
+            )
+            with self.run_report.stage('deploy_campaign_blue_green'):
+                deployment = personalize.deploy_campaign_blue_green(
+                    name=self.resource_name('massage-campaign'),
+                    solution_version_arn=solution_version_arn,
+                    campaign_pointer=campaign_pointer,
+                    shadow_requests=self.build_shadow_requests(shadow_sample_size),
+                    min_provisioned_tps=min_provisioned_tps,
+                    enable_metadata=False
+                )
+            if not deployment['promoted']:
+                logger.error(f"Solution version {solution_version_arn} not promoted, "
+                             f"{deployment['liveCampaignArn']} stays live")
+                return deployment['liveCampaignArn']
+            campaign_arn = deployment['candidateCampaignArn']
+        else:
+            with self.run_report.stage('create_campaign'):
+                campaign_arn = personalize.create_campaign(
+                    name=self.resource_name('massage-campaign'),
+                    solution_version_arn=solution_version_arn,
+                    min_provisioned_tps=min_provisioned_tps,
+                    enable_metadata=False
+                )
         logger.info(campaign_arn)
+
+        # Inference joins the names from the catalog, the shards from the global one
+        if self.shard is None:
+            self.save_item_catalog(campaign_arn, solution_version_arn)
         return campaign_arn
 
+    @staticmethod
+    def build_shadow_requests(sample_size=200):
+        """
+        Sample recent bookings as the (user_id, context) requests of the blue/green shadow check
+
+        :param sample_size: int, the number of requests
+        :return: list, (user_id, context) pairs
+        """
+        interaction_df = pd.read_csv(os.path.join(settings.BASE_DIR, 'data/interaction.csv'), dtype=str)
+        recent_df = interaction_df.sort_values('TIMESTAMP').tail(sample_size * 10)
+        sample_df = recent_df.sample(min(sample_size, len(recent_df)), random_state=42).fillna('null')
+        return [
+            (row.USER_ID, {'SERVICE_LENGTH': row.SERVICE_LENGTH, 'MASSAGE_NAME': row.MASSAGE_NAME,
+                           'CENTER_NAME': row.CENTER_NAME})
+            for row in sample_df.itertuples()
+        ]
+
+    @staticmethod
+    def save_event_tracker(event_tracker, path=None):
+        """
+        Save the event tracker EventWriter sends the booking events to
+
+        :param event_tracker: dict, the event tracker ARN and tracking ID
+        :param path: str, the file path. Default: None, settings.EVENT_TRACKER_PATH
+        :return: None
+        """
+        path = path or settings.EVENT_TRACKER_PATH
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(event_tracker, f)
+        logger.info(f"Event tracker {event_tracker['eventTrackerArn']} saved to {path}")
+
+    @staticmethod
+    def save_item_catalog(campaign_arn, solution_version_arn):
+        """
+        Save the item catalog Inference joins ITEM_NAME from, versioned with the deployed campaign
+
+        :param campaign_arn: str, the campaign ARN
+        :param solution_version_arn: str, the solution version ARN
+        :return: ItemCatalog, the saved catalog
+        """
+        item_df = pd.read_csv(os.path.join(settings.BASE_DIR, 'data/item.csv'), dtype=str)
+        item_catalog = ItemCatalog.from_item_dataset(
+            item_df, campaign_arn=campaign_arn, solution_version_arn=solution_version_arn
+        )
+        item_catalog.save(settings.ITEM_CATALOG_PATH)
+        return item_catalog
+
+    def train_shards(self, process_data, shard_by='base_center', regions=None, min_interactions=MIN_SHARD_INTERACTIONS,
+                     max_workers=None, global_campaign_arn=None, import_mode='INCREMENTAL', global_params=None,
+                     **train_params):
+        """
+        Train one dataset group, solution and campaign per shard of the processed data, the shards in parallel,
+        and save the ShardRouter Inference routes the requests with.
+        Each shard has its own run report, a shard that fails keeps its requests on the global campaign.
+        The global campaign is trained alongside the shards with `global_params`, the request rate files
+        are downloaded once for every capacity plan.
+
+        :param process_data: pd.DataFrame, the processed data
+        :param shard_by: str, 'base_center'|'region'. Default: 'base_center'
+        :param regions: dict, center -> region, required to shard by region
+        :param min_interactions: int, the minimum bookings of a shard, smaller ones stay on the global campaign
+        :param max_workers: int, the number of shards, and global campaign, trained concurrently.
+                            Default: None, all of them
+        :param global_campaign_arn: str, the campaign of the requests without a shard, when `global_params` is not
+                                    given. Default: None, the campaign given to Inference or its campaign pointer
+        :param import_mode: str, the import data mode, 'FULL'|'INCREMENTAL'. Default: 'INCREMENTAL'
+        :param global_params: dict, the `train_recommendation` parameters of the global campaign, e.g.
+                              {'import_mode': 'FULL', 'blue_green': True}. Default: None, the global campaign
+                              is not trained
+        :param train_params: the other `train_recommendation` parameters of the shards, blue/green is not supported
+        :return: (ShardRouter, str | None), the saved router and the ARN of the global campaign trained with
+                 `global_params`
+        :raises Exception: the error of the global campaign training, once the shards are done and the router saved
+        """
+        shards, center_shards = assign_shards(process_data, shard_by, regions, min_interactions)
+        shard_data = split_shards(process_data, shards)
+        logger.info(f"Training {len(shard_data)} shards by {shard_by}: "
+                    f"{', '.join(f'{shard} ({len(df)})' for shard, df in shard_data.items())}")
+        # Every capacity plan reads the same files, concurrent downloads would overwrite each other's
+        with self.run_report.stage('download_request_rates'):
+            rate_paths = Personalization(profile_name=self.profile_name).request_rate_paths()
+
+        def train_shard(shard):
+            pipeline = TrainPipeline(self.data_path, profile_name=self.profile_name,
+                                     run_report=RunReport(f'train-{shard}'), training_window=self.training_window,
+                                     shard=shard)
+            shard_import_mode = pipeline.resolve_import_mode(import_mode)
+            pipeline.run_report.info.update(shard=shard, shard_by=shard_by, import_mode=shard_import_mode)
+            try:
+                with pipeline.run_report.stage('run'):
+                    pipeline.build_data_for_personalize(shard_data[shard], import_mode=shard_import_mode)
+                    campaign_arn = pipeline.train_recommendation(import_mode=shard_import_mode, rate_paths=rate_paths,
+                                                                 **train_params)
+            except BaseException:
+                pipeline.run_report.save(status='failed')
+                raise
+            pipeline.run_report.info['campaign_arn'] = campaign_arn
+            pipeline.run_report.save()
+            return campaign_arn
+
+        shard_campaigns, shard_results = {}, {}
+        global_error = None
+        with self.run_report.stage('train_shards', rows_in=len(process_data)) as stage:
+            n_jobs = len(shard_data) + (global_params is not None)
+            with ThreadPoolExecutor(max_workers=max_workers or max(n_jobs, 1)) as executor:
+                futures = {}
+                if global_params is not None:
+                    # The traffic routed to the shards is planned for by the shard campaigns
+                    global_future = executor.submit(
+                        self.train_recommendation, rate_paths=rate_paths,
+                        exclude_campaign_names=[self.resource_name('massage-campaign', shard=shard)
+                                                for shard in shard_data],
+                        **global_params
+                    )
+                futures.update({executor.submit(train_shard, shard): shard for shard in shard_data})
+                for future in as_completed(futures):
+                    shard = futures[future]
+                    try:
+                        shard_campaigns[shard] = future.result()
+                        shard_results[shard] = {'status': 'ok', 'rows': len(shard_data[shard]),
+                                                'campaign_arn': shard_campaigns[shard]}
+                    except Exception as e:
+                        logger.error(f"Shard {shard} failed, its requests stay on the global campaign: {e!r}")
+                        shard_results[shard] = {'status': 'failed', 'rows': len(shard_data[shard]), 'error': repr(e)}
+                if global_params is not None:
+                    try:
+                        campaign_arn = global_future.result()
+                        if not global_params.get('blue_green'):
+                            global_campaign_arn = campaign_arn
+                    except Exception as e:
+                        logger.error(f"Global campaign failed: {e!r}")
+                        campaign_arn, global_error = None, e
+            stage.set(rows_out=sum(len(shard_data[shard]) for shard in shard_campaigns))
+
+        router = ShardRouter(center_shards, shard_campaigns, global_campaign_arn=global_campaign_arn,
+                             shard_by=shard_by)
+        router.save(settings.SHARD_ROUTER_PATH)
+        if os.path.exists(settings.ITEM_CATALOG_PATH):
+            item_catalog = ItemCatalog.load(settings.ITEM_CATALOG_PATH)
+            item_catalog.shard_campaign_arns = sorted(shard_campaigns.values())
+            item_catalog.save(settings.ITEM_CATALOG_PATH)
+        self.run_report.info['shards'] = shard_results
+        if global_error is not None:
+            raise global_error
+        return router, campaign_arn if global_params is not None else None
+
+    @staticmethod
+    def rate_governor_stats():
+        """
+        :return: dict | None, the calls, throttles and waits of the control-plane calls so far, per service
+        """
+        governor = get_rate_governor()
+        return governor.snapshot() if governor is not None else None
+
     def run(self,
             import_mode='INCREMENTAL',
             perform_hpo=False,
             perform_auto_ml=False,
-            keep_previous_solution=True
+            keep_previous_solution=True,
+            force_retrain=False,
+            solution_configs=None,
+            selection_metric='normalized_discounted_cumulative_gain_at_10',
+            blue_green=False,
+            shard_by=None,
+            regions=None,
+            min_shard_interactions=MIN_SHARD_INTERACTIONS,
+            max_shard_workers=None
             ):
 
-        processed_data = self.process_data()
-        self.build_data_for_personalize(processed_data)
-        campaign_arn = self.train_recommendation(
-            import_mode=import_mode,
-            perform_hpo=perform_hpo,
-            perform_auto_ml=perform_auto_ml,
-            keep_previous_solution=keep_previous_solution
-        )
+        # The shards resolve the import mode of their own datasets
+        global_import_mode = self.resolve_import_mode(import_mode)
+        self.run_report.info.update(data_path=self.data_path, import_mode=global_import_mode, blue_green=blue_green,
+                                    shard_by=shard_by)
+        try:
+            with self.run_report.stage('run'):
+                processed_data = self.process_data()
+                self.build_data_for_personalize(processed_data, import_mode=global_import_mode)
+                with self.run_report.stage('build_fallback_recommender', rows_in=len(processed_data)):
+                    self.build_fallback_recommender(processed_data)
+                global_params = {
+                    'import_mode': global_import_mode,
+                    'perform_hpo': perform_hpo,
+                    'perform_auto_ml': perform_auto_ml,
+                    'keep_previous_solution': keep_previous_solution,
+                    'force_retrain': force_retrain,
+                    'solution_configs': solution_configs,
+                    'selection_metric': selection_metric,
+                    'blue_green': blue_green
+                }
+                if shard_by is None:
+                    campaign_arn = self.train_recommendation(**global_params)
+                else:
+                    # The global campaign serves the centers without a shard, it is trained alongside the shards
+                    _, campaign_arn = self.train_shards(
+                        processed_data,
+                        shard_by=shard_by,
+                        regions=regions,
+                        min_interactions=min_shard_interactions,
+                        max_workers=max_shard_workers,
+                        global_params=global_params,
+                        import_mode=import_mode,
+                        perform_hpo=perform_hpo,
+                        perform_auto_ml=perform_auto_ml,
+                        keep_previous_solution=keep_previous_solution,
+                        force_retrain=force_retrain,
+                        solution_configs=solution_configs,
+                        selection_metric=selection_metric
+                    )
+        except BaseException:
+            self.run_report.info['rate_governor'] = self.rate_governor_stats()
+            self.run_report.save(status='failed')
+            raise
+
+        self.run_report.info['campaign_arn'] = campaign_arn
+        self.run_report.info['rate_governor'] = self.rate_governor_stats()
+        self.run_report.save()
         return campaign_arn
 
 
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Train and deploy the recommendation model")
+    parser.add_argument('--data-path', nargs='+',
+                        default=[os.path.join(settings.BASE_DIR, 'data', 'full_2024-02-22_04-55-21.csv')],
+                        help="Raw exports, local or s3:// paths or globs, quote the globs. Later exports win on overlaps")
+    parser.add_argument('--profile-name', default='nmtruong')
+    parser.add_argument('--import-mode', choices=['FULL', 'INCREMENTAL'], default='FULL')
+    parser.add_argument('--perform-hpo', action='store_true')
+    parser.add_argument('--force-retrain', action='store_true')
+    parser.add_argument('--blue-green', action='store_true')
+    parser.add_argument('--exact-statistics', action='store_true',
+                        help="Count the distinct users, items and massages exactly instead of with sketches")
+    sharding = parser.add_argument_group('sharding', "Also train one campaign per base center or region")
+    sharding.add_argument('--shard-by', choices=['base_center', 'region'], default=None)
+    sharding.add_argument('--regions', default=None,
+                          help="The center -> region mapping to shard by region, a JSON object or a center,region CSV")
+    sharding.add_argument('--min-shard-interactions', type=int, default=MIN_SHARD_INTERACTIONS,
+                          help="Smaller shards stay on the global campaign")
+    sharding.add_argument('--max-shard-workers', type=int, default=None,
+                          help="The number of shards trained concurrently. Default: all of them")
+    window = parser.add_argument_group('training window', "Only export the interactions of this window to Personalize")
+    window.add_argument('--window-months', type=int, default=None,
+                        help="The last N months. Default: settings.TRAINING_WINDOW_MONTHS, 0 for the whole history")
+    window.add_argument('--window-days', type=int, default=None, help="The last N days")
+    window.add_argument('--window-start', default=None, help="The first date, e.g. 2023-01-01")
+    window.add_argument('--window-end', default=None,
+                        help="The day after the window, e.g. 2024-01-01, alone the whole history before it. "
+                             "Default: the day after the latest booking")
+    add_profiling_args(parser)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    run_report = RunReport('train')
+    run_report.profiler = profiler_from_args(args, run_report)
+    training_window = {
+        'months': args.window_months, 'days': args.window_days,
+        'start_date': args.window_start, 'end_date': args.window_end
+    }
+    training_window = {key: value for key, value in training_window.items() if value is not None} or None
+    train_pipeline = TrainPipeline(args.data_path, profile_name=args.profile_name, run_report=run_report,
+                                   exact_statistics=args.exact_statistics, training_window=training_window)
+    return train_pipeline.run(
+        import_mode=args.import_mode,
+        perform_hpo=args.perform_hpo,
+        force_retrain=args.force_retrain,
+        blue_green=args.blue_green,
+        shard_by=args.shard_by,
+        regions=load_regions(args.regions) if args.regions else None,
+        min_shard_interactions=args.min_shard_interactions,
+        max_shard_workers=args.max_shard_workers
+    )
+
+
 if __name__ == '__main__':
-    data_path = os.path.join(settings.BASE_DIR, 'data', 'full_2024-02-22_04-55-21.csv')
-    train_pipeline = TrainPipeline(data_path, profile_name='nmtruong')
-    train_pipeline.run(import_mode='FULL')
+    # python -m recommender.pipeline_train --profile cpu --profile-stage process_data_types
+    main()
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from config.log_config import logger
+
+STORE_MAGIC = b'MRSTORE1'
+CURRENT_FILE_NAME = 'CURRENT'
+HEADER_STRUCT = struct.Struct('<8sQ')
+ARRAY_ALIGNMENT = 64
+
+
+def hash_store_key(user_id, massage_name):
+    """
+    Hash a (user, massage_name) pair to the 64-bit key used by the store
+
+    :param user_id: str, the user ID
+    :param massage_name: str, the massage name chosen by the guest
+    :return: int, the unsigned 64-bit key
+    """
+    key = f'{user_id}\x1f{massage_name}'.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def _align(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+class _StoreSnapshot:
+    """
+    One immutable, memory-mapped version of the store file.
+    The arrays are views on the mmap, so forked workers share the same physical pages.
+    Readers hold the snapshot between `acquire` and `release`, a retired snapshot is closed by its last reader.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._readers = 0
+        self._retired = False
+        with open(file_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, header_len = HEADER_STRUCT.unpack_from(self._mmap, 0)
+        if magic != STORE_MAGIC:
+            raise ValueError(f"{file_path} is not a recommendation store file")
+
+        header = json.loads(self._mmap[HEADER_STRUCT.size:HEADER_STRUCT.size + header_len])
+        self.version = header['version']
+        self.top_n = header['top_n']
+        n_keys, n_items = header['n_keys'], header['n_items']
+
+        self.keys = np.frombuffer(self._mmap, dtype='<u8', count=n_keys, offset=header['keys_offset'])
+        self.items = np.frombuffer(
+            self._mmap, dtype='<i4', count=n_keys * self.top_n, offset=header['items_offset']
+        ).reshape(n_keys, self.top_n)
+
+        # The item table is tiny (one row per enhancement), decode it once
+        item_ids = np.frombuffer(
+            self._mmap, dtype=f"S{header['item_id_width']}", count=n_items, offset=header['item_ids_offset']
+        )
+        self.item_ids = [item_id.decode('utf-8') for item_id in item_ids]
+        self.item_names = None
+        if header.get('item_names_offset') is not None:
+            item_names = np.frombuffer(
+                self._mmap, dtype=f"S{header['item_name_width']}", count=n_items,
+                offset=header['item_names_offset']
+            )
+            self.item_names = [item_name.decode('utf-8') for item_name in item_names]
+
+    def acquire(self):
+        """
+        :return: bool, whether the snapshot is still open, it must then be released
+        """
+        with self._lock:
+            if self._mmap is None:
+                return False
+            self._readers += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._readers -= 1
+            if self._retired and self._readers == 0:
+                self._close()
+
+    def retire(self):
+        """
+        Close the snapshot once its last reader is done, it was replaced by a new version
+        """
+        with self._lock:
+            self._retired = True
+            if self._readers == 0:
+                self._close()
+
+    def _close(self):
+        # The arrays export the mmap buffer, drop them before closing it
+        self.keys = self.items = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            logger.warning(f"Recommendation store {self.file_path} is still referenced, left to the garbage collector")
+        self._mmap = None
+
+    def lookup(self, key):
+        index = int(np.searchsorted(self.keys, key))
+        if index >= self.keys.shape[0] or self.keys[index] != key:
+            return None
+        row = self.items[index]
+        return row[row >= 0]
+
+
+class RecommendationStore:
+    """
+    Local store of precomputed top-N item lists per (user, massage_name).
+
+    The store directory holds one immutable file per version and a CURRENT pointer file.
+    Writers publish a new version with an atomic rename of the pointer; readers pick it up
+    with `reload()` (or automatically every `refresh_interval` seconds) without a restart.
+
+    File layout: a small JSON header, sorted uint64 key hashes, a fixed-width int32 matrix of
+    item indices (-1 padded) and the item ID / name tables.
+    """
+
+    def __init__(self, store_dir, refresh_interval=60):
+        self.store_dir = store_dir
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._current_mtime = None
+        self._last_check = 0.0
+        self._reload_lock = threading.Lock()
+        self.reload()
+
+    @property
+    def version(self):
+        snapshot = self._snapshot
+        return snapshot.version if snapshot is not None else None
+
+    @staticmethod
+    def write(store_dir, recommendations, top_n=25, version=None):
+        """
+        Write a new version of the store and make it the current one
+
+        :param store_dir: str, the store directory
+        :param recommendations: pd.DataFrame, ranked recommendations with columns USER_ID, MASSAGE_NAME, ITEM_ID
+                                and optionally ITEM_NAME. Rows are expected in rank order per (USER_ID, MASSAGE_NAME)
+        :param top_n: int, the number of items kept per key
+        :param version: str, the version name, e.g. the solution version ID. Default: current unix time
+        :return: str, the path of the written store file
+        """
+        version = str(version or int(time.time()))
+        logger.info(f"Writing recommendation store version {version}...")
+        os.makedirs(store_dir, exist_ok=True)
+
+        df = recommendations.copy()
+        df['RANK'] = df.groupby(['USER_ID', 'MASSAGE_NAME'], sort=False, observed=True).cumcount()
+        df = df[df['RANK'] < top_n]
+
+        item_codes, item_ids = df['ITEM_ID'].astype(str).factorize()
+        df['ITEM_CODE'] = item_codes
+        df['KEY'] = np.fromiter(
+            (hash_store_key(u, m) for u, m in zip(df['USER_ID'], df['MASSAGE_NAME'])),
+            dtype=np.uint64, count=len(df)
+        )
+
+        keys, key_index = np.unique(df['KEY'].to_numpy(), return_inverse=True)
+        items = np.full((len(keys), top_n), -1, dtype='<i4')
+        items[key_index, df['RANK'].to_numpy()] = df['ITEM_CODE'].to_numpy()
+
+        item_id_table = np.array([i.encode('utf-8') for i in item_ids])
+        item_name_table = None
+        if 'ITEM_NAME' in df.columns:
+            names = df.drop_duplicates('ITEM_CODE').set_index('ITEM_CODE')['ITEM_NAME'].sort_index()
+            item_name_table = np.array([str(name).encode('utf-8') for name in names])
+
+        header = {
+            'version': version,
+            'top_n': top_n,
+            'n_keys': int(len(keys)),
+            'n_items': int(len(item_id_table)),
+            'item_id_width': int(item_id_table.dtype.itemsize),
+        }
+        # The header size must be known before the offsets, reserve room for them
+        header_len = len(json.dumps({**header, 'keys_offset': 0, 'items_offset': 0, 'item_ids_offset': 0,
+                                     'item_names_offset': 0, 'item_name_width': 0})) + 128
+        header['keys_offset'] = _align(HEADER_STRUCT.size + header_len)
+        header['items_offset'] = _align(header['keys_offset'] + keys.nbytes)
+        header['item_ids_offset'] = _align(header['items_offset'] + items.nbytes)
+        header['item_names_offset'] = None
+        if item_name_table is not None:
+            header['item_names_offset'] = _align(header['item_ids_offset'] + item_id_table.nbytes)
+            header['item_name_width'] = int(item_name_table.dtype.itemsize)
+
+        file_name = f'store-{version}.bin'
+        file_path = os.path.join(store_dir, file_name)
+        tmp_path = f'{file_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER_STRUCT.pack(STORE_MAGIC, header_len))
+            f.write(json.dumps(header).encode('utf-8').ljust(header_len))
+            for offset, array in [
+                (header['keys_offset'], keys.astype('<u8')),
+                (header['items_offset'], items),
+                (header['item_ids_offset'], item_id_table),
+                (header['item_names_offset'], item_name_table),
+            ]:
+                if array is None:
+                    continue
+                f.seek(offset)
+                f.write(array.tobytes())
+        os.replace(tmp_path, file_path)
+
+        # Publish the new version atomically
+        pointer_path = os.path.join(store_dir, CURRENT_FILE_NAME)
+        with open(f'{pointer_path}.tmp', 'w') as f:
+            f.write(file_name)
+        os.replace(f'{pointer_path}.tmp', pointer_path)
+
+        logger.info(f"Recommendation store {file_path} written with {len(keys)} keys")
+        return file_path
+
+    def reload(self):
+        """
+        Load the version the CURRENT pointer refers to and swap it in if it changed
+
+        :return: bool, whether a new version was loaded
+        """
+        with self._reload_lock:
+            self._last_check = time.monotonic()
+            pointer_path = os.path.join(self.store_dir, CURRENT_FILE_NAME)
+            try:
+                mtime = os.stat(pointer_path).st_mtime_ns
+            except FileNotFoundError:
+                logger.warning(f"No recommendation store published in {self.store_dir}")
+                return False
+
+            if mtime == self._current_mtime:
+                return False
+
+            with open(pointer_path) as f:
+                file_name = f.read().strip()
+            snapshot = _StoreSnapshot(os.path.join(self.store_dir, file_name))
+
+            # Readers holding the previous snapshot keep it open until they are done
+            previous, self._snapshot = self._snapshot, snapshot
+            self._current_mtime = mtime
+            if previous is not None:
+                previous.retire()
+            logger.info(f"Loaded recommendation store version {snapshot.version}")
+            return True
+
+    def _acquire_snapshot(self):
+        """
+        :return: _StoreSnapshot | None, the current snapshot, to release after use
+        """
+        while True:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.acquire():
+                return snapshot
+
+    def prefault(self):
+        """
+        Read the whole current version once, so the first lookups don't pay for page faults
+
+        :return: int, the number of keys
+        """
+        snapshot = self._acquire_snapshot()
+        if snapshot is None:
+            return 0
+        try:
+            # The sums force every page of the key and item arrays to be read
+            int(snapshot.keys.sum())
+            int(snapshot.items.sum())
+            return int(snapshot.keys.shape[0])
+        finally:
+            snapshot.release()
+
+    def lookup(self, user_id, massage_name, num_results=5, return_item_metadata=True):
+        """
+        Look up the precomputed recommendations of a guest for the chosen massage
+
+        :param user_id: str, the user ID
+        :param massage_name: str, the massage name
+        :param num_results: int, the number of results
+        :param return_item_metadata: bool, whether to return the item names. Default: True
+        :return: list | None, the item list in the runtime response format, None on a miss
+        """
+        if self.refresh_interval is not None and time.monotonic() - self._last_check > self.refresh_interval:
+            self.reload()
+
+        if massage_name is None:
+            return None
+        snapshot = self._acquire_snapshot()
+        if snapshot is None:
+            return None
+        try:
+            if num_results > snapshot.top_n:
+                return None
+            row = snapshot.lookup(hash_store_key(user_id, massage_name))
+        finally:
+            snapshot.release()
+        if row is None or len(row) < num_results:
+            return None
+
+        item_list = []
+        for code in row[:num_results]:
+            item = {'itemId': snapshot.item_ids[code]}
+            if return_item_metadata and snapshot.item_names is not None:
+                item['metadata'] = {'item_name': snapshot.item_names[code]}
+            item_list.append(item)
+        return item_list
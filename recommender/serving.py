@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from config.config import settings
+from config.log_config import logger
+from helpers.metrics import Gauge, LatencyHistogram
+from helpers.resilience import CircuitBreaker
+from recommender.campaign_pointer import CampaignPointer
+from recommender.pipeline_inference import Inference
+
+# GetRecommendations returns at most 500 items
+MAX_NUM_RESULTS = 500
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error',
+                503: 'Service Unavailable'}
+
+
+class RecommendationServer:
+    """
+    Asyncio HTTP front end for one shared `Inference` instance.
+
+    Endpoints:
+        POST /recommendations  {"user_id": ..., "context": {...}, "num_results": 5, "campaign_arn": ...}
+        GET  /metrics          latency histograms, in-flight gauges and counters
+        GET  /health
+        GET  /ready            200 once the Inference is warmed up, 503 before
+
+    The runtime has no batch API, so identical lookups are micro-batched by coalescing: concurrent requests
+    with the same parameters share one in-flight runtime call, and results are kept in a short TTL cache.
+    The blocking runtime calls run on a thread pool sized like the client connection pool.
+    """
+
+    def __init__(self, inference, campaign_arn=None, host='0.0.0.0', port=8080, max_workers=16,
+                 cache_ttl=30.0, cache_size=100000, warm_up_connections=None, rate_export_interval=60.0,
+                 warm_up_retry_interval=30.0):
+        """
+        :param inference: Inference, the shared inference instance
+        :param campaign_arn: str, the campaign used when a request doesn't name one. Default: None, the live
+                             campaign of the Inference campaign pointer
+        :param host: str, the listening host
+        :param port: int, the listening port
+        :param max_workers: int, the number of threads running runtime calls
+        :param cache_ttl: float, seconds a result is served from cache, 0 disables the cache
+        :param cache_size: int, the maximum number of cached results
+        :param warm_up_connections: int, the connections opened by the warm up on start. Default: the pool size
+        :param rate_export_interval: float, seconds between two exports of the request rate history,
+                                     None disables the export
+        :param warm_up_retry_interval: float, seconds between two warm ups until one succeeds,
+                                       None for a single attempt
+        """
+        self.inference = inference
+        self.campaign_arn = campaign_arn
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.warm_up_connections = warm_up_connections
+        self.rate_export_interval = rate_export_interval
+        self.warm_up_retry_interval = warm_up_retry_interval
+        self.export_task = None
+        self.warm_up_task = None
+
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.server = None
+
+        self.request_latency = LatencyHistogram()
+        self.runtime_latency = LatencyHistogram()
+        self.in_flight = Gauge()
+        self.runtime_in_flight = Gauge()
+        self.counters = {'requests': 0, 'errors': 0, 'cache_hits': 0, 'coalesced': 0, 'runtime_calls': 0}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Recommendation server listening on {self.host}:{self.port}")
+
+        # /ready answers 503 until the warm up is over
+        self.warm_up_task = asyncio.ensure_future(self.warm_up())
+        if self.rate_export_interval:
+            self.export_task = asyncio.ensure_future(self.export_request_rates())
+        return self.server
+
+    async def stop(self):
+        if self.warm_up_task is not None:
+            self.warm_up_task.cancel()
+        if self.export_task is not None:
+            self.export_task.cancel()
+            self.inference.export_request_rates()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def warm_up(self):
+        """
+        Warm up the Inference, again every `warm_up_retry_interval` seconds until it is warm
+
+        :return: dict, the status of the last warm up
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            status = await loop.run_in_executor(
+                self.executor, partial(self.inference.warm_up, self.campaign_arn, self.warm_up_connections)
+            )
+            if status['warm'] or not self.warm_up_retry_interval:
+                return status
+            logger.warning(f"Warm up failed ({status['error'] or status['errors']}), "
+                           f"retrying in {self.warm_up_retry_interval}s")
+            await asyncio.sleep(self.warm_up_retry_interval)
+
+    async def export_request_rates(self):
+        """
+        Export the request rate history of the Inference every `rate_export_interval` seconds
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.rate_export_interval)
+            try:
+                await loop.run_in_executor(self.executor, self.inference.export_request_rates)
+            except OSError:
+                logger.exception("Request rate export failed")
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Minimal HTTP/1.1 handling with keep-alive
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode('latin-1').split(' ')[:2]
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self.dispatch(method, path.split('?')[0], body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                data = json.dumps(payload).encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Idle keep-alive connections are cancelled on shutdown
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        if method == 'GET' and path == '/metrics':
+            return 200, self.get_metrics()
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/ready':
+            readiness = self.inference.readiness()
+            return (200 if readiness['ready'] else 503), readiness
+        if method == 'POST' and path == '/recommendations':
+            return await self.handle_recommendations(body)
+        return 404, {'error': f'{method} {path} not found'}
+
+    async def handle_recommendations(self, body):
+        start_time = time.perf_counter()
+        self.in_flight.inc()
+        self.counters['requests'] += 1
+        try:
+            try:
+                params = self.parse_request(json.loads(body or b'{}'))
+            except json.JSONDecodeError as error:
+                return 400, {'error': f'invalid JSON: {error}'}
+            except ValueError as error:
+                return 400, {'error': str(error)}
+
+            item_list = await self.get_recommendations(params)
+            return 200, {'itemList': item_list}
+        except Exception as error:
+            self.counters['errors'] += 1
+            logger.exception("Recommendation request failed")
+            return 500, {'error': repr(error)}
+        finally:
+            self.in_flight.dec()
+            self.request_latency.observe(time.perf_counter() - start_time)
+
+    def parse_request(self, request):
+        """
+        Validate a recommendation request
+
+        :param request: dict, the decoded JSON body
+        :return: dict, the Inference.get_recommendations parameters
+        :raises: ValueError, with the message returned to the client
+        """
+        if not isinstance(request, dict):
+            raise ValueError('the body must be a JSON object')
+        user_id = request.get('user_id')
+        if user_id is None or isinstance(user_id, bool) or not isinstance(user_id, (str, int)) or user_id == '':
+            raise ValueError('user_id is required, a string or an integer')
+
+        context = request.get('context')
+        if context is None:
+            context = {}
+        if not isinstance(context, dict):
+            raise ValueError('context must be a JSON object')
+
+        num_results = request.get('num_results', 5)
+        if isinstance(num_results, str) and num_results.strip().isdigit():
+            num_results = int(num_results)
+        if isinstance(num_results, bool) or not isinstance(num_results, int) \
+                or not 1 <= num_results <= MAX_NUM_RESULTS:
+            raise ValueError(f'num_results must be an integer between 1 and {MAX_NUM_RESULTS}')
+
+        campaign_arn = request.get('campaign_arn', self.campaign_arn)
+        if campaign_arn is not None and not isinstance(campaign_arn, str):
+            raise ValueError('campaign_arn must be a string')
+
+        return_item_metadata = request.get('return_item_metadata', True)
+        if not isinstance(return_item_metadata, bool):
+            raise ValueError('return_item_metadata must be a boolean')
+
+        return {
+            'campaign_arn': campaign_arn,
+            'user_id': str(user_id),
+            'context': context,
+            'num_results': num_results,
+            'return_item_metadata': return_item_metadata,
+        }
+
+    async def get_recommendations(self, params):
+        """
+        Serve from cache, join an identical in-flight lookup or start a new one
+        """
+        key = json.dumps(params, sort_keys=True)
+        loop = asyncio.get_running_loop()
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            expires_at, item_list = cached
+            if expires_at > loop.time():
+                self.counters['cache_hits'] += 1
+                return item_list
+            del self.cache[key]
+
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, params))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        else:
+            self.counters['coalesced'] += 1
+
+        # Shield the shared lookup, one cancelled client must not cancel it for the others
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, params):
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        self.runtime_in_flight.inc()
+        self.counters['runtime_calls'] += 1
+        try:
+            item_list = await loop.run_in_executor(
+                self.executor, partial(self.inference.get_recommendations, **params)
+            )
+        finally:
+            self.runtime_in_flight.dec()
+            self.runtime_latency.observe(time.perf_counter() - start_time)
+
+        if self.cache_ttl:
+            self.cache[key] = (loop.time() + self.cache_ttl, item_list)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return item_list
+
+    def get_metrics(self):
+        """
+        Get the server metrics
+
+        :return: dict, latency histograms, gauges and counters
+        """
+        return {
+            'request_latency': self.request_latency.snapshot(),
+            'runtime_latency': self.runtime_latency.snapshot(),
+            'in_flight': self.in_flight.snapshot(),
+            'runtime_in_flight': self.runtime_in_flight.snapshot(),
+            'cache_entries': len(self.cache),
+            **self.counters,
+            'inference': self.inference.get_metrics(),
+        }
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Serve recommendations over HTTP")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--campaign-arn', default=os.getenv('CAMPAIGN_ARN'))
+    parser.add_argument('--campaign-pointer', action='store_true',
+                        help="Serve the live campaign of the blue/green campaign pointer in S3")
+    parser.add_argument('--profile-name', default=None)
+    parser.add_argument('--max-workers', type=int, default=16)
+    parser.add_argument('--cache-ttl', type=float, default=30.0)
+    parser.add_argument('--latency-budget', type=float, default=None)
+    parser.add_argument('--hedge', action='store_true', help="Send hedged requests after the p95 latency")
+    parser.add_argument('--breaker-failures', type=int, default=None,
+                        help="Consecutive failures that open the circuit breaker, default: no breaker")
+    parser.add_argument('--breaker-reset', type=float, default=30.0)
+    parser.add_argument('--warm-up-connections', type=int, default=None)
+    parser.add_argument('--rate-export-interval', type=float, default=60.0,
+                        help="Seconds between exports of the request rate history, 0 disables them")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    circuit_breaker = None
+    if args.breaker_failures:
+        circuit_breaker = CircuitBreaker(failure_threshold=args.breaker_failures, reset_timeout=args.breaker_reset)
+
+    campaign_pointer = None
+    if args.campaign_pointer:
+        campaign_pointer = CampaignPointer(
+            settings.S3_DATASET_BUCKET, settings.CAMPAIGN_POINTER_KEY, profile_name=args.profile_name
+        )
+
+    inference = Inference.from_serving_artifacts(
+        profile_name=args.profile_name,
+        latency_budget=args.latency_budget,
+        max_workers=args.max_workers,
+        max_pool_connections=args.max_workers,
+        hedge=args.hedge,
+        circuit_breaker=circuit_breaker,
+        campaign_pointer=campaign_pointer
+    )
+    server = RecommendationServer(
+        inference,
+        campaign_arn=args.campaign_arn,
+        host=args.host,
+        port=args.port,
+        max_workers=args.max_workers,
+        cache_ttl=args.cache_ttl,
+        warm_up_connections=args.warm_up_connections,
+        rate_export_interval=args.rate_export_interval
+    )
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
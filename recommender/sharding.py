@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+
+import pandas as pd
+
+from config.log_config import logger
+
+SHARD_KEYS = ('base_center', 'region')
+# Personalize names are at most 63 characters, the shard name goes in front of the resource name
+MAX_SHARD_NAME_LENGTH = 24
+# The hex digits of the hash telling apart the centers or regions with the same shard name
+SHARD_HASH_LENGTH = 6
+# Personalize does not train on fewer interactions
+MIN_SHARD_INTERACTIONS = 1000
+
+
+def shard_name(value, suffix=None):
+    """
+    A Personalize-safe shard name of a center or region, e.g. 'The NOW - Roswell' -> 'the-now-roswell'
+
+    :param value: str, the center or region
+    :param suffix: str, appended after a dash, within the length limit. Default: None
+    :return: str, the shard name
+    """
+    name = re.sub(r'[^a-z0-9]+', '-', str(value).lower()).strip('-')
+    if suffix is None:
+        return name[:MAX_SHARD_NAME_LENGTH].rstrip('-') or 'shard'
+    return f"{name[:MAX_SHARD_NAME_LENGTH - len(suffix) - 1].rstrip('-') or 'shard'}-{suffix}"
+
+
+def shard_names(values):
+    """
+    The shard names of several centers or regions. The values whose names collide, e.g. once lowercased or
+    cut to the length limit, get a short hash of the raw value, the other names are left as `shard_name` makes them.
+
+    :param values: iterable, the centers or regions
+    :return: dict, value -> its shard name, distinct values have distinct names
+    """
+    names = {value: shard_name(value) for value in sorted(set(map(str, values)))}
+    counts = Counter(names.values())
+    for value, name in names.items():
+        if counts[name] > 1:
+            suffix = hashlib.sha1(value.encode()).hexdigest()[:SHARD_HASH_LENGTH]
+            names[value] = shard_name(value, suffix=suffix)
+            logger.warning(f"Shard name {name} is shared by {counts[name]} values, {value!r} -> {names[value]}")
+    if len(set(names.values())) < len(names):
+        raise ValueError(f"Colliding shard names: {sorted(names.values())}")
+    return names
+
+
+def assign_shards(data, shard_by='base_center', regions=None, min_interactions=MIN_SHARD_INTERACTIONS):
+    """
+    Assign every booking to the shard of the guest's base center or its region.
+    Shards with fewer than `min_interactions` bookings, and centers missing from `regions`,
+    are left to the global campaign.
+
+    :param data: pd.DataFrame, the processed data
+    :param shard_by: str, 'base_center'|'region'. Default: 'base_center'
+    :param regions: dict, center -> region, required to shard by region
+    :param min_interactions: int, the minimum bookings of a shard
+    :return: (pd.Series, dict), the shard of every booking (None for the global campaign only)
+             and center -> shard of the sharded centers
+    """
+    if shard_by not in SHARD_KEYS:
+        raise ValueError(f"Unknown shard key {shard_by}, expected one of {SHARD_KEYS}")
+    if shard_by == 'region' and not regions:
+        raise ValueError("Sharding by region needs the center -> region mapping")
+
+    centers = data['base_center'].astype(str).where(data['base_center'].notna())
+    if shard_by == 'base_center':
+        center_shards = shard_names(centers.dropna().unique())
+    else:
+        region_shards = shard_names(regions.values())
+        center_shards = {str(center): region_shards[str(region)] for center, region in regions.items()}
+
+    shards = centers.map(center_shards)
+    counts = shards.value_counts()
+    small = set(counts[counts < min_interactions].index)
+    if small:
+        logger.info(f"{len(small)} shards with fewer than {min_interactions} bookings stay on the global campaign: "
+                    f"{', '.join(sorted(small))}")
+    shards = shards.where(~shards.isin(small))
+    center_shards = {center: shard for center, shard in center_shards.items() if shard not in small}
+    return shards, center_shards
+
+
+def split_shards(data, shards):
+    """
+    Split the processed data by shard
+
+    :param data: pd.DataFrame, the processed data
+    :param shards: pd.Series, the shard of every booking, see `assign_shards`
+    :return: dict, shard -> its bookings
+    """
+    return {shard: shard_df for shard, shard_df in data.groupby(shards.to_numpy(), sort=True)}
+
+
+class ShardRouter:
+    """
+    Routes a request to the campaign of its shard, by the guest's BASE_CENTER first, then by the CENTER_NAME
+    of the booking. Requests of centers without a shard go to the global campaign.
+    """
+
+    def __init__(self, center_shards, shard_campaigns, global_campaign_arn=None, shard_by='base_center'):
+        """
+        :param center_shards: dict, center -> shard
+        :param shard_campaigns: dict, shard -> campaign ARN, the shards without a campaign route to the global one
+        :param global_campaign_arn: str, the campaign of every other request. Default: None, the campaign
+                                    given to Inference or its campaign pointer
+        :param shard_by: str, the shard key, 'base_center'|'region'
+        """
+        self.center_shards = center_shards
+        self.shard_campaigns = shard_campaigns
+        self.global_campaign_arn = global_campaign_arn
+        self.shard_by = shard_by
+        self.center_campaigns = {
+            center: shard_campaigns[shard] for center, shard in center_shards.items() if shard in shard_campaigns
+        }
+
+    def __len__(self):
+        return len(self.shard_campaigns)
+
+    def route(self, context, default=None):
+        """
+        Get the campaign of a request
+
+        :param context: dict, the request context, with BASE_CENTER and/or CENTER_NAME. None for an empty context
+        :param default: str, the campaign when no shard matches. Default: None, the global campaign
+        :return: str | None, the campaign ARN
+        """
+        context = context or {}
+        for field in ('BASE_CENTER', 'CENTER_NAME'):
+            campaign_arn = self.center_campaigns.get(context.get(field))
+            if campaign_arn is not None:
+                return campaign_arn
+        return default if default is not None else self.global_campaign_arn
+
+    def save(self, path):
+        """
+        Save the router to a JSON file, atomically replacing the previous version
+
+        :param path: str, the file path
+        :return: None
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({
+                'shard_by': self.shard_by,
+                'global_campaign_arn': self.global_campaign_arn,
+                'shard_campaigns': self.shard_campaigns,
+                'center_shards': self.center_shards,
+            }, f)
+        os.replace(f'{path}.tmp', path)
+        logger.info(f"Shard router with {len(self)} shard campaigns saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a router saved with `save`
+
+        :param path: str, the file path
+        :return: ShardRouter
+        """
+        with open(path) as f:
+            router = json.load(f)
+        return cls(router['center_shards'], router['shard_campaigns'],
+                   global_campaign_arn=router['global_campaign_arn'], shard_by=router['shard_by'])
+
+
+def load_regions(path):
+    """
+    Load the center -> region mapping, a JSON object or a CSV file with center and region columns
+
+    :param path: str, the file path
+    :return: dict, center -> region
+    """
+    if path.endswith('.csv'):
+        regions_df = pd.read_csv(path, dtype=str)
+        return dict(zip(regions_df['center'], regions_df['region']))
+    with open(path) as f:
+        return json.load(f)
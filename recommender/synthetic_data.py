@@ -0,0 +1,333 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from config.config import settings
+from config.log_config import logger
+
+# The columns of the raw POS export read by DataLoader.load_data
+RAW_COLUMNS = [
+    'invoice_id', 'invoice_closed_date', 'user_id', 'guest_dob', 'guest_gender', 'guest_zipcode',
+    'guest_base_center', 'center_name', 'center_zip', 'service_parent_category', 'service_name',
+    'item_name', 'item_code', 'service_length',
+]
+# A massage is billed on 3 lines, DataLoader keeps the invoices with exactly 3 Massages rows
+MASSAGE_LINES = ['Massage', 'Massage Gratuity', 'Massage Service Fee']
+# The booked minutes are in the name, the service length adds 10 minutes to settle in
+MASSAGE_NAMES = ['The NOW 50', 'The NOW 80', 'The NOW 110', 'The NOW Custom 50', 'The NOW Custom 80',
+                 'The NOW Prenatal 50', 'The NOW Reflexology 50', 'The NOW Couples 80']
+ENHANCEMENT_NAMES = ['CBD Oil', 'Hot Stones', 'Aromatherapy', 'Cupping', 'Scalp Treatment', 'Foot Scrub',
+                     'Hand Treatment', 'Face Treatment', 'Muscle Melt', 'Gua Sha', 'Lymphatic Drainage',
+                     'Eye Mask', 'Back Scrub', 'Percussion Therapy', 'Cooling Gel', 'Extra 10 Minutes']
+CENTER_NAMES = ['Roswell', 'Buckhead', 'Sandy Springs', 'Alpharetta', 'Decatur', 'Marietta', 'Midtown',
+                'Brookhaven', 'Dunwoody', 'Smyrna', 'Vinings', 'Westside']
+RETAIL_NAMES = ['Gift Card', 'Membership Fee', 'Massage Oil', 'Candle']
+
+
+def zipf_cdf(n, skew):
+    """
+    The cumulative distribution of ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** skew
+
+    :param n: int, the number of ranks
+    :param skew: float, the exponent, 0 is uniform
+    :return: np.ndarray, the cumulative probabilities
+    """
+    weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** skew
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def mix64(values):
+    """
+    Deterministic uint64 hash (splitmix64 finalizer), the user attributes are derived from the user index
+    instead of being held in memory for every user
+    """
+    values = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class SyntheticExport:
+    """
+    Generate a raw export in the schema DataLoader reads, to benchmark the pipeline without production data.
+
+    The data follows the shape of the real export:
+        - most massage invoices have 3 Massages lines of the same massage, some have 1, 2 or 6 and are filtered out
+        - 0 to 3 enhancements per invoice, some enhancement lines are billed twice
+        - Retail lines that aren't massages nor enhancements
+        - user activity, massages and enhancements follow Zipf distributions, every massage has its own
+          enhancement preferences
+        - users book in their base center most of the time
+
+    The rows are generated in chunks, so the memory stays flat from 1M to 100M rows.
+    """
+
+    def __init__(self, n_rows=1_000_000, n_users=None, n_centers=40, n_massages=12, n_enhancements=30,
+                 user_skew=0.5, item_skew=1.0, start_date='2021-01-01', end_date='2024-02-22',
+                 chunk_rows=1_000_000, seed=42):
+        """
+        :param n_rows: int, the number of rows
+        :param n_users: int, the number of users. Default: None, one user per 15 rows
+        :param n_centers: int, the number of centers
+        :param n_massages: int, the number of massages
+        :param n_enhancements: int, the number of enhancements
+        :param user_skew: float, the Zipf exponent of the bookings per user, 0 is uniform
+        :param item_skew: float, the Zipf exponent of the massage and enhancement popularity, 0 is uniform
+        :param start_date: str, the first invoice date
+        :param end_date: str, the last invoice date
+        :param chunk_rows: int, the number of rows generated at once
+        :param seed: int, the random seed, the same parameters and seed give the same export
+        """
+        self.n_rows = n_rows
+        self.n_users = n_users or max(1, n_rows // 15)
+        self.n_centers = n_centers
+        self.n_massages = n_massages
+        self.n_enhancements = n_enhancements
+        self.user_skew = user_skew
+        self.item_skew = item_skew
+        self.start = np.datetime64(start_date, 's')
+        self.end = np.datetime64(end_date, 's')
+        self.chunk_rows = chunk_rows
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.user_cdf = zipf_cdf(self.n_users, user_skew)
+        self.center_cdf = zipf_cdf(n_centers, 0.8)
+        self.massage_cdf = zipf_cdf(n_massages, item_skew)
+        self.enhancement_cdf = zipf_cdf(n_enhancements, item_skew)
+        # Shuffle the user ranks, so the most active users aren't the first user IDs
+        self.user_permutation = rng.permutation(self.n_users)
+        # Every massage ranks the enhancements in its own order
+        self.enhancement_preferences = np.array([rng.permutation(n_enhancements) for _ in range(n_massages)])
+
+        self.centers = np.array([self.numbered(CENTER_NAMES, i) for i in range(n_centers)], dtype=object)
+        self.center_zips = np.array([f'{30000 + i * 37 % 999:05d}' for i in range(n_centers)], dtype=object)
+        self.massages = np.array([self.numbered(MASSAGE_NAMES, i) for i in range(n_massages)], dtype=object)
+        self.massage_codes = np.array([f'MAS{i:03d}' for i in range(n_massages)], dtype=object)
+        self.service_lengths = np.array(
+            [float(MASSAGE_NAMES[i % len(MASSAGE_NAMES)].rsplit(' ', 1)[1]) + 10 for i in range(n_massages)]
+        )
+        self.enhancements = np.array([self.numbered(ENHANCEMENT_NAMES, i) for i in range(n_enhancements)],
+                                     dtype=object)
+        self.enhancement_codes = np.array([f'ENH{i:03d}' for i in range(n_enhancements)], dtype=object)
+
+    @staticmethod
+    def numbered(names, i):
+        """
+        The i-th name, numbered once the list is exhausted
+        """
+        return names[i % len(names)] if i < len(names) else f'{names[i % len(names)]} {i // len(names) + 1}'
+
+    def generate_users(self, user_index):
+        """
+        The attributes of the users, derived from the user index
+
+        :param user_index: np.ndarray, the user indexes
+        :return: pd.DataFrame, user_id, guest_dob, guest_gender, guest_zipcode, guest_base_center indexed like
+                 `user_index`
+        """
+        unique_index, inverse = np.unique(user_index, return_inverse=True)
+        high, low = mix64(unique_index), mix64(unique_index + np.uint64(self.n_users))
+        # UUID-like IDs as in the export
+        user_ids = [
+            f'{h >> 32:08x}-{h >> 16 & 0xffff:04x}-4{h & 0xfff:03x}-{l >> 48:04x}-{l & 0xffffffffffff:012x}'
+            for h, l in zip(high.tolist(), low.tolist())
+        ]
+
+        # Adults of 18 to 78 years old at the end of the export
+        age_days = 18 * 365 + (high % np.uint64(60 * 365)).astype(np.int64)
+        dob = pd.to_datetime(self.end.astype('datetime64[D]') - age_days.astype('timedelta64[D]'))
+        guest_dob = dob.strftime('%m/%d/%Y 12:00:00 AM').to_numpy(dtype=object)
+
+        draw = (low % np.uint64(1000)).astype(np.int64)
+        gender = np.where(draw < 720, 'Female', np.where(draw < 985, 'Male', None)).astype(object)
+        zipcode = np.array([f'{30000 + z:05d}' for z in (low >> np.uint64(20) & np.uint64(0xfff)).tolist()],
+                           dtype=object)
+        zipcode[(high >> np.uint64(40)) % np.uint64(100) < 6] = None
+        base_center = np.searchsorted(self.center_cdf, (high >> np.uint64(11)).astype(np.float64) / 2 ** 53)
+
+        return pd.DataFrame({
+            'user_id': np.array(user_ids, dtype=object)[inverse],
+            'guest_dob': guest_dob[inverse],
+            'guest_gender': gender[inverse],
+            'guest_zipcode': zipcode[inverse],
+            'base_center': base_center[inverse],
+        })
+
+    def generate_chunk(self, rng, first_invoice_id, n_invoices):
+        """
+        Generate the rows of `n_invoices` invoices
+
+        :param rng: np.random.Generator, the random generator
+        :param first_invoice_id: int, the ID of the first invoice
+        :param n_invoices: int, the number of invoices
+        :return: pd.DataFrame, the rows in RAW_COLUMNS
+        """
+        # Lines per invoice: massage lines, enhancements, a duplicated enhancement, retail lines
+        n_massage_lines = rng.choice([3, 1, 2, 6], size=n_invoices, p=[0.92, 0.03, 0.03, 0.02])
+        n_enhancement_lines = rng.choice([0, 1, 2, 3], size=n_invoices, p=[0.3, 0.42, 0.2, 0.08])
+        n_duplicates = ((rng.random(n_invoices) < 0.05) & (n_enhancement_lines > 0)).astype(np.int64)
+        n_retail_lines = (rng.random(n_invoices) < 0.1).astype(np.int64)
+        n_lines = n_massage_lines + n_enhancement_lines + n_duplicates + n_retail_lines
+
+        # Invoice attributes
+        invoice_ids = first_invoice_id + np.arange(n_invoices)
+        user_index = self.user_permutation[np.searchsorted(self.user_cdf, rng.random(n_invoices))]
+        users = self.generate_users(user_index)
+        massage_index = np.searchsorted(self.massage_cdf, rng.random(n_invoices))
+        # Users book in their base center most of the time
+        center_index = np.where(
+            rng.random(n_invoices) < 0.85,
+            users['base_center'].to_numpy(),
+            np.searchsorted(self.center_cdf, rng.random(n_invoices))
+        )
+        # Open hours 9 AM to 9 PM
+        days = rng.integers(0, (self.end - self.start).astype('timedelta64[D]').astype(np.int64), n_invoices)
+        seconds = days * 86400 + rng.integers(9 * 3600, 21 * 3600, n_invoices)
+        closed_dates = np.datetime_as_string(self.start + seconds.astype('timedelta64[s]'), unit='s')
+        closed_dates = np.char.replace(closed_dates, 'T', ' ').astype(object)
+
+        # One row per line, `position` is the line number within the invoice
+        row_invoice = np.repeat(np.arange(n_invoices), n_lines)
+        starts = np.cumsum(n_lines) - n_lines
+        position = np.arange(len(row_invoice)) - starts[row_invoice]
+        row_massage_lines = n_massage_lines[row_invoice]
+        is_massage = position < row_massage_lines
+        is_enhancement = ~is_massage & (position < (n_massage_lines + n_enhancement_lines + n_duplicates)[row_invoice])
+        is_retail = ~is_massage & ~is_enhancement
+
+        # The enhancements follow the preferences of the massage of the invoice
+        row_massage = massage_index[row_invoice]
+        enhancement_rank = np.searchsorted(self.enhancement_cdf, rng.random(len(row_invoice)))
+        enhancement_index = self.enhancement_preferences[row_massage, enhancement_rank]
+        # The duplicated line bills the first enhancement of the invoice again
+        is_duplicate = is_enhancement & (position == (n_massage_lines + n_enhancement_lines)[row_invoice])
+        enhancement_index[is_duplicate] = enhancement_index[np.flatnonzero(is_duplicate) - position[is_duplicate]
+                                                            + row_massage_lines[is_duplicate]]
+        retail_index = rng.integers(0, len(RETAIL_NAMES), len(row_invoice))
+
+        category = np.where(is_massage, 'Massages', np.where(is_enhancement, 'Enhancement', 'Retail')).astype(object)
+        service_name = np.array(MASSAGE_LINES, dtype=object)[position % len(MASSAGE_LINES)]
+        service_name[is_enhancement] = 'Enhancement'
+        service_name[is_retail] = 'Retail'
+        item_name = np.where(
+            is_massage, self.massages[row_massage],
+            np.where(is_enhancement, self.enhancements[enhancement_index], np.array(RETAIL_NAMES)[retail_index])
+        ).astype(object)
+        item_code = np.where(
+            is_massage, self.massage_codes[row_massage],
+            np.where(is_enhancement, self.enhancement_codes[enhancement_index],
+                     np.char.add('RET', retail_index.astype(str)))
+        ).astype(object)
+        service_length = np.where(is_massage, self.service_lengths[row_massage], np.nan)
+        row_center = center_index[row_invoice]
+
+        return pd.DataFrame({
+            'invoice_id': invoice_ids[row_invoice],
+            'invoice_closed_date': closed_dates[row_invoice],
+            'user_id': users['user_id'].to_numpy()[row_invoice],
+            'guest_dob': users['guest_dob'].to_numpy()[row_invoice],
+            'guest_gender': users['guest_gender'].to_numpy()[row_invoice],
+            'guest_zipcode': users['guest_zipcode'].to_numpy()[row_invoice],
+            'guest_base_center': self.centers[users['base_center'].to_numpy()][row_invoice],
+            'center_name': self.centers[row_center],
+            'center_zip': self.center_zips[row_center],
+            'service_parent_category': category,
+            'service_name': service_name,
+            'item_name': item_name,
+            'item_code': item_code,
+            'service_length': service_length,
+        }, columns=RAW_COLUMNS)
+
+    def iter_chunks(self):
+        """
+        Generate the export chunk by chunk
+
+        :return: generator of pd.DataFrame, chunks of about `chunk_rows` rows, `n_rows` rows in total
+        """
+        rng = np.random.default_rng(self.seed + 1)
+        # About 4.6 lines per invoice
+        invoices_per_chunk = max(1, int(self.chunk_rows / 4.6))
+        n_rows, first_invoice_id = 0, 10_000_000
+        while n_rows < self.n_rows:
+            chunk = self.generate_chunk(rng, first_invoice_id, invoices_per_chunk)
+            chunk = chunk.iloc[:self.n_rows - n_rows]
+            n_rows += len(chunk)
+            first_invoice_id += invoices_per_chunk
+            yield chunk
+
+    def write(self, path):
+        """
+        Write the export, CSV or Parquet by the file extension, e.g. .csv, .csv.gz or .parquet
+
+        :param path: str, the file path
+        :return: str, the file path
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        is_parquet = path.endswith('.parquet')
+        compression = 'gzip' if path.endswith('.gz') else None
+
+        logger.info(f"Generating {self.n_rows} rows | {self.n_users} users | user skew {self.user_skew} "
+                    f"| item skew {self.item_skew} -> {path}")
+        writer, n_rows = None, 0
+        try:
+            for chunk in self.iter_chunks():
+                if is_parquet:
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq
+
+                    table = pa.Table.from_pandas(chunk, preserve_index=False,
+                                                 schema=writer.schema if writer is not None else None)
+                    if writer is None:
+                        writer = pq.ParquetWriter(tmp_path, table.schema)
+                    writer.write_table(table)
+                else:
+                    chunk.to_csv(tmp_path, mode='a' if n_rows else 'w', header=not n_rows, index=False,
+                                 compression=compression)
+                n_rows += len(chunk)
+                logger.info(f"{n_rows} / {self.n_rows} rows written")
+        finally:
+            if writer is not None:
+                writer.close()
+        os.replace(tmp_path, path)
+        logger.info(f"Synthetic export written to {path}, {os.path.getsize(path) / 1024 ** 2:.1f} MB")
+        return path
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic raw export in the DataLoader schema")
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=None, help="Default: one user per 15 rows")
+    parser.add_argument('--centers', type=int, default=40)
+    parser.add_argument('--massages', type=int, default=12)
+    parser.add_argument('--enhancements', type=int, default=30)
+    parser.add_argument('--user-skew', type=float, default=0.5, help="Zipf exponent of the bookings per user")
+    parser.add_argument('--item-skew', type=float, default=1.0, help="Zipf exponent of the item popularity")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None,
+                        help="A .csv, .csv.gz or .parquet path. Default: settings.BENCHMARK_DATA_DIR/raw_<rows>.csv")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    output = args.output or os.path.join(settings.BENCHMARK_DATA_DIR, f'raw_{args.rows}.csv')
+    return SyntheticExport(
+        n_rows=args.rows,
+        n_users=args.users,
+        n_centers=args.centers,
+        n_massages=args.massages,
+        n_enhancements=args.enhancements,
+        user_skew=args.user_skew,
+        item_skew=args.item_skew,
+        seed=args.seed
+    ).write(output)
+
+
+if __name__ == '__main__':
+    # python -m recommender.synthetic_data --rows 10000000 --output data/synthetic/raw_10M.parquet
+    main()
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from config.log_config import logger
+
+CATEGORICAL_COLUMNS = ['GENDER', 'ZIPCODE', 'BASE_CENTER']
+MISSING_VALUE = 'null'
+
+
+class UserTable:
+    """
+    Columnar user-attribute table built from `DatasetBuilder.build_user_dataset`.
+
+    AGE is kept as a float32 column and GENDER, ZIPCODE, BASE_CENTER as int32 category codes,
+    with a hash index on USER_ID. `Inference` uses it to fill the user fields of the context,
+    so callers only send the user ID and the chosen massage.
+    """
+
+    def __init__(self, user_ids, ages, codes, categories):
+        """
+        :param user_ids: np.ndarray, the user IDs, one per row
+        :param ages: np.ndarray, float32 ages, NaN when unknown
+        :param codes: dict, column -> int32 category codes, -1 when unknown
+        :param categories: dict, column -> np.ndarray of category values
+        """
+        self.user_index = pd.Index(user_ids)
+        self.ages = ages
+        self.codes = codes
+        self.categories = {col: [str(value) for value in values] for col, values in categories.items()}
+
+    def __len__(self):
+        return len(self.user_index)
+
+    @classmethod
+    def from_user_dataset(cls, user_df):
+        """
+        Build the table from the user dataset
+
+        :param user_df: pd.DataFrame, the output of DatasetBuilder.build_user_dataset
+        :return: UserTable
+        """
+        user_df = user_df.drop_duplicates(subset=['USER_ID'])
+        codes, categories = {}, {}
+        for col in CATEGORICAL_COLUMNS:
+            col_codes, col_categories = pd.factorize(user_df[col].astype('object'))
+            codes[col] = col_codes.astype(np.int32)
+            categories[col] = np.asarray([str(value) for value in col_categories], dtype=str)
+
+        return cls(
+            np.asarray(user_df['USER_ID'].astype(str), dtype=str),
+            pd.to_numeric(user_df['AGE'], errors='coerce').to_numpy(dtype=np.float32),
+            codes,
+            categories
+        )
+
+    def save(self, path):
+        """
+        Save the table to a compressed .npz file
+
+        :param path: str, the file path
+        :return: None
+        """
+        arrays = {'user_ids': np.asarray(self.user_index, dtype=str), 'ages': self.ages}
+        for col in CATEGORICAL_COLUMNS:
+            arrays[f'codes_{col}'] = self.codes[col]
+            arrays[f'categories_{col}'] = np.asarray(self.categories[col], dtype=str)
+
+        np.savez_compressed(path, **arrays)
+        logger.info(f"User table with {len(self)} users saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a table saved with `save`
+
+        :param path: str, the file path
+        :return: UserTable
+        """
+        with np.load(path) as arrays:
+            table = cls(
+                arrays['user_ids'],
+                arrays['ages'],
+                {col: arrays[f'codes_{col}'] for col in CATEGORICAL_COLUMNS},
+                {col: arrays[f'categories_{col}'] for col in CATEGORICAL_COLUMNS},
+            )
+        logger.info(f"Loaded user table with {len(table)} users")
+        return table
+
+    def get(self, user_id):
+        """
+        Get the context fields of a user
+
+        :param user_id: str, the user ID
+        :return: dict | None, AGE, GENDER, ZIPCODE and BASE_CENTER as context strings, None for unknown users
+        """
+        try:
+            row = self.user_index.get_loc(user_id)
+        except KeyError:
+            return None
+
+        age = self.ages[row]
+        attributes = {'AGE': MISSING_VALUE if np.isnan(age) else str(int(age))}
+        for col in CATEGORICAL_COLUMNS:
+            code = self.codes[col][row]
+            attributes[col] = self.categories[col][code] if code >= 0 else MISSING_VALUE
+        return attributes
+
+    def fill_context(self, user_id, context):
+        """
+        Fill the user fields missing from a context, the fields sent by the caller take precedence
+
+        :param user_id: str, the user ID
+        :param context: dict, the context, None for an empty one
+        :return: dict, the completed context
+        """
+        attributes = self.get(user_id)
+        if attributes is None:
+            return context or {}
+        return {**attributes, **(context or {})}